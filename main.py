@@ -1,6 +1,11 @@
-def main():
-    print("Hello from shadowrun-lore-rag!")
+"""Entry point: run the whole pipeline incrementally (see src/pipeline.py)."""
 
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "src"))
+
+from pipeline import main  # noqa: E402
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,160 @@
+"""Sourcebook catalogue (docs/sourcebooks.csv), joined onto chunks at ingest.
+
+Chunks only know the markdown file they came from (`source`). At ingest, each
+chunk also gets its book's catalogue fields, so retrieval can be pre-filtered
+to a book, edition or kind of book:
+
+- book_title, book_sku, publisher: always in the catalogue
+- edition, year, book_type: optional columns, added only where filled in
+  (year as an int, so `$gte` / `$lte` work)
+
+A source matches a catalogue row by the SKU its filename starts with
+("7210---tir-tairngire.md" is SKU 7210), or by title when the filename has no
+SKU. Several rows sharing a SKU (revised printings) are told apart by title.
+Sources that match no row get no catalogue fields, and an empty cell adds no
+field, since Chroma metadata can't hold None.
+
+Like `source`, the fields describe a chunk's first occurrence: a chunk shared
+by several books carries the first book's edition and type.
+
+book_filter() turns --book / --edition / --book-type (query.py, evaluate.py)
+into a Chroma `where` filter. --book names the source file, as in the section
+headings of tests/rag_queries.md, and matches it in `sources`, every book a
+chunk appears in, so a shared chunk is found under each of them (the sharded
+backend only searches those books' shards). An edition or type no catalogued
+book has is refused rather than searched for, since nothing could match.
+"""
+
+import csv
+import re
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+
+from config import settings
+from logs import logger
+
+CATALOGUE_FIELDS = ("book_title", "book_sku", "publisher", "edition", "year", "book_type")
+
+
+@dataclass(frozen=True)
+class Book:
+    title: str
+    skus: tuple[str, ...]
+    publisher: str
+    edition: str
+    year: int | None
+    book_type: str
+
+    def metadata(self, sku: str | None = None) -> dict:
+        """Chunk metadata fields; `sku` picks which of a reprint's SKUs to record."""
+        fields = {
+            "book_title": self.title,
+            "book_sku": sku if sku in self.skus else next(iter(self.skus), ""),
+            "publisher": self.publisher,
+            "edition": self.edition,
+            "year": self.year,
+            "book_type": self.book_type,
+        }
+        return {name: value for name, value in fields.items() if value not in ("", None)}
+
+
+def _slug(text: str) -> str:
+    """Lowercase words joined by single hyphens, for comparing titles with filenames."""
+    return "-".join(re.findall(r"[^\W_]+", text.lower()))
+
+
+@cache
+def load_catalogue(path: Path | None = None) -> tuple[Book, ...]:
+    path = path or settings.book_catalogue_path
+    if not path.exists():
+        logger.warning(f"book catalogue not found at {path}, chunks get no book metadata")
+        return ()
+
+    books = []
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            year = (row.get("year") or "").strip()
+            books.append(
+                Book(
+                    title=row["title"].strip(),
+                    skus=tuple(sku.strip() for sku in row["sku"].split(",") if sku.strip()),
+                    publisher=(row.get("publisher") or "").strip(),
+                    edition=(row.get("edition") or "").strip(),
+                    year=int(year) if year.isdigit() else None,
+                    book_type=(row.get("book_type") or "").strip(),
+                )
+            )
+    return tuple(books)
+
+
+@cache
+def find_book(source: str) -> Book | None:
+    """The catalogue row for a source file, by SKU prefix then title."""
+    stem = _slug(Path(source).stem)
+    catalogue = load_catalogue()
+
+    sku = re.match(r"\d+", stem)
+    if sku is None:
+        return next((book for book in catalogue if _slug(book.title) == stem), None)
+
+    candidates = [book for book in catalogue if sku.group() in book.skus]
+    # Revised printings share a SKU; the longest title in the filename wins
+    titled = [book for book in candidates if _slug(book.title) in stem]
+    if titled:
+        return max(titled, key=lambda book: len(book.title))
+    return candidates[0] if candidates else None
+
+
+def book_metadata(source: str) -> dict:
+    """Catalogue fields for a chunk from `source` (empty if it isn't catalogued)."""
+    book = find_book(source)
+    if book is None:
+        return {}
+    sku = re.match(r"\d+", Path(source).stem)
+    return book.metadata(sku.group() if sku else None)
+
+
+def catalogue_fields(metadata: dict) -> dict:
+    """The catalogue fields a stored chunk's metadata holds."""
+    return {name: metadata[name] for name in CATALOGUE_FIELDS if name in metadata}
+
+
+def _check_catalogued(field: str, value: str) -> None:
+    """Raise ValueError unless some catalogued book has `value` in `field`."""
+    known = sorted({getattr(book, field) for book in load_catalogue()} - {""})
+    if not known:
+        raise ValueError(
+            f"no book in {settings.book_catalogue_path} has a {field}; "
+            f"fill in its {field} column to filter on it"
+        )
+    if value not in known:
+        raise ValueError(f"no catalogued book has {field} {value!r} (known: {', '.join(known)})")
+
+
+def book_filter(
+    books: list[str] | None = None,
+    edition: str | None = None,
+    book_type: str | None = None,
+) -> dict | None:
+    """Chroma `where` filter for the given books (source file stems), edition and type.
+
+    Raises ValueError for an edition or type no catalogued book has.
+    """
+    clauses = []
+    if books:
+        sources = [
+            {"sources": {"$contains": book if book.endswith(".md") else f"{book}.md"}}
+            for book in books
+        ]
+        clauses.append(sources[0] if len(sources) == 1 else {"$or": sources})
+    if edition:
+        _check_catalogued("edition", edition)
+        clauses.append({"edition": edition})
+    if book_type:
+        _check_catalogued("book_type", book_type)
+        clauses.append({"book_type": book_type})
+
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
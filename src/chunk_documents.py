@@ -6,6 +6,11 @@ Pass 2: chunks prose with MarkdownTextSplitter, converts table rows to
 
 Tables with clear headers and > MIN_TABLE_ROWS rows get row-as-sentence
 conversion. Small or headerless tables are kept as a single atomic chunk.
+
+Identical chunks from different books are stored once at ingest; their
+metadata then lists every occurrence in parallel `sources` / `headings` lists
+(see chunk_occurrences), with `source` / `heading` holding the first, along
+with that book's catalogue fields (see book_catalogue.py).
 """
 
 import hashlib
@@ -15,6 +20,8 @@ from typing import Generator
 from langchain_core.documents import Document
 from langchain_text_splitters import MarkdownTextSplitter
 
+from book_catalogue import book_metadata
+
 MIN_TABLE_ROWS = 5  # tables below this threshold are kept as atomic chunks
 
 _SEPARATOR_RE = re.compile(r"^\|[-:\s|]+\|$")
@@ -103,6 +110,27 @@ def _chunk_id(content: str) -> str:
     return hashlib.sha1(content.encode()).hexdigest()
 
 
+def occurrence_metadata(occurrences: list[tuple[str, str]]) -> dict:
+    """Metadata fields recording every (source, heading) a chunk appears under.
+
+    The first source's catalogue fields (edition, year, ...) come with it.
+    """
+    return {
+        "source": occurrences[0][0],
+        "heading": occurrences[0][1],
+        "sources": [source for source, _ in occurrences],
+        "headings": [heading for _, heading in occurrences],
+        **book_metadata(occurrences[0][0]),
+    }
+
+
+def chunk_occurrences(metadata: dict) -> list[tuple[str, str]]:
+    """Every (source, heading) a stored chunk appears under, first occurrence first."""
+    if metadata.get("sources"):
+        return list(zip(metadata["sources"], metadata["headings"]))
+    return [(metadata.get("source", "unknown"), metadata.get("heading", ""))]
+
+
 def chunk_markdown(
     content: str,
     source: str,
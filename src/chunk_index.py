@@ -0,0 +1,169 @@
+"""Cross-book chunk index: dedupe by chunk_id and track where each chunk occurs.
+
+Sourcebooks reprint gear tables, rules sidebars and copyright blocks, and
+identical text produces the same chunk_id in every book that carries it. Each
+unique chunk is embedded and stored once under id = chunk_id; its metadata
+lists every (source, heading) occurrence in `sources` / `headings`, while
+`source` / `heading` keep the first occurrence so existing filters still work,
+as do its book's catalogue fields (book_catalogue.py).
+
+The index is also what incremental and resumed runs diff against:
+
+- full rebuild: nothing stored, every first occurrence is embedded
+- incremental: the run sees the whole corpus, so its occurrences are
+  authoritative — stored chunks no longer produced are deleted
+- resume: the run only sees unfinished books, so stored occurrences in books
+  that were not re-processed are kept
+
+A repeat occurrence is only in the store once reconcile() has rewritten its
+chunk's provenance, so that is when it is checkpointed as written: a book
+whose repeats were never reconciled is not "done", and a resume re-processes it.
+"""
+
+from collections import Counter
+from collections.abc import Iterable, Iterator
+
+from book_catalogue import CATALOGUE_FIELDS, book_metadata, catalogue_fields
+from chunk_documents import chunk_occurrences, occurrence_metadata
+from embedding_pipeline import ChunkRef, Item
+from ingest_checkpoint import IngestCheckpoint
+from logs import logger
+
+# langchain_chroma's default collection name — query.py, evaluate.py and
+# shadowtalk.py open the store through langchain and expect this collection
+COLLECTION_NAME = "langchain"
+
+# Chroma rejects get/delete/update calls above ~5.4k ids per request
+CHROMA_MAX_BATCH = 5000
+
+Occurrence = tuple[str, str]  # (source, heading)
+
+
+class ChunkIndex:
+    def __init__(self, collection=None, partial: bool = False):
+        self.partial = partial
+        self.stored: dict[str, list[Occurrence]] = {}
+        self.stored_books: dict[str, dict] = {}  # catalogue fields as stored
+        self.legacy_ids: list[str] = []
+        self.seen: dict[str, list[Occurrence]] = {}
+        self.processed: set[str] = set()
+        self.repeats: list[tuple[ChunkRef, str]] = []  # (occurrence, chunk_id)
+        self.added: Counter[str] = Counter()
+
+        if collection is None:
+            return
+
+        stored = collection.get(include=["metadatas"])
+        for id_, metadata in zip(stored["ids"], stored["metadatas"]):
+            # Stores written before dedupe keyed chunks per book
+            # ("<source>:<chunk_id>"); those are replaced (cache hits, no re-embed)
+            if not metadata or id_ != metadata.get("chunk_id"):
+                self.legacy_ids.append(id_)
+                continue
+            self.stored[id_] = chunk_occurrences(metadata)
+            self.stored_books[id_] = catalogue_fields(metadata)
+
+        if self.legacy_ids:
+            logger.info(f"replacing {len(self.legacy_ids)} chunks stored under per-book ids")
+
+    def admit(self, items: Iterable[Item]) -> Iterator[Item]:
+        """Yield only chunks that still need embedding; record every occurrence."""
+        for ref, chunk in items:
+            chunk_id = chunk.metadata["chunk_id"]
+            occurrence = (ref.source, chunk.metadata["heading"])
+            self.processed.add(ref.source)
+
+            occurrences = self.seen.get(chunk_id)
+            if occurrences is None:
+                self.seen[chunk_id] = [occurrence]
+                if chunk_id not in self.stored:
+                    chunk.metadata.update(occurrence_metadata([occurrence]))
+                    self.added[ref.source] += 1
+                    yield ref, chunk
+                    continue
+            elif occurrence not in occurrences:
+                occurrences.append(occurrence)
+
+            # Already stored (or stored via its first occurrence this run);
+            # written once reconcile() has saved this occurrence
+            self.repeats.append((ref, chunk_id))
+
+    def reconcile(
+        self, collection, skipped: set[str], checkpoint: IngestCheckpoint | None = None
+    ) -> None:
+        """Bring stored provenance in line with this run; delete orphaned chunks.
+
+        Call once the chunk stream has been consumed and written. `skipped` is
+        the set of chunk_ids the pipeline failed to store. Repeat occurrences
+        are checkpointed as written only after their provenance is updated.
+        """
+        updates: dict[str, list[Occurrence]] = {}
+        deletes: list[str] = list(self.legacy_ids)
+        removed: Counter[str] = Counter()
+
+        for chunk_id in self.stored.keys() | self.seen.keys():
+            stored = self.stored.get(chunk_id, [])
+            seen = self.seen.get(chunk_id, [])
+            if self.partial:
+                final = [o for o in stored if o[0] not in self.processed]
+                final += [o for o in seen if o not in final]
+            else:
+                final = seen
+
+            if not final:
+                deletes.append(chunk_id)
+                removed[stored[0][0]] += 1
+                continue
+
+            if chunk_id in self.stored:
+                written = stored
+            elif chunk_id in skipped:
+                continue
+            else:
+                written = seen[:1]
+            # Also rewritten when the catalogue changed since the chunk was stored
+            book_changed = (
+                chunk_id in self.stored
+                and self.stored_books[chunk_id] != book_metadata(final[0][0])
+            )
+            if final != written or book_changed:
+                updates[chunk_id] = final
+
+        # Per-book summary so a one-book re-clean is easy to verify in the log
+        if self.stored or self.legacy_ids:
+            for source in sorted(self.added.keys() | removed.keys()):
+                logger.info(f"  {source}: +{self.added[source]} new, -{removed[source]} stale")
+
+        shared = sum(1 for occurrences in self.seen.values() if len(occurrences) > 1)
+        repeats = sum(len(occurrences) - 1 for occurrences in self.seen.values())
+        if shared:
+            logger.info(
+                f"{shared} chunks appear in more than one place — "
+                f"stored once, {repeats} repeat embeddings avoided"
+            )
+
+        if deletes:
+            logger.info(f"deleting {len(deletes)} stale chunks")
+            for i in range(0, len(deletes), CHROMA_MAX_BATCH):
+                collection.delete(ids=deletes[i : i + CHROMA_MAX_BATCH])
+
+        if updates:
+            logger.info(f"updating provenance of {len(updates)} chunks")
+            items = list(updates.items())
+            for i in range(0, len(items), CHROMA_MAX_BATCH):
+                batch = items[i : i + CHROMA_MAX_BATCH]
+                collection.update(
+                    ids=[chunk_id for chunk_id, _ in batch],
+                    # None drops catalogue fields the book no longer has
+                    metadatas=[
+                        {**dict.fromkeys(CATALOGUE_FIELDS), **occurrence_metadata(final)}
+                        for _, final in batch
+                    ],
+                )
+
+        if checkpoint is not None:
+            # A repeat of a chunk that failed to store stays unwritten, so a
+            # resume retries its book
+            written = [ref for ref, chunk_id in self.repeats if chunk_id not in skipped]
+            if written:
+                checkpoint.record_written(written)
@@ -13,19 +13,43 @@ Cleans:
   row-as-sentence conversion produces labelled sentences instead of ': value'
 - Currency symbol expansion: ¥ → nuyen (¥), £ → Irish punts (£) so that queries
   using either the symbol or the word form match the same chunks
-- Markdown normalisation via mdformat (collapses excessive table cell whitespace
-  that marker-pdf inserts to match PDF column widths)
+- Table normalisation (collapses excessive table cell whitespace that
+  marker-pdf inserts to match PDF column widths, compacts delimiter rows)
+
+All line rules, header repair, currency expansion and table normalisation run
+in a single streaming pass over each file. Table rows are laid out as
+mdformat's compact_tables lays them out (cell text is left as written; see
+normalise_tables); prose is left alone. CLEAN_FORMATTER=mdformat
+re-renders the whole document through mdformat instead, as before.
+
+Books are cleaned in parallel processes, and a book is skipped when its
+source and the cleaning code/config are unchanged since it was last cleaned
+(see stage_stamps.py).
 
 Usage:
     uv run python src/clean_markdown.py
+    uv run python src/clean_markdown.py --force      # re-clean every book
+    uv run python src/clean_markdown.py --check      # diff against markdown_clean/
+    uv run python src/clean_markdown.py --benchmark  # time both formatters
 """
 
+import argparse
+import json
+import os
 import re
+import sys
+import time
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from importlib.metadata import version
+from pathlib import Path
+from typing import TextIO
 
 import mdformat
 
 from config import settings
 from logs import logger, setup_logging
+from stage_stamps import config_hash, run_stage, source_hashes, write_atomic
 
 # Matches standalone image reference lines
 IMAGE_RE = re.compile(r"^!\[.*?\]\(.*?\)\s*$")
@@ -55,6 +79,35 @@ REPEATED_PHRASE_RE = re.compile(r"(\S.{9,})\1{5,}")
 # Matches a markdown separator row: cells containing only dashes, colons, spaces
 SEPARATOR_ROW_RE = re.compile(r"^\|[\s\-:|]+\|$")
 
+# GFM table parsing, as markdown-it does it for mdformat: a delimiter row is
+# made of |, -, : and spaces; each of its cells is dashes with optional
+# alignment colons. Unescaped pipes separate cells
+DELIMITER_ROW_RE = re.compile(r"^[-:|][-:|\s]*$")
+DELIMITER_CELL_RE = re.compile(r"^:?-+:?$")
+CELL_SPLIT_RE = re.compile(r"(?<!\\)\|")
+
+# HTML block starts that can interrupt a paragraph (CommonMark types 1-6)
+HTML_BLOCK_TAGS = (
+    "address|article|aside|base|basefont|blockquote|body|caption|center|col|colgroup|dd"
+    "|details|dialog|dir|div|dl|dt|fieldset|figcaption|figure|footer|form|frame|frameset"
+    "|h[1-6]|head|header|hr|html|iframe|legend|li|link|main|menu|menuitem|nav|noframes|ol"
+    "|optgroup|option|p|param|search|section|summary|table|tbody|td|tfoot|th|thead|title"
+    "|tr|track|ul"
+)
+HTML_BLOCK_START = (
+    r"<(?:(?:script|pre|style|textarea)(?:\s|>|$)|!--|\?|![A-Za-z]|!\[CDATA\["
+    rf"|/?(?:{HTML_BLOCK_TAGS})(?:\s|/?>|$))"
+)
+
+# Block starts that end a table body: blank line, indented code, heading,
+# blockquote, code fence, thematic break, list item or HTML block
+TABLE_END_RE = re.compile(
+    r"^(?: {4}|\s*$| {0,3}(?:#{1,6}(?:\s|$)|>|```|~~~|[-*+](?:\s|$)|\d{1,9}[.)](?:\s|$)"
+    rf"|(?:\*[ \t]*){{3,}}$|(?:-[ \t]*){{3,}}$|(?:_[ \t]*){{3,}}$|{HTML_BLOCK_START}))",
+    re.IGNORECASE,
+)
+FENCE_RE = re.compile(r"^ {0,3}(```|~~~)")
+
 # Continuation fragments that should be merged into the previous header cell
 _CONTINUATION_STARTS = ("/", ":")
 _CONTINUATION_WORDS = ("and ", "or ", "of ")
@@ -138,20 +191,14 @@ def _repair_header_row(line: str) -> str:
     return "|" + "|".join(repaired) + "|"
 
 
-def repair_table_headers(content: str) -> str:
-    """Repair OCR-split header cells across all tables in the content."""
-    lines = content.splitlines()
-    result = []
-    for i, line in enumerate(lines):
-        if (
-            TABLE_ROW_RE.match(line)
-            and i + 1 < len(lines)
-            and SEPARATOR_ROW_RE.match(lines[i + 1])
-            and "--" in lines[i + 1]
-        ):
-            line = _repair_header_row(line)
-        result.append(line)
-    return "\n".join(result)
+def _is_header_row(line: str, next_line: str | None) -> bool:
+    """A table row directly followed by a |---| separator row."""
+    return (
+        next_line is not None
+        and bool(TABLE_ROW_RE.match(line))
+        and bool(SEPARATOR_ROW_RE.match(next_line))
+        and "--" in next_line
+    )
 
 
 def expand_currency_symbols(content: str) -> str:
@@ -169,70 +216,374 @@ def expand_currency_symbols(content: str) -> str:
     return content
 
 
-def postprocess(content: str) -> str:
-    lines = content.splitlines()
-    output = []
+def _expand_line(line: str) -> str:
+    # Most lines have no currency symbol; skip the four regex passes for them
+    if "¥" in line or "£" in line:
+        return expand_currency_symbols(line)
+    return line
+
+
+def clean_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Apply every line rule, header repair and currency expansion in one pass.
+
+    `lines` keep their line endings, as read from a file: an open file can be
+    passed directly, so a book is never held in memory more than once.
+    Header repair needs to see the separator row after a header, so each
+    line is held back until the next kept line arrives.
+    """
+    pending: str | None = None
     prev_blank = False
 
+    for raw in lines:
+        # str.splitlines() also breaks on form feeds, U+2028 etc., which a
+        # file iterator doesn't; split again so line boundaries stay the same
+        for line in raw.splitlines():
+            if is_image_line(line):
+                continue
+
+            if is_malformed_table_row(line):
+                continue
+
+            if INDEX_ENTRY_RE.match(line):
+                continue
+
+            # if not line.strip().startswith("|"):
+            #     line = REPEATED_PHRASE_RE.sub(r"\1", line).strip()
+            #     if not line:
+            #         continue
+
+            line = collapse_table_cell_whitespace(line)
+            line = clean_nav_bar(line)
+
+            # Collapse consecutive blank lines
+            is_blank = not line.strip()
+            if is_blank and prev_blank:
+                continue
+            prev_blank = is_blank
+
+            if pending is not None:
+                if _is_header_row(pending, line):
+                    pending = _repair_header_row(pending)
+                yield _expand_line(pending)
+            pending = line
+
+    # An empty last line is dropped, as joining and re-splitting the lines
+    # always did
+    if pending:
+        yield _expand_line(pending)
+
+
+def _split_row(line: str) -> list[str]:
+    cells = CELL_SPLIT_RE.split(line.strip())
+    if cells and cells[0] == "":
+        cells.pop(0)
+    if cells and cells[-1] == "":
+        cells.pop()
+    return [CELL_WHITESPACE_RE.sub(" ", cell.strip()) for cell in cells]
+
+
+def _delimiter_aligns(line: str) -> list[str] | None:
+    """Alignment markers (":-", "-:", ":-:" or "--") of a delimiter row, else None."""
+    if len(line) - len(line.lstrip(" ")) >= 4:
+        return None
+    stripped = line.strip()
+    if not DELIMITER_ROW_RE.match(stripped) or stripped.startswith(("- ", "-\t")):
+        return None
+
+    columns = stripped.split("|")
+    aligns = []
+    for i, column in enumerate(columns):
+        column = column.strip()
+        if not column:
+            # Outer pipes leave empty columns at the ends, nowhere else
+            if i in (0, len(columns) - 1):
+                continue
+            return None
+        if not DELIMITER_CELL_RE.match(column):
+            return None
+        left, right = column.startswith(":"), column.endswith(":")
+        aligns.append(":-:" if left and right else ":-" if left else "-:" if right else "--")
+    return aligns
+
+
+def _format_row(cells: list[str], columns: int) -> str:
+    # Short rows are padded and long rows truncated to the header's width
+    cells = (cells + [""] * columns)[:columns]
+    return "| " + " | ".join(cells) + " |"
+
+
+def normalise_tables(lines: Iterable[str]) -> Iterator[str]:
+    """Rewrite GFM tables in compact form and pass every other line through.
+
+    Lays rows out as mdformat's compact_tables does: cells trimmed, one space
+    inside each pipe, the delimiter row reduced to --/:-/-:/:-:, and body rows
+    padded or truncated to the header's column count. A table indented under a
+    list item keeps its header row's indentation. Table detection follows GFM
+    (a row with pipes directly above a delimiter row with the same number of
+    columns; the body runs to the next blank line or block start, HTML blocks
+    included), so even pipe-less body rows become table rows, as they do in
+    mdformat. Prose is left exactly as it is.
+
+    Cell text is kept as written, where mdformat re-renders it (decoding
+    entities such as &amp;, re-escaping emphasis characters), and tables
+    inside blockquotes are passed through unchanged. The --benchmark report
+    counts the table rows that still differ from mdformat's.
+    """
+    held: str | None = None  # possible header row, waiting for the next line
+    columns = 0  # > 0 while inside a table body
+    indent = ""  # the table's leading indentation, e.g. inside a list item
+    fence: str | None = None
+
     for line in lines:
-        if is_image_line(line):
+        if columns:
+            if not TABLE_END_RE.match(line):
+                yield indent + _format_row(_split_row(line), columns)
+                continue
+            columns = 0
+
+        if fence:
+            if line.lstrip(" ").startswith(fence):
+                fence = None
+            yield line
             continue
 
-        if is_malformed_table_row(line):
-            continue
+        if held is not None:
+            aligns = _delimiter_aligns(line)
+            header = _split_row(held)
+            if aligns and len(header) == len(aligns):
+                columns = len(aligns)
+                indent = held[: len(held) - len(held.lstrip(" "))]
+                yield indent + _format_row(header, columns)
+                yield indent + "| " + " | ".join(aligns) + " |"
+                held = None
+                continue
+            yield held
+            held = None
+
+        if match := FENCE_RE.match(line):
+            fence = match.group(1)
+            yield line
+        elif "|" in line and len(line) - len(line.lstrip(" ")) < 4:
+            held = line
+        else:
+            yield line
+
+    if held is not None:
+        yield held
 
-        if INDEX_ENTRY_RE.match(line):
-            continue
 
-        # if not line.strip().startswith("|"):
-        #     line = REPEATED_PHRASE_RE.sub(r"\1", line).strip()
-        #     if not line:
-        #         continue
+def format_markdown(content: str) -> str:
+    return mdformat.text(
+        content, extensions={"gfm"}, options={"wrap": "no", "compact_tables": True}
+    )
 
-        line = collapse_table_cell_whitespace(line)
-        line = clean_nav_bar(line)
 
-        # Collapse consecutive blank lines
-        is_blank = not line.strip()
-        if is_blank and prev_blank:
-            continue
+def clean_stream(lines: Iterable[str]) -> Iterator[str]:
+    """The lines of the cleaned book, without line endings, as they're produced.
 
-        output.append(line)
-        prev_blank = is_blank
+    `lines` keep their line endings (e.g. an open file). With the mdformat
+    formatter the whole book is rendered before the first line comes out.
+    """
+    cleaned = clean_lines(lines)
+    if settings.clean_formatter == "mdformat":
+        yield from format_markdown("\n".join(cleaned)).splitlines()
+        return
 
-    result = "\n".join(output)
-    result = repair_table_headers(result)
-    result = expand_currency_symbols(result)
-    result = mdformat.text(
-        result, extensions={"gfm"}, options={"wrap": "no", "compact_tables": True}
+    tables = normalise_tables(cleaned)
+    for line in tables:
+        # A leading blank line is dropped
+        if line:
+            yield line
+            break
+    yield from tables
+
+
+def clean(lines: Iterable[str]) -> str:
+    """Clean a whole book; `lines` keep their line endings (e.g. an open file)."""
+    if settings.clean_formatter == "mdformat":
+        return format_markdown("\n".join(clean_lines(lines)))
+    content = "\n".join(clean_stream(lines))
+    return content + "\n" if content else content
+
+
+def stage_config() -> str:
+    """Everything besides the input that decides what a cleaned book looks like."""
+    return config_hash(
+        source_hashes("clean_markdown"),
+        settings.clean_formatter,
+        version("mdformat"),
+        version("mdformat-gfm"),
     )
-    return result
+
+
+def postprocess(content: str) -> str:
+    return clean(content.splitlines(keepends=True))
+
+
+def clean_file(md_file: Path, dest: Path) -> None:
+    logger.info(f"processing {md_file.name}")
+
+    original_lines = 0
+
+    def counted(f: TextIO) -> Iterator[str]:
+        nonlocal original_lines
+        for line in f:
+            original_lines += len(line.splitlines())
+            yield line
+
+    with open(md_file, encoding="utf-8") as f:
+        cleaned = clean(counted(f))
+    write_atomic(dest, cleaned)
+
+    cleaned_lines = len(cleaned.splitlines())
+    logger.info(
+        f"  {original_lines} → {cleaned_lines} lines ({original_lines - cleaned_lines} removed)"
+    )
+
+
+def check_file(md_file: Path, golden: Path) -> bool:
+    """Compare this version's output for `md_file` with a known-good cleaned file."""
+    with open(md_file, encoding="utf-8") as f:
+        cleaned = clean(f)
+    expected = golden.read_text(encoding="utf-8")
+    if cleaned == expected:
+        return True
+
+    for number, (got, want) in enumerate(
+        zip(cleaned.splitlines(), expected.splitlines()), start=1
+    ):
+        if got != want:
+            logger.error(f"{md_file.name} differs at line {number}:")
+            logger.error(f"  expected: {want!r}")
+            logger.error(f"  got:      {got!r}")
+            break
+    else:
+        logger.error(
+            f"{md_file.name} differs in length: {len(cleaned)} chars, expected {len(expected)}"
+        )
+    return False
+
+
+def benchmark(md_files: list[Path]) -> Path:
+    """Time the table normaliser against mdformat on each book, and compare tables."""
+    books = {}
+    for md_file in md_files:
+        start = time.perf_counter()
+        with open(md_file, encoding="utf-8") as f:
+            lines = list(clean_lines(f))
+        line_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tables = "\n".join(normalise_tables(lines))
+        tables_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        formatted = format_markdown("\n".join(lines))
+        mdformat_seconds = time.perf_counter() - start
+
+        table_rows = [line for line in tables.splitlines() if line.startswith("|")]
+        mdformat_rows = [line for line in formatted.splitlines() if line.startswith("|")]
+        books[md_file.name] = {
+            "chars": sum(len(line) + 1 for line in lines),
+            "line_rules_seconds": round(line_seconds, 4),
+            "tables_seconds": round(tables_seconds, 4),
+            "mdformat_seconds": round(mdformat_seconds, 4),
+            "table_rows": len(table_rows),
+            "table_rows_differing": sum(a != b for a, b in zip(table_rows, mdformat_rows))
+            + abs(len(table_rows) - len(mdformat_rows)),
+        }
+        logger.info(
+            f"{md_file.name}: tables {tables_seconds:.3f}s, mdformat {mdformat_seconds:.3f}s, "
+            f"{books[md_file.name]['table_rows_differing']} of {len(table_rows)} table rows differ"
+        )
+
+    def total(field: str) -> float:
+        return round(sum(book[field] for book in books.values()), 4)
+
+    tables_total, mdformat_total = total("tables_seconds"), total("mdformat_seconds")
+    report = {
+        "books": len(books),
+        "chars": total("chars"),
+        "line_rules_seconds": total("line_rules_seconds"),
+        "tables_seconds": tables_total,
+        "mdformat_seconds": mdformat_total,
+        "speedup": round(mdformat_total / tables_total, 1) if tables_total else None,
+        "table_rows": total("table_rows"),
+        "table_rows_differing": total("table_rows_differing"),
+        "per_book": books,
+    }
+    logger.info(
+        f"{len(books)} books: line rules {report['line_rules_seconds']:.2f}s, "
+        f"tables {tables_total:.2f}s vs mdformat {mdformat_total:.2f}s "
+        f"({report['speedup']}x); {report['table_rows_differing']} of "
+        f"{report['table_rows']} table rows differ"
+    )
+
+    settings.reports_path.mkdir(parents=True, exist_ok=True)
+    output_path = settings.reports_path / f"{datetime.now():%Y%m%d_%H%M%S}_clean_benchmark.json"
+    output_path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    logger.info(f"benchmark written to {output_path}")
+    return output_path
 
 
 def main() -> None:
     setup_logging(settings.log_level)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Write nothing; compare output with the existing markdown_clean/ files "
+        "and exit non-zero if any book would change",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-clean every book, even those whose source and config are unchanged",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.chunk_workers or os.cpu_count() or 1,
+        help="Books cleaned in parallel",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Write nothing; time the table normaliser against mdformat on every book "
+        "and write a report to reports/",
+    )
+    args = parser.parse_args()
+
     if not settings.markdown_extracted_path.exists():
         logger.error(
             f"markdown extracted path {settings.markdown_extracted_path} does not exist"
         )
         return
 
-    settings.markdown_path.mkdir(parents=True, exist_ok=True)
+    md_files = sorted(settings.markdown_extracted_path.glob("*.md"))
 
-    for md_file in sorted(settings.markdown_extracted_path.glob("*.md")):
-        dest = settings.markdown_path / md_file.name
-        logger.info(f"processing {md_file.name}")
+    if args.benchmark:
+        benchmark(md_files)
+        return
 
-        content = md_file.read_text(encoding="utf-8")
-        cleaned = postprocess(content)
-        dest.write_text(cleaned, encoding="utf-8")
+    if args.check:
+        golden = [f for f in md_files if (settings.markdown_path / f.name).exists()]
+        failed = [f for f in golden if not check_file(f, settings.markdown_path / f.name)]
+        logger.info(f"{len(golden) - len(failed)} of {len(golden)} books match markdown_clean/")
+        if failed:
+            sys.exit(1)
+        return
 
-        original_lines = len(content.splitlines())
-        cleaned_lines = len(cleaned.splitlines())
-        logger.info(
-            f"  {original_lines} → {cleaned_lines} lines ({original_lines - cleaned_lines} removed)"
-        )
+    run_stage(
+        "clean",
+        clean_file,
+        md_files,
+        settings.markdown_path,
+        stage_config(),
+        workers=args.workers,
+        force=args.force,
+    )
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 """Configuration for Shadowrun Lore RAG system."""
 
 from pathlib import Path
+from typing import Literal
 
 from pydantic_settings import BaseSettings
 
@@ -9,6 +10,10 @@ class Settings(BaseSettings):
     # Ollama connection
     ollama_host: str = "http://ollama:11434"
 
+    # How long Ollama keeps a model loaded after a request, in seconds
+    # (-1 = until it is restarted); unset uses Ollama's default of 5 minutes
+    ollama_keep_alive: int | None = None
+
     # Ollama models
     embedding_model: str = "mxbai-embed-large"
     llm_model: str = "llama3.1:8b"
@@ -17,16 +22,74 @@ class Settings(BaseSettings):
 
     # Data paths
     data_path: Path = Path("/data")
+    # Sourcebook catalogue joined onto chunks at ingest (see book_catalogue.py)
+    book_catalogue_path: Path = Path("docs/sourcebooks.csv")
+
+    # PDF conversion: release memory between books only above these (0 = never)
+    convert_max_rss_mb: int = 0
+    convert_max_vram_mb: int = 0
+    convert_workers: int = 1  # > 1 converts page-range shards in parallel processes
+    convert_shard_pages: int = 50  # pages per marker call (and per cached batch)
+
+    # Markdown cleaning: "tables" rewrites only table blocks, "mdformat"
+    # re-renders the whole document
+    clean_formatter: Literal["tables", "mdformat"] = "tables"
+
+    # Clean and strip books in memory at ingest, reading markdown_extracted/
+    # directly; markdown_clean/ and markdown_stripped/ are then only written
+    # for debugging, with write_intermediate_markdown
+    inline_markdown_stages: bool = False
+    write_intermediate_markdown: bool = False
 
     # Chunking settings
     chunk_size: int = 1000
     chunk_overlap: int = 200
+    chunk_workers: int = 0  # processes for chunking and per-book clean/strip; 0 = one per core
 
     # Retrieval settings
     top_k: int = 5
+    # "chroma" searches the HNSW index; "numpy" does exact search over a copy
+    # exported from it (numpy_index/); "sharded" searches a copy split into one
+    # collection per book (chroma_shards/) in parallel. float16 halves the
+    # NumPy index but each search pays for converting it back to float32
+    vector_backend: Literal["chroma", "numpy", "sharded"] = "chroma"
+    numpy_index_dtype: Literal["float32", "float16"] = "float32"
+    # Codes the NumPy index is searched through, chosen at ingest/export:
+    # "int8" is 4x smaller than float32, "pq" 64x (1024 dims, 64 subvectors).
+    # The best numpy_index_rescore × top_k candidates are then re-ranked with
+    # their float vectors (0 = rank by the codes alone)
+    numpy_index_quantisation: Literal["none", "int8", "pq"] = "none"
+    numpy_index_rescore: int = 4
+    numpy_index_pq_subvectors: int = 64
+    # Chroma's HNSW index (defaults are Chroma's own). Space, max_neighbors
+    # (M) and ef_construction are fixed when the collection is created, so
+    # changing them needs a full rebuild; ef_search (candidates explored per
+    # query) applies to an existing store. hnsw_benchmark.py sweeps them
+    hnsw_space: Literal["l2", "cosine", "ip"] = "l2"
+    hnsw_max_neighbors: int = 16
+    hnsw_ef_construction: int = 100
+    hnsw_ef_search: int = 100
+    shard_search_workers: int = 0  # threads searching book shards at once; 0 = one per core
+
+    # Query server
+    server_host: str = "0.0.0.0"
+    server_port: int = 8000
+    server_concurrency: int = 4  # answers generated at once; the rest queue
+    server_warmup_attempts: int = 10  # warm-up tries, with backoff, before exiting
 
     # Embedding config
-    embedding_batch_size: int = 10
+    embedding_batch_size: int = 10  # starting size; adapts to observed latency
+    embedding_max_batch_size: int = 64
+    embedding_concurrency: int = 4  # embedding requests kept in flight
+    embedding_target_latency: float = 5.0  # seconds per embedding request
+    embedding_cache_max_mb: int = 2048  # 0 disables the on-disk embedding cache
+
+    # Near-duplicate suppression at ingest. Off by default: a collapsed chunk is
+    # stored with the vector of the chunk it repeats, and two rules or
+    # stat-table chunks this similar often differ in exactly the value a
+    # question asks about
+    near_duplicate_threshold: float = 0.0  # estimated Jaccard similarity; 0 disables
+    near_duplicate_dry_run: bool = False  # only write the cluster report
 
     # Logging
     log_level: str = "INFO"
@@ -43,6 +106,10 @@ class Settings(BaseSettings):
     def markdown_extracted_path(self) -> Path:
         return self.data_path / "markdown_extracted"
 
+    @property
+    def conversion_cache_path(self) -> Path:
+        return self.data_path / "conversion_cache"
+
     @property
     def markdown_path(self) -> Path:
         return self.data_path / "markdown_clean"
@@ -55,6 +122,30 @@ class Settings(BaseSettings):
     def chroma_path(self) -> Path:
         return self.data_path / "chroma_db"
 
+    @property
+    def numpy_index_path(self) -> Path:
+        return self.data_path / "numpy_index"
+
+    @property
+    def chroma_shards_path(self) -> Path:
+        return self.data_path / "chroma_shards"
+
+    @property
+    def ingest_store_path(self) -> Path:
+        # Where create_embeddings writes: with VECTOR_BACKEND=sharded, straight
+        # into the book shards; otherwise the single Chroma store
+        if self.vector_backend == "sharded":
+            return self.chroma_shards_path
+        return self.chroma_path
+
+    @property
+    def embedding_cache_path(self) -> Path:
+        return self.data_path / "embedding_cache"
+
+    @property
+    def reports_path(self) -> Path:
+        return self.data_path / "reports"
+
     @property
     def evals_path(self) -> Path:
         return self.data_path / "evals"
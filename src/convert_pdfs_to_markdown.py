@@ -1,27 +1,84 @@
-"""Ingest PDFs into the RAG system."""
+"""Ingest PDFs into the RAG system.
+
+Books are converted in batches of up to `convert_shard_pages` pages and the
+markdown of every page is cached (see page_cache.py), keyed by PDF hash,
+converter config and page number. A crashed or OOM-killed run loses at most
+the batches in flight; re-running converts only the pages not yet cached.
+Pages are stitched back in order, and a table cut by a page break is joined
+back into one table.
+
+marker-pdf's surya layout/OCR/table models are loaded once per run and reused
+for every batch. After each batch the process RSS and CUDA memory are checked
+against `convert_max_rss_mb` / `convert_max_vram_mb`; only when a limit is
+exceeded are caches released, and if that is not enough the models are
+dropped and reloaded for the next batch.
+
+With --watch the converter stays up with its models loaded and picks up PDFs
+as they land in pdfs_normalised/.
+
+With --workers N (> 1) page batches are converted in parallel worker
+processes, each holding its own copy of the models — for CPU-only nodes,
+where one book otherwise uses a fraction of the cores.
+
+--use-llm --pages re-converts only the listed pages with LLM-assisted table
+fixing; every other page comes from the plain conversion in the cache.
+
+--force rebuilds the markdown but still reuses cached pages. --refresh
+re-converts the selected pages (the LLM pages with --use-llm, otherwise the
+whole book) and overwrites their cache entries, for when a conversion came
+out wrong and converting again may do better. --prune-cache deletes pages
+cached under a converter config that is no longer current.
+
+Usage:
+    uv run python src/convert_pdfs_to_markdown.py
+    uv run python src/convert_pdfs_to_markdown.py --book 7204---germany-sourcebook --force
+    uv run python src/convert_pdfs_to_markdown.py --book 7204---germany-sourcebook --force --use-llm --pages 40-42
+    uv run python src/convert_pdfs_to_markdown.py --book 7204---germany-sourcebook --refresh --use-llm --pages 41
+    uv run python src/convert_pdfs_to_markdown.py --prune-cache
+    uv run python src/convert_pdfs_to_markdown.py --watch
+    uv run python src/convert_pdfs_to_markdown.py --workers 4
+"""
 
 import argparse
 import gc
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import resource
 import sys
+import time
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from importlib.metadata import version
+from pathlib import Path
 
+import pypdfium2
 import torch
 from marker.converters.pdf import PdfConverter
 from marker.models import create_model_dict
 
 from config import settings
 from logs import logger, setup_logging
+from page_cache import PageCache
+
+
+TABLE_ROW_RE = re.compile(r"^\|.*\|$")
+SEPARATOR_ROW_RE = re.compile(r"^\|[\s\-:|]+\|$")
 
+# marker's paginate_output marker: "{page}" followed by 48 dashes
+PAGE_MARKER_RE = re.compile(r"^\{(\d+)\}-{48}$", re.MULTILINE)
 
-def build_converter(model_dict, use_llm: bool = False) -> PdfConverter:
-    """Build a PdfConverter, optionally with LLM-assisted table fixing via Ollama."""
+
+def converter_config(use_llm: bool = False) -> dict:
+    """marker options that shape the output — also what the page cache is keyed on."""
     config = {
         "drop_repeated_text": True,
         "disable_ocr_math": True,
     }
-
     if use_llm:
-        from marker.config.parser import ConfigParser
-
         config.update(
             {
                 "use_llm": True,
@@ -31,6 +88,32 @@ def build_converter(model_dict, use_llm: bool = False) -> PdfConverter:
                 "ollama_model": settings.marker_llm_model,
             }
         )
+    return config
+
+
+def config_hash(use_llm: bool = False) -> str:
+    config = {**converter_config(use_llm), "marker_version": version("marker-pdf")}
+    # The Ollama URL changes between hosts, not the output
+    config.pop("ollama_base_url", None)
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def build_converter(
+    model_dict, use_llm: bool = False, page_range: list[int] | None = None
+) -> PdfConverter:
+    """Build a PdfConverter, optionally with LLM-assisted table fixing via Ollama.
+
+    `page_range` limits conversion to those (0-based) pages. Output is
+    paginated so it can be split and cached per page.
+    """
+    config = converter_config(use_llm)
+    config["paginate_output"] = True
+
+    if use_llm:
+        from marker.config.parser import ConfigParser
+
+        if page_range is not None:
+            config["page_range"] = ",".join(str(page) for page in page_range)
         config_parser = ConfigParser(config)
         return PdfConverter(
             config=config_parser.generate_config_dict(),
@@ -40,11 +123,314 @@ def build_converter(model_dict, use_llm: bool = False) -> PdfConverter:
             llm_service=config_parser.get_llm_service(),
         )
 
+    if page_range is not None:
+        config["page_range"] = page_range
     return PdfConverter(artifact_dict=model_dict, config=config)
 
 
+# Seconds between scans of pdfs_normalised/ in --watch mode
+WATCH_INTERVAL = 30
+
+
+def _rss_mb() -> float:
+    """Current resident set size of this process in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        # No /proc (macOS): fall back to peak RSS, reported in bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024)
+
+
+def _vram_mb() -> float:
+    if not torch.cuda.is_available():
+        return 0.0
+    return torch.cuda.memory_reserved() / (1024 * 1024)
+
+
+def _over_memory_limit() -> bool:
+    return (settings.convert_max_rss_mb > 0 and _rss_mb() > settings.convert_max_rss_mb) or (
+        settings.convert_max_vram_mb > 0 and _vram_mb() > settings.convert_max_vram_mb
+    )
+
+
+def _reclaim_memory() -> None:
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+        torch.cuda.synchronize()
+
+
+class MarkerModels:
+    """marker-pdf models, loaded on first use and kept for the run."""
+
+    def __init__(self):
+        self._model_dict: dict | None = None
+
+    @property
+    def model_dict(self) -> dict:
+        if self._model_dict is None:
+            logger.info("loading marker-pdf models...")
+            self._model_dict = create_model_dict()
+        return self._model_dict
+
+    def convert_pages(self, pdf_file: Path, pages: list[int], use_llm: bool) -> dict[int, str]:
+        """Convert `pages` of a PDF and return each page's markdown."""
+        try:
+            # Converters are cheap to build; the models are shared
+            converter = build_converter(self.model_dict, use_llm=use_llm, page_range=pages)
+            rendered = split_pages(converter(str(pdf_file)).markdown)
+            # Blank pages produce no marker; cache them as empty so they
+            # aren't converted again
+            return {page: rendered.get(page, "") for page in pages}
+        finally:
+            self.reclaim_if_needed()
+
+    def release(self) -> None:
+        if self._model_dict is None:
+            return
+        logger.info("tear down marker-pdf models")
+        self._model_dict = None
+        _reclaim_memory()
+
+    def reclaim_if_needed(self) -> None:
+        """Free memory only when over the configured RSS/VRAM limits."""
+        if not _over_memory_limit():
+            return
+        logger.info(
+            f"memory over limit (rss {_rss_mb():.0f} MB, vram {_vram_mb():.0f} MB), "
+            "releasing cached memory"
+        )
+        _reclaim_memory()
+        if _over_memory_limit():
+            # Still over: the models themselves (or fragmentation around them)
+            # are the problem — reload them for the next batch
+            self.release()
+
+
+def find_pdfs() -> list[Path]:
+    return sorted(settings.pdfs_normalised_path.glob("*.pdf"))
+
+
+def pdf_hash(pdf_file: Path) -> str:
+    """SHA-256 of the PDF's bytes, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(pdf_file, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def page_count(pdf_file: Path) -> int:
+    pdf = pypdfium2.PdfDocument(str(pdf_file))
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def split_pages(markdown: str) -> dict[int, str]:
+    """Split paginated marker output into {page number: markdown}."""
+    parts = PAGE_MARKER_RE.split(markdown)
+    # parts = [preamble, page, text, page, text, ...]
+    return {int(page): text.strip("\n") for page, text in zip(parts[1::2], parts[2::2])}
+
+
+def page_runs(pages: list[int], max_pages: int) -> list[list[int]]:
+    """Group sorted page numbers into contiguous runs of at most `max_pages`."""
+    runs: list[list[int]] = []
+    for page in pages:
+        if runs and page == runs[-1][-1] + 1 and len(runs[-1]) < max_pages:
+            runs[-1].append(page)
+        else:
+            runs.append([page])
+    return runs
+
+
+def _table_cells(line: str) -> list[str]:
+    return [cell.strip() for cell in line.strip().split("|")[1:-1]]
+
+
+def _join_pages(before: str, after: str) -> str:
+    """Concatenate two consecutive pages, re-joining a table cut between them.
+
+    A table that runs over the page break comes out of the second page as a
+    new table: either the real header repeated, or its first row promoted to a
+    header. Both are folded into the table that ends the first page.
+    """
+    before_lines = before.rstrip("\n").split("\n")
+    after_lines = after.lstrip("\n").split("\n")
+
+    ends_in_table = bool(TABLE_ROW_RE.match(before_lines[-1].strip()))
+    starts_with_table = (
+        len(after_lines) >= 2
+        and TABLE_ROW_RE.match(after_lines[0].strip())
+        and SEPARATOR_ROW_RE.match(after_lines[1].strip())
+    )
+    if not (ends_in_table and starts_with_table):
+        return before.rstrip("\n") + "\n\n" + after.lstrip("\n")
+
+    columns = len(_table_cells(before_lines[-1]))
+    if len(_table_cells(after_lines[0])) != columns:
+        return before.rstrip("\n") + "\n\n" + after.lstrip("\n")
+
+    start = len(before_lines) - 1
+    while start > 0 and TABLE_ROW_RE.match(before_lines[start - 1].strip()):
+        start -= 1
+    header = _table_cells(before_lines[start])
+
+    if _table_cells(after_lines[0]) == header:
+        continuation = after_lines[2:]  # repeated header + separator
+    else:
+        continuation = after_lines[:1] + after_lines[2:]  # promoted first row
+
+    return "\n".join(before_lines + continuation)
+
+
+def stitch_pages(pages: list[str]) -> str:
+    pages = [page for page in pages if page.strip()]
+    if not pages:
+        return ""
+    markdown = pages[0]
+    for page in pages[1:]:
+        markdown = _join_pages(markdown, page)
+    return markdown + "\n"
+
+
+# -- sharded conversion -----------------------------------------------------
+
+# Models of the current worker process, loaded by _init_shard_worker
+_worker_models: MarkerModels | None = None
+
+
+def _init_shard_worker(torch_threads: int) -> None:
+    global _worker_models
+    setup_logging(settings.log_level)
+    # Split the cores between workers instead of each one grabbing all of them
+    torch.set_num_threads(torch_threads)
+    _worker_models = MarkerModels()
+
+
+def _convert_shard(pdf_file: Path, pages: list[int], use_llm: bool) -> dict[int, str]:
+    """Convert one page range. Runs in a worker process."""
+    return _worker_models.convert_pages(pdf_file, pages, use_llm)
+
+
+def _convert_runs(
+    pdf_file: Path,
+    runs: list[list[int]],
+    use_llm: bool,
+    models: MarkerModels | None,
+    pool: ProcessPoolExecutor | None,
+) -> Iterator[dict[int, str] | Exception]:
+    """Convert page runs in-process or on the pool, yielding each as it finishes.
+
+    A failed run is yielded as its exception so the runs around it still land
+    in the cache.
+    """
+    if pool is None:
+        for run in runs:
+            try:
+                yield models.convert_pages(pdf_file, run, use_llm)
+            except Exception as e:
+                yield e
+        return
+
+    futures = [pool.submit(_convert_shard, pdf_file, run, use_llm) for run in runs]
+    for future in as_completed(futures):
+        try:
+            yield future.result()
+        except Exception as e:
+            yield e
+
+
+def convert_pdf(
+    pdf_file: Path,
+    output_file: Path,
+    cache: PageCache,
+    use_llm: bool = False,
+    llm_pages: set[int] | None = None,
+    models: MarkerModels | None = None,
+    pool: ProcessPoolExecutor | None = None,
+    workers: int = 1,
+    refresh: bool = False,
+) -> bool:
+    """Convert one book page by page through the cache; returns True on success.
+
+    With `use_llm`, every page (or only `llm_pages`, if given) is converted with
+    LLM-assisted table fixing; the rest use the plain converter. Each set of
+    pages is looked up under its own config hash. With `refresh`, the pages
+    converted the way `use_llm` asks for skip the cache and replace its entries.
+    """
+    try:
+        content_hash = pdf_hash(pdf_file)
+        pages = page_count(pdf_file)
+    except Exception as e:
+        logger.error(f"error reading {pdf_file.name}: {e}")
+        return False
+
+    wants_llm = {
+        page: use_llm and (llm_pages is None or page in llm_pages) for page in range(pages)
+    }
+    rendered: dict[int, str] = {}
+    failed = 0
+
+    for llm in (False, True):
+        selected = [page for page in range(pages) if wants_llm[page] == llm]
+        if not selected:
+            continue
+        config = config_hash(llm)
+        if refresh and llm == use_llm:
+            cached = {}
+        else:
+            cached = cache.get_many(content_hash, config, selected)
+        rendered.update(cached)
+
+        missing = [page for page in selected if page not in cached]
+        label = " [LLM-assisted]" if llm else ""
+        if not missing:
+            logger.info(f"{pdf_file.name}{label}: all {len(selected)} pages cached")
+            continue
+
+        run_pages = settings.convert_shard_pages
+        if pool is not None:
+            # At least one run per worker so a short book still spreads out
+            run_pages = max(1, min(run_pages, math.ceil(len(missing) / workers)))
+        runs = page_runs(missing, run_pages)
+        logger.info(
+            f"converting {pdf_file.name}{label}: {len(missing)} of {len(selected)} pages "
+            f"({len(cached)} cached) in {len(runs)} batches"
+        )
+
+        for result in _convert_runs(pdf_file, runs, llm, models, pool):
+            if isinstance(result, Exception):
+                logger.error(f"error converting {pdf_file.name}: {result}")
+                failed += 1
+                continue
+            cache.put_many(content_hash, config, result)
+            rendered.update(result)
+
+    if failed:
+        logger.error(
+            f"{failed} page batches of {pdf_file.name} failed — converted pages are "
+            "cached, re-run to retry the rest"
+        )
+        return False
+
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(stitch_pages([rendered[page] for page in range(pages)]))
+    logger.info(f"saved to {output_file.name}")
+    return True
+
+
 def convert_pdfs_to_markdown(
-    book: str | None = None, force: bool = False, use_llm: bool = False
+    book: str | None = None,
+    force: bool = False,
+    use_llm: bool = False,
+    llm_pages: set[int] | None = None,
+    workers: int = 1,
+    refresh: bool = False,
 ) -> None:
     """Convert PDFs to markdown using marker-pdf."""
     logger.info(f"looking for PDFs in {settings.pdfs_normalised_path}")
@@ -53,7 +439,7 @@ def convert_pdfs_to_markdown(
         logger.error(f"pdf path {settings.pdfs_normalised_path} does not exist")
         sys.exit(1)
 
-    pdf_files = list(settings.pdfs_normalised_path.glob("*.pdf"))
+    pdf_files = find_pdfs()
     if not pdf_files:
         logger.info(f"no PDF files found in {settings.pdfs_normalised_path}")
         return
@@ -66,36 +452,120 @@ def convert_pdfs_to_markdown(
 
     logger.info(f"found {len(pdf_files)} PDF files for extraction")
 
+    convert_pdfs(
+        pdf_files,
+        force=force,
+        use_llm=use_llm,
+        llm_pages=llm_pages,
+        workers=workers,
+        refresh=refresh,
+    )
+
+
+def convert_pdfs(
+    pdf_files: list[Path],
+    force: bool = False,
+    use_llm: bool = False,
+    llm_pages: set[int] | None = None,
+    workers: int = 1,
+    refresh: bool = False,
+) -> list[Path]:
+    """Convert the given PDFs; returns those whose markdown was written."""
     settings.markdown_extracted_path.mkdir(parents=True, exist_ok=True)
+    cache = PageCache(settings.conversion_cache_path)
 
-    for pdf_file in pdf_files:
-        output_file = settings.markdown_extracted_path / f"{pdf_file.stem}.md"
+    pool = None
+    models = None
+    if workers > 1:
+        torch_threads = max(1, (os.cpu_count() or 1) // workers)
+        logger.info(
+            f"converting in page-range shards across {workers} worker processes "
+            f"({torch_threads} torch threads each)"
+        )
+        # spawn: forked workers would inherit torch state that isn't fork-safe
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shard_worker,
+            initargs=(torch_threads,),
+        )
+    else:
+        models = MarkerModels()
 
-        if output_file.exists() and not force:
-            logger.info(f"skipping {pdf_file.name} (already extracted)")
-            continue
+    converted: list[Path] = []
+    try:
+        for pdf_file in pdf_files:
+            output_file = settings.markdown_extracted_path / f"{pdf_file.stem}.md"
 
-        logger.info(f"loading marker-pdf models...")
-        model_dict = create_model_dict()
-        converter = None
-        try:
-            converter = build_converter(model_dict, use_llm=use_llm)
-            label = " [LLM-assisted]" if use_llm else ""
-            logger.info(f"converting {pdf_file.name}{label}")
-            rendered = converter(str(pdf_file))
-            with open(output_file, "w", encoding="utf-8") as f:
-                f.write(rendered.markdown)
-            logger.info(f"saved to {output_file.name}")
-        except Exception as e:
-            logger.error(f"error converting {pdf_file.name}: {e}")
-        finally:
-            logger.info(f"tear down marker-pdf models")
-            del converter
-            del model_dict
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-                torch.cuda.synchronize()
+            if output_file.exists() and not (force or refresh):
+                logger.info(f"skipping {pdf_file.name} (already extracted)")
+                continue
+
+            if convert_pdf(
+                pdf_file,
+                output_file,
+                cache,
+                use_llm=use_llm,
+                llm_pages=llm_pages,
+                models=models,
+                pool=pool,
+                workers=workers,
+                refresh=refresh,
+            ):
+                converted.append(pdf_file)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if models is not None:
+            models.release()
+        cache.close()
+    return converted
+
+
+def watch(use_llm: bool = False) -> None:
+    """Keep the models loaded and convert PDFs as they appear, until interrupted."""
+    settings.markdown_extracted_path.mkdir(parents=True, exist_ok=True)
+    logger.info(
+        f"watching {settings.pdfs_normalised_path} for new PDFs every {WATCH_INTERVAL}s"
+    )
+
+    models = MarkerModels()
+    cache = PageCache(settings.conversion_cache_path)
+    failed: set[Path] = set()
+    try:
+        while True:
+            for pdf_file in find_pdfs():
+                output_file = settings.markdown_extracted_path / f"{pdf_file.stem}.md"
+                if output_file.exists() or pdf_file in failed:
+                    continue
+                if not convert_pdf(pdf_file, output_file, cache, use_llm=use_llm, models=models):
+                    # Don't retry a broken PDF every scan; restart the watcher to retry
+                    failed.add(pdf_file)
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        logger.info("stopping watcher")
+    finally:
+        models.release()
+        cache.close()
+
+
+def prune_cache() -> None:
+    """Drop cached pages converted under a config other than the current plain and LLM ones."""
+    cache = PageCache(settings.conversion_cache_path)
+    try:
+        deleted = cache.prune({config_hash(False), config_hash(True)})
+    finally:
+        cache.close()
+    logger.info(f"pruned {deleted} pages cached under old converter configs")
+
+
+def parse_pages(value: str) -> set[int]:
+    """Parse a 1-based page list like "12,40-42" into 0-based page numbers."""
+    pages: set[int] = set()
+    for part in value.split(","):
+        first, _, last = part.strip().partition("-")
+        pages.update(range(int(first) - 1, int(last or first)))
+    return pages
 
 
 def main() -> None:
@@ -109,16 +579,60 @@ def main() -> None:
     parser.add_argument(
         "--force",
         action="store_true",
-        help="Re-convert even if output already exists",
+        help="Rebuild output even if it exists (pages already in the conversion cache are reused)",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Re-convert the selected pages even if cached, replacing the cached output",
+    )
+    parser.add_argument(
+        "--prune-cache",
+        action="store_true",
+        help="Delete cached pages from converter configs that are no longer current, then exit",
     )
     parser.add_argument(
         "--use-llm",
         action="store_true",
         help=f"LLM-assisted table fixing via Ollama ({settings.marker_llm_model})",
     )
+    parser.add_argument(
+        "--pages",
+        type=parse_pages,
+        help='With --use-llm: only these 1-based pages, e.g. "12,40-42"; the rest reuse the plain conversion',
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.convert_workers,
+        help="Convert each book as page-range shards across this many processes",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep models loaded and convert new PDFs as they arrive",
+    )
     args = parser.parse_args()
 
-    convert_pdfs_to_markdown(book=args.book, force=args.force, use_llm=args.use_llm)
+    if args.pages and not args.use_llm:
+        parser.error("--pages only applies with --use-llm")
+
+    if args.prune_cache:
+        prune_cache()
+        return
+
+    if args.watch:
+        watch(use_llm=args.use_llm)
+        return
+
+    convert_pdfs_to_markdown(
+        book=args.book,
+        force=args.force,
+        use_llm=args.use_llm,
+        llm_pages=args.pages,
+        workers=args.workers,
+        refresh=args.refresh,
+    )
 
 
 if __name__ == "__main__":
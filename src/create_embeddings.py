@@ -1,52 +1,344 @@
-"""Ingest PDFs into the RAG system."""
+"""Ingest PDFs into the RAG system.
 
-import math
+Full rebuild (default) wipes chroma_db/ and embeds every chunk. Incremental mode
+(--incremental) diffs the chunk_ids produced by the chunker against what is
+already stored, embeds and inserts only new chunks, and deletes chunks that no
+longer exist — re-cleaning one book only re-embeds that book.
+
+Chunks are stored once per chunk_id even when several books contain the same
+text; their metadata lists every book and heading they appear under (see
+chunk_index.py). With NEAR_DUPLICATE_THRESHOLD set, near-identical chunks
+(OCR variants, reprinted tables with a changed cell) are folded into the first
+one the same way — see near_duplicates.py; the clusters are written to
+reports/near_duplicates.json.
+
+Every run writes per-stage timings and per-book totals to
+reports/<timestamp>_ingest.json (see ingest_metrics.py).
+
+Progress is checkpointed to chroma_db/ingest_checkpoint.json. If a run dies
+part-way (Ollama restart, OOM), --resume keeps the store, skips books and
+chunks already committed, and retries chunks that were skipped after errors.
+
+A full rebuild creates the collection with the HNSW_* settings (space, M,
+ef_construction, ef_search); incremental and resumed runs keep the existing
+collection's build parameters (see vector_store.py).
+
+With VECTOR_BACKEND=numpy (or --quantisation), the store is exported to
+numpy_index/ once the run finishes (see numpy_index.py). --quantisation picks
+the int8 or PQ codes that index is searched through, overriding
+NUMPY_INDEX_QUANTISATION (see vector_quantisation.py).
+
+With VECTOR_BACKEND=sharded, chunks are written straight into per-book shards
+in chroma_shards/ instead of chroma_db/, a shared chunk into the shard of every
+book it appears in (see sharded_store.py); the checkpoint lives there too.
+
+With INLINE_MARKDOWN_STAGES, books are read from markdown_extracted/ and
+cleaned and stripped in memory on their way to the chunker, so the
+markdown_clean/ and markdown_stripped/ copies are not needed.
+
+Usage:
+    uv run python src/create_embeddings.py
+    uv run python src/create_embeddings.py --incremental
+    uv run python src/create_embeddings.py --resume
+    uv run python src/create_embeddings.py --chunk-workers 1
+    uv run python src/create_embeddings.py --quantisation int8
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import NamedTuple
 
-from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from langchain_ollama import OllamaEmbeddings
 
 from chunk_documents import chunk_markdown
+from chunk_index import ChunkIndex
+from clean_markdown import clean, clean_stream
+from clean_markdown import stage_config as clean_stage_config
 from config import settings
+from embedding_cache import EmbeddingCache
+from embedding_pipeline import (
+    AdaptiveBatchSize,
+    ChunkRef,
+    EmbeddingPipeline,
+    Item,
+    prefetch,
+)
+from ingest_checkpoint import CHECKPOINT_NAME, IngestCheckpoint
+from ingest_metrics import IngestMetrics
 from logs import logger, setup_logging
+from near_duplicates import NearDuplicateFilter
+from numpy_index import export_from_chroma
+from sharded_store import ShardedCollection
+from stage_stamps import write_atomic
+from strip_toc import stage_config as strip_stage_config
+from strip_toc import strip_lines
+from vector_quantisation import QUANTISATIONS
+from vector_store import open_collection
 
 
-def load_and_chunk_documents():
-    """Load markdown files and chunk them using two-pass table-aware chunker."""
-    logger.info(f"loading documents from {settings.markdown_stripped_path}")
+def markdown_source_path() -> Path:
+    """Where ingest reads books from: stripped markdown, or extracted with inline stages."""
+    if settings.inline_markdown_stages:
+        return settings.markdown_extracted_path
+    return settings.markdown_stripped_path
 
-    md_files = list(settings.markdown_stripped_path.glob("*.md"))
-    if not settings.markdown_stripped_path.exists() or not md_files:
-        logger.info(f"no markdown files found in {settings.markdown_path}")
+
+def find_markdown_files() -> list[Path]:
+    source_path = markdown_source_path()
+    logger.info(f"loading documents from {source_path}")
+
+    if not source_path.exists():
+        md_files = []
+    else:
+        md_files = sorted(source_path.glob("*.md"))
+    if not md_files:
+        logger.info(f"no markdown files found in {source_path}")
         return []
 
     logger.info(f"found {len(md_files)} markdown files")
+    return md_files
+
+
+def file_hash(md_file: Path) -> str:
+    return hashlib.sha1(md_file.read_bytes()).hexdigest()
+
+
+class ChunkedBook(NamedTuple):
+    content_hash: str  # keys the book in the checkpoint
+    chunks: list[Document]
+    chars: int
+    read_seconds: float
+    chunk_seconds: float
+
+
+def clean_and_strip(md_file: Path) -> str:
+    """Run the clean and strip stages on an extracted book in memory.
+
+    Lines stream from the file through cleaning and stripping without either
+    stage's output touching disk, unless write_intermediate_markdown asks for
+    debug copies in markdown_clean/ and markdown_stripped/.
+    """
+    with open(md_file, encoding="utf-8") as f:
+        if not settings.write_intermediate_markdown:
+            return "\n".join(strip_lines(clean_stream(f)))
+        cleaned = clean(f)
+
+    stripped = "\n".join(strip_lines(cleaned.splitlines()))
+    for path, content in (
+        (settings.markdown_path, cleaned),
+        (settings.markdown_stripped_path, stripped),
+    ):
+        path.mkdir(parents=True, exist_ok=True)
+        write_atomic(path / md_file.name, content)
+    return stripped
+
+
+def _chunk_file(md_file: Path, chunk_size: int, chunk_overlap: int) -> ChunkedBook:
+    """Read and chunk one book. Top-level so it can run in a worker process."""
+    start = time.perf_counter()
+    raw = md_file.read_bytes()
+    if settings.inline_markdown_stages:
+        # Read time then includes cleaning and stripping
+        content = clean_and_strip(md_file)
+    else:
+        content = raw.decode("utf-8")
+    read_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    file_chunks = chunk_markdown(
+        content=content,
+        source=md_file.name,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+    file_chunks = dedupe_chunks(file_chunks)
+    return ChunkedBook(
+        hashlib.sha1(raw).hexdigest(),
+        file_chunks,
+        len(content),
+        read_seconds,
+        time.perf_counter() - start,
+    )
+
+
+def _chunk_in_pool(md_files: list[Path], workers: int) -> Iterator[ChunkedBook]:
+    """Chunk books across worker processes, yielding results in file order.
+
+    At most `2 * workers` books are in flight, so a slow consumer (the embedding
+    stage) never lets finished books pile up in memory.
+    """
+    # spawn: this runs on the prefetch thread while the Chroma client and
+    # embedding threads are up, and forking a threaded process can deadlock
+    # the child on a lock some other thread held
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=setup_logging,
+        initargs=(settings.log_level,),
+    ) as pool:
+        pending: deque[Future] = deque()
+        files = iter(md_files)
+        for md_file in islice(files, 2 * workers):
+            pending.append(
+                pool.submit(_chunk_file, md_file, settings.chunk_size, settings.chunk_overlap)
+            )
+        while pending:
+            result = pending.popleft().result()
+            for md_file in islice(files, 1):
+                pending.append(
+                    pool.submit(
+                        _chunk_file, md_file, settings.chunk_size, settings.chunk_overlap
+                    )
+                )
+            yield result
+
+
+def load_and_chunk_documents(
+    md_files: list[Path],
+    workers: int = 1,
+    checkpoint: IngestCheckpoint | None = None,
+    metrics: IngestMetrics | None = None,
+) -> Iterator[Item]:
+    """Lazily read and chunk markdown files, one book at a time.
+
+    Only the books currently being chunked are held in memory; each book's
+    chunks are yielded to the embedding stage as soon as it is done. With
+    workers > 1 books are chunked in parallel processes, still in file order.
+
+    Each chunk is yielded with its ChunkRef (book, position in the book).
+    """
     logger.info(
         f"chunking with size={settings.chunk_size}, overlap={settings.chunk_overlap}"
     )
 
-    chunks: list[Document] = []
-    for md_file in md_files:
-        content = md_file.read_text(encoding="utf-8")
-        file_chunks = chunk_markdown(
-            content=content,
-            source=md_file.name,
-            chunk_size=settings.chunk_size,
-            chunk_overlap=settings.chunk_overlap,
+    workers = min(workers, len(md_files))
+    if workers > 1:
+        logger.info(f"chunking across {workers} worker processes")
+        per_file = _chunk_in_pool(md_files, workers)
+    else:
+        per_file = (
+            _chunk_file(md_file, settings.chunk_size, settings.chunk_overlap)
+            for md_file in md_files
         )
-        logger.info(f"  {md_file.name} → {len(file_chunks)} chunks")
-        chunks.extend(file_chunks)
 
-    logger.info(f"created {len(chunks)} chunks total")
-    return chunks
+    total = 0
+    for md_file, book in zip(md_files, per_file):
+        logger.info(f"  {md_file.name} → {len(book.chunks)} chunks")
+        total += len(book.chunks)
+
+        if checkpoint is not None:
+            checkpoint.start_book(md_file.name, book.content_hash, len(book.chunks))
+        if metrics is not None:
+            metrics.record_book(
+                md_file.name, len(book.chunks), book.chars, book.read_seconds, book.chunk_seconds
+            )
+
+        for index, chunk in enumerate(book.chunks):
+            yield ChunkRef(md_file.name, index), chunk
 
+    logger.info(f"created {total} chunks total")
 
-def create_vector_store(chunks: list[Document]):
-    """Create embeddings and store in ChromaDB."""
-    if not chunks:
-        logger.info("no chunks to process")
+
+def dedupe_chunks(chunks: list[Document]) -> list[Document]:
+    """Drop repeated chunk_ids within one book (identical text chunked twice)."""
+    seen: set[str] = set()
+    unique: list[Document] = []
+    for chunk in chunks:
+        if chunk.metadata["chunk_id"] in seen:
+            continue
+        seen.add(chunk.metadata["chunk_id"])
+        unique.append(chunk)
+
+    if len(unique) < len(chunks):
+        logger.debug(f"  dropped {len(chunks) - len(unique)} duplicate chunks")
+    return unique
+
+
+def clear_vector_store() -> None:
+    """Remove existing vector store contents (can't delete mount point)."""
+    if not (settings.ingest_store_path / "chroma.sqlite3").exists():
         return
 
+    logger.info("clearing existing vector store")
+    for item in settings.ingest_store_path.iterdir():
+        if item.is_dir():
+            shutil.rmtree(item)
+        else:
+            item.unlink()
+
+
+def plan_resume(checkpoint: IngestCheckpoint, md_files: list[Path]) -> list[Path]:
+    """Drop books the checkpoint records as finished with unchanged content.
+
+    Partially ingested (or since-changed) books are re-chunked; chunks already
+    in the store are recognised by chunk_id and not embedded again.
+    """
+    remaining = [
+        md_file
+        for md_file in md_files
+        if not checkpoint.book_done(md_file.name, file_hash(md_file))
+    ]
+
+    logger.info(
+        f"resuming: {len(md_files) - len(remaining)} books already committed, "
+        f"{len(remaining)} to go"
+    )
+    return remaining
+
+
+def open_ingest_collection():
+    """The collection ingest writes: per-book shards with VECTOR_BACKEND=sharded."""
+    if settings.vector_backend == "sharded":
+        return ShardedCollection(settings.chroma_shards_path)
+    return open_collection()
+
+
+def _writer(collection):
+    def write(batch: list[Document], vectors: list[list[float]]) -> None:
+        collection.upsert(
+            ids=[doc.metadata["chunk_id"] for doc in batch],
+            embeddings=vectors,
+            metadatas=[doc.metadata for doc in batch],
+            documents=[doc.page_content for doc in batch],
+        )
+
+    return write
+
+
+def write_near_duplicate_report(near_duplicates: NearDuplicateFilter) -> None:
+    settings.reports_path.mkdir(parents=True, exist_ok=True)
+    report_path = settings.reports_path / "near_duplicates.json"
+    report_path.write_text(json.dumps(near_duplicates.report(), indent=2), encoding="utf-8")
+    logger.info(f"near-duplicate report written to {report_path}")
+
+
+def create_vector_store(
+    chunks: Iterable[Item],
+    incremental: bool = False,
+    resume: bool = False,
+    checkpoint: IngestCheckpoint | None = None,
+    metrics: IngestMetrics | None = None,
+):
+    """Create embeddings and store in ChromaDB.
+
+    `chunks` is consumed lazily: chunking runs on a background thread and hands
+    chunks over through a bounded queue, so embedding starts with the first
+    book and memory is bounded by the in-flight window, not the corpus.
+
+    With `resume`, the existing store is kept and added to rather than cleared.
+    """
     logger.info(f"connecting to Ollama at {settings.ollama_host}")
     logger.info(f"using embedding model: {settings.embedding_model}")
 
@@ -55,62 +347,222 @@ def create_vector_store(chunks: list[Document]):
         base_url=settings.ollama_host,
     )
 
-    logger.info(f"creating vector store at {settings.chroma_path}")
-    settings.chroma_path.mkdir(parents=True, exist_ok=True)
+    if incremental:
+        logger.info(f"updating vector store at {settings.ingest_store_path}")
+        collection = open_ingest_collection()
+        index = ChunkIndex(collection)
+    elif resume:
+        logger.info(f"resuming vector store at {settings.ingest_store_path}")
+        collection = open_ingest_collection()
+        index = ChunkIndex(collection, partial=True)
+    else:
+        logger.info(f"creating vector store at {settings.ingest_store_path}")
+        settings.ingest_store_path.mkdir(parents=True, exist_ok=True)
+        clear_vector_store()
+        collection = open_ingest_collection()
+        index = ChunkIndex()
 
-    # Clear existing vector store contents (can't delete mount point)
-    if (settings.chroma_path / "chroma.sqlite3").exists():
-        logger.info("clearing existing vector store")
-        import shutil
+    near_duplicates = None
+    if settings.near_duplicate_threshold > 0:
+        near_duplicates = NearDuplicateFilter(
+            settings.near_duplicate_threshold, dry_run=settings.near_duplicate_dry_run
+        )
+        chunks = near_duplicates.filter(chunks)
 
-        for item in settings.chroma_path.iterdir():
-            if item.is_dir():
-                shutil.rmtree(item)
-            else:
-                item.unlink()
+    chunks = index.admit(chunks)
 
-    logger.info("generating embeddings and storing in ChromaDB")
+    cache = None
+    if settings.embedding_cache_max_mb > 0:
+        logger.info(f"using embedding cache at {settings.embedding_cache_path}")
+        cache = EmbeddingCache(
+            settings.embedding_cache_path,
+            settings.embedding_model,
+            settings.embedding_cache_max_mb,
+        )
 
-    batch_size = settings.embedding_batch_size
-    vector_store = None
+    logger.info(
+        f"generating embeddings and storing in ChromaDB "
+        f"({settings.embedding_concurrency} requests in flight)"
+    )
 
-    for i in range(0, len(chunks), batch_size):
-        batch = chunks[i : i + batch_size]
-        curr_batch = math.floor(i / batch_size) + 1
-        total_batch_count = math.ceil(len(chunks) / batch_size)
-        logger.info(f"processing batch {curr_batch}/{total_batch_count}")
+    skipped_ids: set[str] = set()
 
-        if vector_store is None:
-            vector_store = Chroma.from_documents(
-                documents=batch,
-                embedding=embeddings,
-                persist_directory=str(settings.chroma_path),
-            )
-        else:
-            try:
-                vector_store.add_documents(batch)
-            except Exception as e:
-                logger.warning(f"batch {curr_batch} failed: {e}, trying individually")
-                for idx, document in enumerate(batch):
-                    try:
-                        vector_store.add_documents([document])
-                    except Exception:
-                        logger.error(f"skipping chunk {i+idx}")
+    def on_skipped(ref: ChunkRef, doc: Document) -> None:
+        skipped_ids.add(doc.metadata["chunk_id"])
+        if checkpoint is not None:
+            checkpoint.record_skipped(ref, doc.metadata["chunk_id"])
+
+    pipeline = EmbeddingPipeline(
+        embed=embeddings.embed_documents,
+        write=_writer(collection),
+        cache=cache,
+        batch_size=AdaptiveBatchSize(
+            initial=settings.embedding_batch_size,
+            maximum=settings.embedding_max_batch_size,
+            target_latency=settings.embedding_target_latency,
+        ),
+        concurrency=settings.embedding_concurrency,
+        on_written=checkpoint.record_written if checkpoint else None,
+        on_skipped=on_skipped,
+        metrics=metrics,
+    )
+    window = settings.embedding_max_batch_size * settings.embedding_concurrency
+    stats = pipeline.run(prefetch(chunks, maxsize=2 * window))
+
+    index.reconcile(collection, skipped_ids, checkpoint)
+
+    if near_duplicates is not None:
+        near_duplicates.log_summary()
+        write_near_duplicate_report(near_duplicates)
+        if metrics is not None:
+            metrics.extra["near_duplicates"] = {
+                "collapsed": near_duplicates.collapsed,
+                "clusters": len(near_duplicates.clusters),
+                "dry_run": near_duplicates.dry_run,
+                # The rest were embedded: the chunk they repeat wasn't cached yet
+                "stored_with_kept_vector": stats.borrowed,
+            }
+
+    if cache is not None:
+        cache.log_stats()
+        cache.close()
 
-    logger.info(f"successfully created vector store with {len(chunks)} chunks")
+    if checkpoint is not None:
+        checkpoint.finish()
+
+    if stats.skipped:
+        logger.warning(f"{len(stats.skipped)} chunks skipped after retries:")
+        if checkpoint is not None:
+            for source, indexes in checkpoint.skipped().items():
+                logger.warning(f"  {source}: chunks {indexes}")
+            logger.warning(f"recorded in {checkpoint.path} — re-run with --resume to retry")
+    logger.info(
+        f"successfully stored {stats.written} chunks in vector store "
+        f"({stats.requests} embedding requests)"
+    )
+
+
+def _checkpoint_config() -> dict:
+    """Settings a checkpoint is only valid for — resuming across a change would mix chunkings."""
+    config = {
+        "embedding_model": settings.embedding_model,
+        "chunk_size": settings.chunk_size,
+        "chunk_overlap": settings.chunk_overlap,
+        "near_duplicate_threshold": settings.near_duplicate_threshold,
+    }
+    if settings.near_duplicate_threshold > 0:
+        # A dry run tags nothing, so it stores different vectors
+        config["near_duplicate_dry_run"] = settings.near_duplicate_dry_run
+    if settings.inline_markdown_stages:
+        # Books are keyed by their extracted text, so the cleaning and
+        # stripping code is part of what they were chunked from
+        config["inline_markdown_stages"] = [clean_stage_config(), strip_stage_config()]
+    return config
 
 
 def main():
     """Run the full ingestion pipeline."""
     setup_logging(settings.log_level)
 
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only embed new chunks and delete stale ones instead of rebuilding",
+    )
+    mode.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted ingest from its checkpoint and retry skipped chunks",
+    )
+    parser.add_argument(
+        "--chunk-workers",
+        type=int,
+        default=settings.chunk_workers or os.cpu_count() or 1,
+        help="Worker processes for chunking (1 = chunk in-process)",
+    )
+    parser.add_argument(
+        "--quantisation",
+        choices=QUANTISATIONS,
+        help="Export the NumPy index searched through these codes (default: "
+        "NUMPY_INDEX_QUANTISATION, exported only with VECTOR_BACKEND=numpy)",
+    )
+    args = parser.parse_args()
+    if args.quantisation and settings.vector_backend == "sharded":
+        parser.error("--quantisation exports chroma_db/, which VECTOR_BACKEND=sharded doesn't write")
+
+    run_ingest(
+        incremental=args.incremental,
+        resume=args.resume,
+        chunk_workers=args.chunk_workers,
+        quantisation=args.quantisation,
+    )
+
+
+def run_ingest(
+    incremental: bool = False,
+    resume: bool = False,
+    chunk_workers: int = 1,
+    quantisation: str | None = None,
+) -> None:
     logger.info("shadowrun lore RAG ingestion started")
 
-    # Step 2: Load and chunk documents
-    chunks = load_and_chunk_documents()
+    checkpoint_path = settings.ingest_store_path / CHECKPOINT_NAME
+    if resume:
+        checkpoint = IngestCheckpoint.load(checkpoint_path)
+        if checkpoint is None:
+            logger.error(f"no ingest checkpoint at {checkpoint_path} — nothing to resume")
+            sys.exit(1)
+        if checkpoint.config != _checkpoint_config():
+            logger.error(
+                f"checkpoint was written with {checkpoint.config}, "
+                f"current settings are {_checkpoint_config()} — run a full rebuild"
+            )
+            sys.exit(1)
+        # An incremental run is resumable by design — just run it again
+        incremental = checkpoint.mode == "incremental"
+    else:
+        checkpoint = IngestCheckpoint(
+            checkpoint_path,
+            mode="incremental" if incremental else "full",
+            config=_checkpoint_config(),
+        )
+
+    md_files = find_markdown_files()
+    if not md_files:
+        return
+
+    resume = resume and not incremental
+    if resume:
+        md_files = plan_resume(checkpoint, md_files)
+        if not md_files:
+            logger.info("nothing to resume — last ingest completed")
+            return
+
+    metrics = IngestMetrics(
+        mode="resume" if resume else checkpoint.mode,
+        config={
+            **_checkpoint_config(),
+            "chunk_workers": chunk_workers,
+            "embedding_concurrency": settings.embedding_concurrency,
+            "embedding_batch_size": settings.embedding_batch_size,
+            "embedding_max_batch_size": settings.embedding_max_batch_size,
+        },
+    )
+
+    # Chunking is lazy — books are chunked as the embedding stage pulls them
+    chunks = load_and_chunk_documents(
+        md_files, workers=chunk_workers, checkpoint=checkpoint, metrics=metrics
+    )
+    create_vector_store(
+        chunks, incremental=incremental, resume=resume, checkpoint=checkpoint, metrics=metrics
+    )
+    metrics.write_report(settings.reports_path)
 
-    # Step 3: Create vector store
-    create_vector_store(chunks)
+    if settings.vector_backend == "numpy" or quantisation is not None:
+        logger.info(f"exporting to the NumPy index at {settings.numpy_index_path}")
+        export_from_chroma(quantisation=quantisation)
 
     logger.info("shadowrun lore RAG ingestion complete")
 
@@ -0,0 +1,211 @@
+"""Persistent content-addressed embedding cache.
+
+Embeddings are keyed by (embedding_model, chunk_id). Because chunk_id is the
+SHA-1 of the chunk text, an unchanged prose chunk or table row hits the cache
+across full rebuilds and chunk_size/overlap experiments and is never sent to
+Ollama twice.
+
+Layout under embedding_cache/<model-slug>/:
+    vectors.f32    — fixed-size float32 slots, memory-mapped with numpy
+    index.sqlite3  — chunk_id → slot offset, plus last-use time for eviction
+
+The cache is capped at `embedding_cache_max_mb`; when full, least recently used
+entries are evicted and their slots reused.
+"""
+
+import re
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+
+from logs import logger
+
+_DTYPE = np.float32
+_MIN_CAPACITY = 1024  # slots allocated on first write
+
+
+def model_slug(model: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", model.lower()).strip("-")
+
+
+class EmbeddingCache:
+    def __init__(self, root: Path, model: str, max_mb: int):
+        self.path = root / model_slug(model)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_mb * 1024 * 1024
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = sqlite3.connect(self.path / "index.sqlite3")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                chunk_id TEXT PRIMARY KEY,
+                slot INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+            """
+        )
+
+        self._vectors_file = self.path / "vectors.f32"
+        self._dim = self._meta("dim")
+        self._next_slot = self._meta("next_slot") or 0
+        self._vectors: np.memmap | None = None
+
+        # Slots below the high-water mark that no entry points at (evicted, or
+        # written but never indexed because a run died mid-batch)
+        used = {slot for (slot,) in self._db.execute("SELECT slot FROM entries")}
+        self._free = sorted(set(range(self._next_slot)) - used, reverse=True)
+
+        if self._dim:
+            self._map(self._capacity_on_disk())
+
+    # -- storage -----------------------------------------------------------
+
+    def _meta(self, key: str) -> int | None:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: int) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def _capacity_on_disk(self) -> int:
+        if not self._vectors_file.exists():
+            return 0
+        return self._vectors_file.stat().st_size // (self._dim * _DTYPE().itemsize)
+
+    def _map(self, capacity: int) -> None:
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        if capacity == 0:
+            return
+        with open(self._vectors_file, "ab") as f:
+            f.truncate(capacity * self._dim * _DTYPE().itemsize)
+        self._vectors = np.memmap(
+            self._vectors_file, dtype=_DTYPE, mode="r+", shape=(capacity, self._dim)
+        )
+
+    @property
+    def max_entries(self) -> int:
+        if not self._dim:
+            return 0
+        return self.max_bytes // (self._dim * _DTYPE().itemsize)
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    # -- public API --------------------------------------------------------
+
+    def get_many(self, chunk_ids: list[str]) -> dict[str, list[float]]:
+        """Return cached vectors for the given chunk ids, recording hits/misses."""
+        found: dict[str, int] = {}
+        if self._vectors is not None and chunk_ids:
+            unique = list(dict.fromkeys(chunk_ids))
+            placeholders = ",".join("?" * len(unique))
+            found = dict(
+                self._db.execute(
+                    f"SELECT chunk_id, slot FROM entries WHERE chunk_id IN ({placeholders})",
+                    unique,
+                )
+            )
+
+        self.hits += sum(1 for c in chunk_ids if c in found)
+        self.misses += sum(1 for c in chunk_ids if c not in found)
+
+        if not found:
+            return {}
+
+        now = time.time()
+        self._db.executemany(
+            "UPDATE entries SET last_used = ? WHERE chunk_id = ?",
+            [(now, c) for c in found],
+        )
+        self._db.commit()
+
+        rows = self._vectors[list(found.values())]
+        return {c: row.tolist() for c, row in zip(found, rows)}
+
+    def put_many(self, vectors: dict[str, list[float]]) -> None:
+        """Store vectors, evicting least recently used entries if over the cap."""
+        if not vectors or self.max_bytes <= 0:
+            return
+
+        if not self._dim:
+            self._dim = len(next(iter(vectors.values())))
+            self._set_meta("dim", self._dim)
+
+        existing = {
+            c
+            for (c,) in self._db.execute(
+                f"SELECT chunk_id FROM entries WHERE chunk_id IN ({','.join('?' * len(vectors))})",
+                list(vectors),
+            )
+        }
+        new = {c: v for c, v in vectors.items() if c not in existing}
+        if not new:
+            return
+
+        # Never try to hold more than the cap in one go
+        if len(new) > self.max_entries:
+            new = dict(list(new.items())[: self.max_entries])
+
+        overflow = len(self) + len(new) - self.max_entries
+        if overflow > 0:
+            self._evict(overflow)
+
+        slots = [self._allocate_slot() for _ in new]
+        capacity = 0 if self._vectors is None else self._vectors.shape[0]
+        if self._next_slot > capacity:
+            grown = max(_MIN_CAPACITY, capacity * 2, self._next_slot)
+            self._map(min(grown, max(self.max_entries, self._next_slot)))
+
+        self._vectors[slots] = np.asarray(list(new.values()), dtype=_DTYPE)
+        self._vectors.flush()
+
+        now = time.time()
+        self._db.executemany(
+            "INSERT INTO entries (chunk_id, slot, last_used) VALUES (?, ?, ?)",
+            [(c, slot, now) for c, slot in zip(new, slots)],
+        )
+        self._set_meta("next_slot", self._next_slot)
+        self._db.commit()
+
+    def _allocate_slot(self) -> int:
+        if self._free:
+            return self._free.pop()
+        slot = self._next_slot
+        self._next_slot += 1
+        return slot
+
+    def _evict(self, count: int) -> None:
+        rows = self._db.execute(
+            "SELECT chunk_id, slot FROM entries ORDER BY last_used LIMIT ?", (count,)
+        ).fetchall()
+        self._db.executemany("DELETE FROM entries WHERE chunk_id = ?", [(c,) for c, _ in rows])
+        self._free.extend(slot for _, slot in rows)
+        self._free.sort(reverse=True)
+        self.evictions += len(rows)
+
+    def log_stats(self) -> None:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        size_mb = len(self) * (self._dim or 0) * _DTYPE().itemsize / (1024 * 1024)
+        logger.info(
+            f"embedding cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate), "
+            f"{self.evictions} evicted, {len(self)} entries ({size_mb:.0f}/{self.max_bytes // (1024 * 1024)} MB)"
+        )
+
+    def close(self) -> None:
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        self._db.close()
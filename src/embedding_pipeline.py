@@ -0,0 +1,296 @@
+"""Concurrent embedding pipeline used by create_embeddings.
+
+Keeps up to `embedding_concurrency` embedding requests in flight on a thread
+pool while the calling thread serves cache hits and writes finished batches to
+Chroma, so Ollama and Chroma work at the same time instead of taking turns.
+
+Batch size adapts to what Ollama is doing: it grows while requests come back
+well under `embedding_target_latency`, shrinks when they run over, and halves
+on errors. A failed batch is retried by bisection — one bad chunk in a batch
+of 32 costs ~10 extra requests instead of 32, and only that chunk is skipped.
+
+A near-duplicate (metadata `near_duplicate_of`, see near_duplicates.py) not
+in the cache itself is stored with the cached vector of the chunk it repeats.
+If that one isn't cached yet (still being embedded, or evicted), it is
+embedded like any other chunk.
+"""
+
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import NamedTuple
+
+from langchain_core.documents import Document
+
+from embedding_cache import EmbeddingCache
+from ingest_metrics import IngestMetrics
+from logs import logger
+
+
+class ChunkRef(NamedTuple):
+    """Position of a chunk in its book — stable across runs for unchanged books."""
+
+    source: str
+    index: int
+
+    def __str__(self) -> str:
+        return f"{self.source}#{self.index}"
+
+
+Embedder = Callable[[list[str]], list[list[float]]]
+Writer = Callable[[list[Document], list[list[float]]], None]
+Item = tuple[ChunkRef, Document]
+
+
+_DONE = object()
+
+
+def prefetch(iterable: Iterable, maxsize: int) -> Iterator:
+    """Run `iterable` on a background thread, buffering at most `maxsize` items.
+
+    The bounded queue is the backpressure: the producer blocks once the
+    consumer falls `maxsize` items behind. Producer exceptions are re-raised
+    in the consumer.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=max(1, maxsize))
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except BaseException as e:
+            buffer.put(e)
+        else:
+            buffer.put(_DONE)
+
+    threading.Thread(target=produce, name="ingest-prefetch", daemon=True).start()
+
+    while True:
+        item = buffer.get()
+        if item is _DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class AdaptiveBatchSize:
+    """Additive-increase / multiplicative-decrease batch sizing.
+
+    Thread-safe: embedding workers report outcomes concurrently.
+    """
+
+    def __init__(self, initial: int, maximum: int, target_latency: float):
+        self.maximum = max(1, maximum)
+        self.target_latency = target_latency
+        self._value = min(max(1, initial), self.maximum)
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def record_success(self, size: int, latency: float) -> None:
+        with self._lock:
+            # Only batches at (or near) the current size say anything useful
+            if size < self._value // 2:
+                return
+            if latency > self.target_latency:
+                self._value = max(1, int(self._value * 0.75))
+            elif latency < self.target_latency / 2:
+                self._value = min(self.maximum, self._value + max(1, self._value // 4))
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._value = max(1, self._value // 2)
+
+
+@dataclass
+class PipelineStats:
+    embedded: int = 0  # chunks sent to Ollama successfully
+    cached: int = 0  # chunks served from the embedding cache
+    borrowed: int = 0  # near-duplicates stored with the vector of the chunk they repeat
+    written: int = 0  # chunks stored in Chroma
+    requests: int = 0  # embedding requests, including bisection retries
+    skipped: list[ChunkRef] = field(default_factory=list)  # chunks not stored
+
+
+class EmbeddingPipeline:
+    def __init__(
+        self,
+        embed: Embedder,
+        write: Writer,
+        cache: EmbeddingCache | None,
+        batch_size: AdaptiveBatchSize,
+        concurrency: int,
+        on_written: Callable[[list[ChunkRef]], None] | None = None,
+        on_skipped: Callable[[ChunkRef, Document], None] | None = None,
+        metrics: IngestMetrics | None = None,
+    ):
+        self.embed = embed
+        self.write = write
+        self.cache = cache
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        self.on_written = on_written
+        self.on_skipped = on_skipped
+        self.metrics = metrics
+        self.stats = PipelineStats()
+        self._stats_lock = threading.Lock()
+
+    def run(self, items: Iterable[Item]) -> PipelineStats:
+        items = iter(items)
+        in_flight: dict[Future, tuple[list[Item], dict[str, list[float]]]] = {}
+        exhausted = False
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while True:
+                # Top up the window of outstanding embedding requests
+                while not exhausted and len(in_flight) < self.concurrency:
+                    batch = list(islice(items, self.batch_size.value))
+                    if not batch:
+                        exhausted = True
+                        break
+
+                    vectors = self._from_cache(batch)
+                    missing = {
+                        doc.metadata["chunk_id"]: doc.page_content
+                        for _, doc in batch
+                        if doc.metadata["chunk_id"] not in vectors
+                    }
+                    if not missing:
+                        self._store(batch, vectors)
+                        continue
+
+                    future = pool.submit(self._embed, list(missing.items()))
+                    in_flight[future] = (batch, vectors)
+
+                if not in_flight:
+                    break
+
+                # Write whatever finished while the remaining requests keep
+                # the embedding model busy
+                waited = time.perf_counter()
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                if self.metrics is not None:
+                    self.metrics.record_wait(time.perf_counter() - waited)
+                for future in done:
+                    batch, vectors = in_flight.pop(future)
+                    fresh = future.result()
+                    if self.metrics is not None:
+                        self.metrics.count(
+                            "embedded",
+                            (ref.source for ref, doc in batch if doc.metadata["chunk_id"] in fresh),
+                        )
+                    if self.cache is not None:
+                        self.cache.put_many(fresh)
+                    vectors.update(fresh)
+                    self._store(batch, vectors)
+
+        return self.stats
+
+    def _from_cache(self, batch: list[Item]) -> dict[str, list[float]]:
+        if self.cache is None:
+            return {}
+        vectors = self.cache.get_many([doc.metadata["chunk_id"] for _, doc in batch])
+        hits = [ref for ref, doc in batch if doc.metadata["chunk_id"] in vectors]
+        self.stats.cached += len(hits)
+
+        kept_ids = {
+            doc.metadata["chunk_id"]: doc.metadata["near_duplicate_of"]
+            for _, doc in batch
+            if "near_duplicate_of" in doc.metadata and doc.metadata["chunk_id"] not in vectors
+        }
+        kept = self.cache.get_many(list(set(kept_ids.values()))) if kept_ids else {}
+        borrowed = [ref for ref, doc in batch if kept_ids.get(doc.metadata["chunk_id"]) in kept]
+        for chunk_id, kept_id in kept_ids.items():
+            if kept_id in kept:
+                vectors[chunk_id] = kept[kept_id]
+        self.stats.borrowed += len(borrowed)
+
+        if self.metrics is not None:
+            self.metrics.count("cached", (ref.source for ref in hits))
+            self.metrics.count("borrowed", (ref.source for ref in borrowed))
+        return vectors
+
+    def _embed(self, items: list[tuple[str, str]]) -> dict[str, list[float]]:
+        """Embed (chunk_id, text) pairs, bisecting on failure. Runs on a worker."""
+        start = time.perf_counter()
+        with self._stats_lock:
+            self.stats.requests += 1
+        try:
+            vectors = self.embed([text for _, text in items])
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.record_embed(time.perf_counter() - start, len(items), 0, ok=False)
+            self.batch_size.record_failure()
+            if len(items) == 1:
+                logger.error(f"embedding failed for chunk {items[0][0]}: {e}")
+                return {}
+            logger.warning(f"embedding batch of {len(items)} failed: {e}, bisecting")
+            mid = len(items) // 2
+            return {**self._embed(items[:mid]), **self._embed(items[mid:])}
+
+        latency = time.perf_counter() - start
+        self.batch_size.record_success(len(items), latency)
+        if self.metrics is not None:
+            chars = sum(len(text) for _, text in items)
+            self.metrics.record_embed(latency, len(items), chars, ok=True)
+        with self._stats_lock:
+            self.stats.embedded += len(items)
+        return {chunk_id: vector for (chunk_id, _), vector in zip(items, vectors)}
+
+    def _store(self, batch: list[Item], vectors: dict[str, list[float]]) -> None:
+        """Write embedded chunks; chunks without a vector are recorded as skipped."""
+        ready = [(ref, doc) for ref, doc in batch if doc.metadata["chunk_id"] in vectors]
+        if len(ready) < len(batch):
+            ready_refs = {ref for ref, _ in ready}
+            for ref, doc in batch:
+                if ref not in ready_refs:
+                    self._skip(ref, doc)
+
+        self._write(ready, vectors)
+        borrowed = f", {self.stats.borrowed} near-duplicates" if self.stats.borrowed else ""
+        logger.info(
+            f"stored {self.stats.written} chunks "
+            f"({self.stats.embedded} embedded, {self.stats.cached} cached{borrowed}, "
+            f"batch size {self.batch_size.value})"
+        )
+
+    def _write(self, items: list[Item], vectors: dict[str, list[float]]) -> None:
+        """Write to Chroma, bisecting on failure so one bad chunk can't sink a batch."""
+        if not items:
+            return
+        docs = [doc for _, doc in items]
+        start = time.perf_counter()
+        try:
+            self.write(docs, [vectors[doc.metadata["chunk_id"]] for doc in docs])
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.record_write(time.perf_counter() - start, len(items), ok=False)
+            if len(items) == 1:
+                logger.error(f"chroma write failed for chunk {items[0][0]}: {e}")
+                self._skip(*items[0])
+                return
+            mid = len(items) // 2
+            self._write(items[:mid], vectors)
+            self._write(items[mid:], vectors)
+            return
+        self.stats.written += len(items)
+        if self.metrics is not None:
+            self.metrics.record_write(time.perf_counter() - start, len(items), ok=True)
+            self.metrics.count("written", (ref.source for ref, _ in items))
+        if self.on_written is not None:
+            self.on_written([ref for ref, _ in items])
+
+    def _skip(self, ref: ChunkRef, doc: Document) -> None:
+        logger.error(f"skipping chunk {ref}")
+        self.stats.skipped.append(ref)
+        if self.metrics is not None:
+            self.metrics.count("skipped", [ref.source])
+        if self.on_skipped is not None:
+            self.on_skipped(ref, doc)
@@ -9,8 +9,16 @@ Two-pass evaluation:
   and score each on correctness and groundedness. Saves scores to
   results/scores_<timestamp>.json referencing the original answers file.
 
+Pass 1 can pre-filter retrieval by book catalogue fields (see
+book_catalogue.py): --scope-to-book searches each book-specific question only
+in its own book (the file slug in its section heading; cross-book questions
+search everything), --book runs only the named books' questions, scoped to
+them, and --edition / --book-type filter every question.
+
 Usage:
     uv run python src/evaluate.py --pass1 tests/rag_queries.md
+    uv run python src/evaluate.py --pass1 tests/rag_queries.md --scope-to-book
+    uv run python src/evaluate.py --pass1 tests/rag_queries.md --book 10667---sprawl-survival-guide
     uv run python src/evaluate.py --pass2 /data/results/answers_20260425_193000.json
 """
 
@@ -21,15 +29,20 @@ import sys
 from datetime import datetime
 from pathlib import Path
 
-from langchain_chroma import Chroma
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.vectorstores import VectorStore
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 
+from book_catalogue import book_filter
 from config import settings
 from logs import logger, setup_logging
+from vector_store import open_vector_store, vector_store_path
+
 
+# Section slug of the questions that span several books
+CROSS_BOOK = "cross-book"
 
 # ---------------------------------------------------------------------------
 # Query parsing
@@ -96,19 +109,17 @@ def _extract_list(text: str) -> list[str]:
 # RAG helpers
 # ---------------------------------------------------------------------------
 
-def load_vector_store() -> Chroma:
-    if not settings.chroma_path.exists():
-        logger.error(f"vector store not found at {settings.chroma_path}")
+def load_vector_store() -> VectorStore:
+    path = vector_store_path()
+    if not path.exists():
+        logger.error(f"vector store not found at {path}")
         sys.exit(1)
 
     embeddings = OllamaEmbeddings(
         model=settings.embedding_model,
         base_url=settings.ollama_host,
     )
-    return Chroma(
-        persist_directory=str(settings.chroma_path),
-        embedding_function=embeddings,
-    )
+    return open_vector_store(embeddings)
 
 
 ANSWER_PROMPT = ChatPromptTemplate.from_template(
@@ -123,6 +134,14 @@ Answer:"""
 )
 
 
+def question_filter(q: dict, where: dict | None, scope_to_book: bool) -> dict | None:
+    """Pre-filter for one question: `where`, narrowed to the question's own book if scoped."""
+    if not scope_to_book or q["book"] == CROSS_BOOK:
+        return where
+    scoped = book_filter([q["book"]])
+    return scoped if where is None else {"$and": [scoped, where]}
+
+
 def run_query(question: str, retriever, llm) -> tuple[str, list[dict]]:
     """Run a single query. Returns (answer, retrieved_chunks)."""
     docs = retriever.invoke(question)
@@ -140,6 +159,7 @@ def run_query(question: str, retriever, llm) -> tuple[str, list[dict]]:
     chunks = [
         {
             "source": doc.metadata.get("source", "unknown"),
+            "sources": doc.metadata.get("sources") or [doc.metadata.get("source", "unknown")],
             "content": doc.page_content,
         }
         for doc in docs
@@ -152,18 +172,29 @@ def run_query(question: str, retriever, llm) -> tuple[str, list[dict]]:
 # Pass 1 — generate answers
 # ---------------------------------------------------------------------------
 
-def pass1(queries_path: Path) -> None:
+def pass1(
+    queries_path: Path,
+    books: list[str] | None = None,
+    where: dict | None = None,
+    scope_to_book: bool = False,
+) -> None:
     logger.info(f"pass 1 — generating answers from {queries_path}")
 
     queries = parse_queries(queries_path)
+    if books:
+        # Only those books' questions, each searched in its own book
+        queries = [q for q in queries if q["book"] in books]
+        scope_to_book = True
     if not queries:
         logger.error("no queries parsed from file")
         sys.exit(1)
 
     logger.info(f"loaded {len(queries)} queries")
+    if where or scope_to_book:
+        scope = " within each question's book" if scope_to_book else ""
+        logger.info(f"pre-filter: {json.dumps(where)}{scope}")
 
     vector_store = load_vector_store()
-    retriever = vector_store.as_retriever(search_kwargs={"k": settings.top_k})
 
     llm = ChatOllama(
         model=settings.llm_model,
@@ -175,8 +206,14 @@ def pass1(queries_path: Path) -> None:
 
     for i, q in enumerate(queries, 1):
         logger.info(f"  [{i}/{len(queries)}] {q['id']} — {q['question'][:60]}...")
+        search_filter = question_filter(q, where, scope_to_book)
+        retriever = vector_store.as_retriever(
+            search_kwargs={"k": settings.top_k, "filter": search_filter}
+        )
         answer, chunks = run_query(q["question"], retriever, llm)
-        results.append({**q, "answer": answer, "retrieved_chunks": chunks})
+        results.append(
+            {**q, "filter": search_filter, "answer": answer, "retrieved_chunks": chunks}
+        )
         logger.info(f"    answer: {answer[:80]}...")
 
     settings.evals_path.mkdir(parents=True, exist_ok=True)
@@ -191,6 +228,8 @@ def pass1(queries_path: Path) -> None:
             "top_k": settings.top_k,
             "chunk_size": settings.chunk_size,
             "chunk_overlap": settings.chunk_overlap,
+            "filter": where,
+            "scope_to_book": scope_to_book,
         },
         "results": results,
     }
@@ -270,7 +309,8 @@ def pass2(answers_path: Path) -> None:
 
         expected_text = "\n".join(f"- {f}" for f in entry.get("expected", []))
         chunks_text = "\n\n".join(
-            f"[{c['source']}]\n{c['content']}" for c in entry.get("retrieved_chunks", [])
+            f"[{', '.join(c.get('sources') or [c['source']])}]\n{c['content']}"
+            for c in entry.get("retrieved_chunks", [])
         )
 
         chain = JUDGE_PROMPT | judge_llm | StrOutputParser()
@@ -339,11 +379,24 @@ def main() -> None:
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--pass1", metavar="QUERIES_FILE", help="Generate answers from a queries markdown file")
     group.add_argument("--pass2", metavar="ANSWERS_FILE", help="Judge answers from a pass 1 output file")
+    parser.add_argument("--scope-to-book", action="store_true", help="Pass 1: search each book-specific question only in its book")
+    parser.add_argument("--book", action="append", help="Pass 1: only run this book's questions (file slug), scoped to it; repeat for several")
+    parser.add_argument("--edition", help="Pass 1: only search books of this edition")
+    parser.add_argument("--book-type", help="Pass 1: only search books of this type")
 
     args = parser.parse_args()
 
     if args.pass1:
-        pass1(Path(args.pass1))
+        try:
+            where = book_filter(edition=args.edition, book_type=args.book_type)
+        except ValueError as e:
+            parser.error(str(e))
+        pass1(
+            Path(args.pass1),
+            books=args.book,
+            where=where,
+            scope_to_book=args.scope_to_book,
+        )
     elif args.pass2:
         pass2(Path(args.pass2))
 
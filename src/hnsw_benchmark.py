@@ -0,0 +1,251 @@
+"""Sweep Chroma's HNSW parameters and measure each against exact search.
+
+The defaults (HNSW_* settings, Chroma's own values unless set) are one point
+on a build cost / search latency / recall curve. This builds scratch
+collections from the store's vectors over a grid of max_neighbors (M) and
+ef_construction, and searches each with every ef_search in the grid:
+
+- per build: build time and size on disk (whole store, and the HNSW files)
+- per ef_search: p50/p95 search latency and recall@k against exact search
+  in the same distance space, on the questions in tests/rag_queries.md
+
+The vectors come from the NumPy index (exported first if missing), so nothing
+is re-embedded; only the test questions are. The live store isn't touched.
+The report goes to reports/<timestamp>_hnsw_benchmark.json, with the fastest
+setting that reaches --target-recall picked out; put it in the HNSW_*
+settings (a changed space, M or ef_construction needs a full rebuild).
+
+A full-corpus build takes minutes, so --limit builds from the first N
+vectors to try out a grid first.
+
+Usage:
+    uv run python src/hnsw_benchmark.py
+    uv run python src/hnsw_benchmark.py --max-neighbors 16 32 --ef-search 50 100 200
+    uv run python src/hnsw_benchmark.py --space cosine --limit 50000 --k 7
+"""
+
+import argparse
+import itertools
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import chromadb
+import numpy as np
+
+from chunk_index import CHROMA_MAX_BATCH, COLLECTION_NAME
+from config import settings
+from logs import logger, setup_logging
+from numpy_index import (
+    BLOCK_ROWS,
+    dir_bytes,
+    embed_questions,
+    export_from_chroma,
+    latency_ms,
+    write_report,
+)
+
+
+def exact_neighbours(
+    vectors: np.ndarray, queries: np.ndarray, space: str, k: int
+) -> list[set[int]]:
+    """Row numbers of each query's k nearest vectors, by brute force."""
+    distances = np.empty((len(queries), len(vectors)), dtype=np.float32)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = np.asarray(vectors[start : start + BLOCK_ROWS], dtype=np.float32)
+        dots = queries @ block.T
+        if space == "l2":
+            # |q|² is the same for every row, so it doesn't change the order
+            block_distances = np.einsum("ij,ij->i", block, block) - 2 * dots
+        elif space == "cosine":
+            block_distances = -dots / np.maximum(np.linalg.norm(block, axis=1), 1e-12)
+        else:
+            block_distances = -dots
+        distances[:, start : start + len(block)] = block_distances
+
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return [set(row.tolist()) for row in top]
+
+
+def build_collection(path: Path, vectors: np.ndarray, hnsw: dict):
+    """Insert `vectors` into a new collection at `path`, ids being row numbers."""
+    client = chromadb.PersistentClient(path=str(path))
+    collection = client.create_collection(name=COLLECTION_NAME, configuration={"hnsw": hnsw})
+    for start in range(0, len(vectors), CHROMA_MAX_BATCH):
+        block = np.asarray(vectors[start : start + CHROMA_MAX_BATCH], dtype=np.float32)
+        collection.add(ids=[str(row) for row in range(start, start + len(block))], embeddings=block)
+    return collection
+
+
+def reopen(path: Path):
+    """The collection at `path`, with its index freshly loaded from disk.
+
+    A process keeps a collection's index loaded with the ef_search it had
+    when first searched, so a changed ef_search only applies after the
+    client's cache is dropped.
+    """
+    chromadb.PersistentClient(path=str(path)).clear_system_cache()
+    return chromadb.PersistentClient(path=str(path)).get_collection(COLLECTION_NAME)
+
+
+def search_sweep(
+    path: Path, queries: np.ndarray, exact: list[set[int]], ef_search: int, k: int
+) -> dict:
+    collection = chromadb.PersistentClient(path=str(path)).get_collection(COLLECTION_NAME)
+    collection.modify(configuration={"hnsw": {"ef_search": ef_search}})
+    collection = reopen(path)
+    # Untimed, so the first timed query doesn't pay for loading the index
+    collection.query(query_embeddings=queries[:1], n_results=k, include=[])
+
+    seconds, recalls = [], []
+    for query, expected in zip(queries, exact):
+        start = time.perf_counter()
+        ids = collection.query(query_embeddings=[query], n_results=k, include=[])["ids"][0]
+        seconds.append(time.perf_counter() - start)
+        recalls.append(len(expected & {int(i) for i in ids}) / len(expected))
+
+    return {
+        "ef_search": ef_search,
+        **latency_ms(seconds),
+        "recall_at_k": round(float(np.mean(recalls)), 4),
+    }
+
+
+def pick_operating_point(builds: list[dict], target_recall: float) -> dict | None:
+    """The lowest-p50 setting that reaches `target_recall`."""
+    candidates = [
+        {**build["hnsw"], **search}
+        for build in builds
+        for search in build["searches"]
+        if search["recall_at_k"] >= target_recall
+    ]
+    return min(candidates, key=lambda c: c["p50_ms"], default=None)
+
+
+def run_sweep(
+    queries_path: Path,
+    space: str,
+    max_neighbors: list[int],
+    ef_constructions: list[int],
+    ef_searches: list[int],
+    k: int,
+    limit: int | None = None,
+    target_recall: float = 0.99,
+) -> Path:
+    index_path = settings.numpy_index_path
+    if not (index_path / "vectors.npy").exists():
+        export_from_chroma()
+    vectors = np.load(index_path / "vectors.npy", mmap_mode="r")[:limit]
+    k = min(k, len(vectors))
+
+    _, queries = embed_questions(queries_path)
+    exact = exact_neighbours(vectors, queries, space, k)
+    logger.info(f"exact {space} neighbours of {len(queries)} queries in {len(vectors)} vectors")
+
+    builds = []
+    for m, ef_construction in itertools.product(max_neighbors, ef_constructions):
+        hnsw = {"space": space, "max_neighbors": m, "ef_construction": ef_construction}
+        with tempfile.TemporaryDirectory(dir=settings.data_path, prefix=".hnsw_sweep_") as tmp:
+            start = time.perf_counter()
+            collection = build_collection(Path(tmp), vectors, hnsw)
+            # The first search waits for the index to catch up with the inserts
+            collection.query(query_embeddings=queries[:1], n_results=k, include=[])
+            build_seconds = time.perf_counter() - start
+            # Segment directories hold the HNSW files; the rest is sqlite
+            index_bytes = sum(dir_bytes(d) for d in Path(tmp).iterdir() if d.is_dir())
+            build = {
+                "hnsw": hnsw,
+                "build_seconds": round(build_seconds, 2),
+                "disk_bytes": dir_bytes(Path(tmp)),
+                "index_bytes": index_bytes,
+                "searches": [
+                    search_sweep(Path(tmp), queries, exact, ef_search, k)
+                    for ef_search in ef_searches
+                ],
+            }
+            del collection
+            chromadb.PersistentClient(path=tmp).clear_system_cache()
+        builds.append(build)
+
+        recalls = ", ".join(
+            f"ef_search {s['ef_search']}: {s['recall_at_k']} @ {s['p50_ms']}ms"
+            for s in build["searches"]
+        )
+        logger.info(
+            f"M {m}, ef_construction {ef_construction}: built in {build_seconds:.1f}s, "
+            f"{index_bytes / 2**20:.1f} MiB index; {recalls}"
+        )
+
+    best = pick_operating_point(builds, target_recall)
+    if best is None:
+        logger.info(f"no setting reached recall@{k} {target_recall}")
+    else:
+        logger.info(
+            f"fastest setting with recall@{k} >= {target_recall}: M {best['max_neighbors']}, "
+            f"ef_construction {best['ef_construction']}, ef_search {best['ef_search']} "
+            f"({best['p50_ms']}ms p50, recall {best['recall_at_k']})"
+        )
+
+    report = {
+        "queries_file": str(queries_path),
+        "queries": len(queries),
+        "k": k,
+        "chunks": len(vectors),
+        "dimensions": int(vectors.shape[1]),
+        "current_settings": {
+            "space": settings.hnsw_space,
+            "max_neighbors": settings.hnsw_max_neighbors,
+            "ef_construction": settings.hnsw_ef_construction,
+            "ef_search": settings.hnsw_ef_search,
+        },
+        "target_recall": target_recall,
+        "operating_point": best,
+        "builds": builds,
+    }
+    return write_report(report, "hnsw_benchmark")
+
+
+def main() -> None:
+    setup_logging(settings.log_level)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "queries",
+        nargs="?",
+        default=Path("tests/rag_queries.md"),
+        type=Path,
+        help="Test questions (default: tests/rag_queries.md)",
+    )
+    parser.add_argument("--space", choices=("l2", "cosine", "ip"), default=settings.hnsw_space)
+    parser.add_argument("--max-neighbors", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[100, 200])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[10, 25, 50, 100, 200])
+    parser.add_argument("--k", type=int, default=settings.top_k, help="Results per query")
+    parser.add_argument("--limit", type=int, help="Build from the first N vectors only")
+    parser.add_argument(
+        "--target-recall",
+        type=float,
+        default=0.99,
+        help="Recall@k the suggested operating point must reach",
+    )
+    args = parser.parse_args()
+
+    if not settings.chroma_path.exists():
+        logger.error(f"vector store not found at {settings.chroma_path}")
+        sys.exit(1)
+
+    run_sweep(
+        args.queries,
+        space=args.space,
+        max_neighbors=args.max_neighbors,
+        ef_constructions=args.ef_construction,
+        ef_searches=args.ef_search,
+        k=args.k,
+        limit=args.limit,
+        target_recall=args.target_recall,
+    )
+
+
+if __name__ == "__main__":
+    main()
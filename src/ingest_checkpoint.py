@@ -0,0 +1,139 @@
+"""Checkpoint manifest for resumable ingest.
+
+Written atomically (temp file + rename) next to chroma.sqlite3 while
+create_embeddings runs. Records, per book, the content hash it was chunked
+from, how many chunks it produced, which chunk indexes have been committed to
+Chroma (as [start, end) ranges) and which were skipped after retries.
+
+`create_embeddings.py --resume` reads it to skip finished books; chunks of
+unfinished books that are already stored are recognised by chunk_id, and
+skipped chunks are not stored, so a resume retries them.
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from embedding_pipeline import ChunkRef
+
+CHECKPOINT_NAME = "ingest_checkpoint.json"
+
+# Rewriting the manifest after every batch is wasteful; a crash loses at
+# most this many seconds of bookkeeping (those chunks are re-sent on resume,
+# and the embedding cache makes that cheap)
+_SAVE_INTERVAL = 2.0
+
+
+def _add_to_ranges(ranges: list[list[int]], indexes: list[int]) -> list[list[int]]:
+    """Merge chunk indexes into a sorted list of [start, end) ranges."""
+    merged: list[list[int]] = []
+    for start, end in sorted(ranges + [[i, i + 1] for i in indexes]):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class IngestCheckpoint:
+    def __init__(self, path: Path, mode: str, config: dict):
+        self.path = path
+        self.mode = mode
+        self.config = config
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.completed = False
+        self.books: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._last_save = 0.0
+
+    @classmethod
+    def load(cls, path: Path) -> "IngestCheckpoint | None":
+        if not path.exists():
+            return None
+        raw = json.loads(path.read_text(encoding="utf-8"))
+        checkpoint = cls(path, raw["mode"], raw["config"])
+        checkpoint.started = raw["started"]
+        checkpoint.completed = raw["completed"]
+        checkpoint.books = raw["books"]
+        return checkpoint
+
+    # -- queries (used when resuming) --------------------------------------
+
+    def book_done(self, source: str, content_hash: str) -> bool:
+        book = self.books.get(source)
+        return (
+            book is not None
+            and book["content_hash"] == content_hash
+            and book["status"] == "done"
+        )
+
+    def skipped(self) -> dict[str, list[int]]:
+        return {
+            source: sorted(entry["index"] for entry in book["skipped"])
+            for source, book in self.books.items()
+            if book["skipped"]
+        }
+
+    # -- updates (called from the producer and writer threads) -------------
+
+    def start_book(self, source: str, content_hash: str, chunks: int) -> None:
+        with self._lock:
+            book = self.books.get(source)
+            if book is None or book["content_hash"] != content_hash:
+                book = {"content_hash": content_hash, "committed": [], "skipped": []}
+                self.books[source] = book
+            book["chunks"] = chunks
+            book["status"] = "in_progress"
+            # Skipped chunks are retried in this run; re-recorded if they fail again
+            book["skipped"] = []
+            self._mark_if_done(source)
+        self.save()
+
+    def record_written(self, refs: list[ChunkRef]) -> None:
+        with self._lock:
+            by_source: dict[str, list[int]] = {}
+            for ref in refs:
+                by_source.setdefault(ref.source, []).append(ref.index)
+            for source, indexes in by_source.items():
+                book = self.books[source]
+                book["committed"] = _add_to_ranges(book["committed"], indexes)
+                self._mark_if_done(source)
+        self.save()
+
+    def record_skipped(self, ref: ChunkRef, chunk_id: str) -> None:
+        with self._lock:
+            book = self.books[ref.source]
+            book["skipped"].append({"index": ref.index, "chunk_id": chunk_id})
+        self.save(force=True)
+
+    def _mark_if_done(self, source: str) -> None:
+        book = self.books[source]
+        committed = sum(end - start for start, end in book["committed"])
+        if committed >= book["chunks"]:
+            book["status"] = "done"
+
+    def finish(self) -> None:
+        with self._lock:
+            self.completed = True
+        self.save(force=True)
+
+    def save(self, force: bool = False) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < _SAVE_INTERVAL:
+                return
+            self._last_save = now
+            payload = {
+                "mode": self.mode,
+                "config": self.config,
+                "started": self.started,
+                "updated": datetime.now().isoformat(timespec="seconds"),
+                "completed": self.completed,
+                "books": self.books,
+            }
+            tmp = self.path.with_suffix(".json.tmp")
+            tmp.write_text(json.dumps(payload, indent=2), encoding="utf-8")
+            os.replace(tmp, self.path)
@@ -0,0 +1,201 @@
+"""Per-stage timings and counters for one create_embeddings run.
+
+Collected while the run streams through its stages (file read, chunking,
+embedding requests, Chroma writes) and written as a JSON report to
+reports/<timestamp>_ingest.json. The numbers answer two questions: how fast
+is ingest on this hardware, and when it slows down, is it Ollama or Chroma?
+
+`waiting_on_embeddings_seconds` is time the main thread sat idle waiting for
+Ollama; `chroma_writes.total_seconds` is time it spent writing. Whichever
+dominates the wall time is the bottleneck.
+"""
+
+import json
+import threading
+import time
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from logs import logger
+
+# Rough chars-per-token ratio for English prose; good enough for throughput
+# estimates, not for context-window maths
+CHARS_PER_TOKEN = 4
+
+
+class Latencies:
+    def __init__(self):
+        self.seconds: list[float] = []
+        self.items = 0
+        self.failed = 0
+
+    def record(self, seconds: float, items: int, ok: bool = True) -> None:
+        self.seconds.append(seconds)
+        if ok:
+            self.items += items
+        else:
+            self.failed += 1
+
+    def summary(self) -> dict:
+        if not self.seconds:
+            return {"count": 0, "failed": 0, "items": 0}
+        seconds = np.asarray(self.seconds)
+        return {
+            "count": len(seconds),
+            "failed": self.failed,
+            "items": self.items,
+            "total_seconds": round(float(seconds.sum()), 3),
+            "p50_seconds": round(float(np.percentile(seconds, 50)), 3),
+            "p95_seconds": round(float(np.percentile(seconds, 95)), 3),
+            "max_seconds": round(float(seconds.max()), 3),
+        }
+
+
+@dataclass
+class BookTotals:
+    chunks: int = 0
+    chars: int = 0
+    read_seconds: float = 0.0
+    chunk_seconds: float = 0.0
+    cached: int = 0
+    borrowed: int = 0  # near-duplicates given the vector of the chunk they repeat
+    embedded: int = 0
+    written: int = 0
+    skipped: int = 0
+
+
+class IngestMetrics:
+    """Thread-safe: embedding workers and the main thread record concurrently."""
+
+    def __init__(self, mode: str, config: dict):
+        self.mode = mode
+        self.config = config
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+        self.books: dict[str, BookTotals] = {}
+        self.embed = Latencies()
+        self.write = Latencies()
+        self.waiting_on_embeddings = 0.0
+        self.embedded_chars = 0
+        self.extra: dict = {}  # stage summaries added by the caller
+
+    def _book(self, source: str) -> BookTotals:
+        return self.books.setdefault(source, BookTotals())
+
+    # -- recording ---------------------------------------------------------
+
+    def record_book(
+        self, source: str, chunks: int, chars: int, read_seconds: float, chunk_seconds: float
+    ) -> None:
+        with self._lock:
+            book = self._book(source)
+            book.chunks += chunks
+            book.chars += chars
+            book.read_seconds += read_seconds
+            book.chunk_seconds += chunk_seconds
+
+    def record_embed(self, seconds: float, items: int, chars: int, ok: bool) -> None:
+        with self._lock:
+            self.embed.record(seconds, items, ok)
+            if ok:
+                self.embedded_chars += chars
+
+    def record_write(self, seconds: float, items: int, ok: bool) -> None:
+        with self._lock:
+            self.write.record(seconds, items, ok)
+
+    def record_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.waiting_on_embeddings += seconds
+
+    def count(self, field: str, sources: Iterable[str]) -> None:
+        """Add one to a per-book counter (cached/borrowed/embedded/written/skipped) per chunk."""
+        with self._lock:
+            for source in sources:
+                book = self._book(source)
+                setattr(book, field, getattr(book, field) + 1)
+
+    # -- reporting ---------------------------------------------------------
+
+    def report(self) -> dict:
+        wall = time.perf_counter() - self._start
+        with self._lock:
+            books = {source: asdict(book) for source, book in sorted(self.books.items())}
+            for book in books.values():
+                book["read_seconds"] = round(book["read_seconds"], 4)
+                book["chunk_seconds"] = round(book["chunk_seconds"], 4)
+            embed = self.embed.summary()
+            write = self.write.summary()
+            embedded_chars = self.embedded_chars
+            waiting = self.waiting_on_embeddings
+
+        def total(field: str):
+            return sum(book[field] for book in books.values())
+
+        embed_seconds = embed.get("total_seconds", 0.0)
+        embedded_tokens = embedded_chars // CHARS_PER_TOKEN
+        return {
+            "started": self.started.isoformat(timespec="seconds"),
+            "finished": datetime.now().isoformat(timespec="seconds"),
+            "mode": self.mode,
+            "config": self.config,
+            "wall_seconds": round(wall, 3),
+            "totals": {
+                "books": len(books),
+                "chunks": total("chunks"),
+                "cached": total("cached"),
+                "borrowed": total("borrowed"),
+                "embedded": total("embedded"),
+                "written": total("written"),
+                "skipped": total("skipped"),
+                "estimated_tokens_embedded": embedded_tokens,
+                "chunks_per_second": round(total("written") / wall, 2) if wall else 0.0,
+                # Per second of embedding request time, i.e. what Ollama sustains
+                # per in-flight request
+                "tokens_per_second": (
+                    round(embedded_tokens / embed_seconds, 1) if embed_seconds else 0.0
+                ),
+            },
+            "stages": {
+                "read_seconds": round(total("read_seconds"), 3),
+                "chunking_seconds": round(total("chunk_seconds"), 3),
+                "embedding_requests": embed,
+                "waiting_on_embeddings_seconds": round(waiting, 3),
+                "chroma_writes": write,
+                **self.extra,
+            },
+            "books": books,
+        }
+
+    def write_report(self, reports_path: Path) -> Path:
+        report = self.report()
+        reports_path.mkdir(parents=True, exist_ok=True)
+        timestamp = self.started.strftime("%Y%m%d_%H%M%S")
+        output_path = reports_path / f"{timestamp}_ingest.json"
+        output_path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+        totals, stages = report["totals"], report["stages"]
+        embed, write = stages["embedding_requests"], stages["chroma_writes"]
+        logger.info(
+            f"ingest took {report['wall_seconds']:.1f}s — "
+            f"{totals['chunks_per_second']} chunks/s, ~{totals['tokens_per_second']} tokens/s per request"
+        )
+        if embed["count"]:
+            logger.info(
+                f"  embedding: {embed['count']} requests, p50 {embed['p50_seconds']}s, "
+                f"p95 {embed['p95_seconds']}s, {embed['failed']} failed; "
+                f"waited {stages['waiting_on_embeddings_seconds']:.1f}s on Ollama"
+            )
+        if write["count"]:
+            logger.info(
+                f"  chroma: {write['count']} writes, p50 {write['p50_seconds']}s, "
+                f"p95 {write['p95_seconds']}s, {write['total_seconds']:.1f}s total"
+            )
+        logger.info(f"ingest report written to {output_path}")
+        return output_path
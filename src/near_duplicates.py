@@ -0,0 +1,235 @@
+"""Near-duplicate chunk suppression with MinHash/LSH.
+
+OCR output repeats itself with small differences: a gear table reprinted with
+one changed cell, page furniture that survived drop_repeated_text, a sidebar
+re-typeset with different hyphenation. Exact dedupe (chunk_index.py) misses
+these, so they are embedded again and crowd each other out of retrieval.
+
+Each chunk is reduced to a MinHash signature over character 5-gram shingles of
+its lowercased, whitespace-collapsed text. Signatures are split into LSH bands;
+a chunk is only compared against the cluster representatives that share a band
+bucket with it, so the stage is linear in the number of chunks. A chunk whose
+estimated Jaccard similarity to a representative reaches the threshold is
+collapsed into it: it keeps its own chunk_id and text, and is tagged with the
+representative's chunk_id in `near_duplicate_of`. The embedding pipeline then
+stores it with the representative's vector from the embedding cache instead
+of embedding it (embedding_pipeline.py), so a table reprinted with one
+changed cell costs no embedding call but its value is still there to be
+retrieved and read. It does come back next to the chunk it repeats, with the
+same distance.
+
+Chunks are only compared with chunks of the same type (prose, table,
+table_row), and the first occurrence in file order is always the one kept.
+
+The stage is off unless NEAR_DUPLICATE_THRESHOLD is set. With
+NEAR_DUPLICATE_DRY_RUN, clusters are found and written to
+reports/near_duplicates.json without tagging any chunk, to see what a
+threshold would collapse before turning it on.
+"""
+
+import re
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from embedding_pipeline import ChunkRef, Item
+from logs import logger
+
+NUM_PERM = 128  # signature length; estimate error is ~1/sqrt(NUM_PERM)
+SHINGLE_SIZE = 5  # characters per shingle
+
+# Representatives kept per LSH bucket. Bounds the comparisons per chunk when
+# a bucket is crowded (e.g. many short chunks of one table), keeping the
+# stage linear
+_BUCKET_REPS = 8
+
+_PRIME = np.uint64(4294967291)  # largest prime below 2**32
+_MASK = np.uint64(0xFFFFFFFF)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _lsh_params(threshold: float, num_perm: int) -> tuple[int, int]:
+    """Pick (bands, rows) so the LSH S-curve rises just below `threshold`.
+
+    Pairs above the threshold then almost always share a bucket; the extra
+    candidates this lets through are discarded by the signature comparison.
+    """
+    target = max(0.0, threshold - 0.05)
+    best = (num_perm, 1)
+    best_knee = 0.0
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        knee = (1 / bands) ** (1 / rows)
+        if best_knee < knee <= target:
+            best, best_knee = (bands, rows), knee
+    return best
+
+
+def _shingle_hashes(text: str) -> np.ndarray:
+    """32-bit hashes of the distinct character shingles of `text`."""
+    normalised = _WHITESPACE_RE.sub(" ", text.lower()).strip().encode("utf-8")
+    data = np.frombuffer(normalised, dtype=np.uint8).astype(np.uint64)
+    if len(data) < SHINGLE_SIZE:
+        data = np.pad(data, (0, SHINGLE_SIZE - len(data)))
+
+    # Polynomial hash of every window, vectorised over the whole chunk
+    windows = len(data) - SHINGLE_SIZE + 1
+    hashes = np.zeros(windows, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        hashes = (hashes * np.uint64(257) + data[offset : offset + windows]) & _MASK
+    return np.unique(hashes)
+
+
+@dataclass
+class _Representative:
+    ref: ChunkRef
+    chunk_id: str
+    heading: str
+    signature: np.ndarray
+
+
+@dataclass
+class Cluster:
+    """A kept chunk and the near-duplicates collapsed into it."""
+
+    kept: _Representative
+    duplicates: list[tuple[ChunkRef, str, float]] = field(default_factory=list)
+
+
+class NearDuplicateFilter:
+    def __init__(
+        self, threshold: float, num_perm: int = NUM_PERM, seed: int = 1, dry_run: bool = False
+    ):
+        self.threshold = threshold
+        self.dry_run = dry_run
+        self.num_perm = num_perm
+        self.bands, self.rows = _lsh_params(threshold, num_perm)
+
+        # Universal hash family h(x) = (a*x + b) mod p; a, b, x < 2**32 so
+        # the arithmetic stays inside uint64
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, int(_PRIME), size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.integers(0, int(_PRIME), size=(num_perm, 1), dtype=np.uint64)
+
+        self._buckets: dict[tuple, list[int]] = defaultdict(list)
+        self._reps: list[_Representative] = []
+        self._collapsed: dict[str, str] = {}  # collapsed chunk_id → kept chunk_id
+        self._kept_ids: set[str] = set()
+        self.clusters: dict[int, Cluster] = {}
+        self.chunks = 0
+
+    def signature(self, text: str) -> np.ndarray:
+        shingles = _shingle_hashes(text)
+        return ((self._a * shingles + self._b) % _PRIME).min(axis=1).astype(np.uint32)
+
+    def _tag(self, chunk, kept_id: str) -> None:
+        if not self.dry_run:
+            chunk.metadata["near_duplicate_of"] = kept_id
+
+    def filter(self, items: Iterable[Item]) -> Iterator[Item]:
+        """Pass chunks through, tagging near-duplicates with the chunk they repeat."""
+        for ref, chunk in items:
+            self.chunks += 1
+            chunk_id = chunk.metadata["chunk_id"]
+
+            # Exact repeats are the chunk index's job; keep them consistent
+            # with whatever their first occurrence was mapped to
+            if chunk_id in self._kept_ids:
+                yield ref, chunk
+                continue
+            if chunk_id in self._collapsed:
+                self._tag(chunk, self._collapsed[chunk_id])
+                yield ref, chunk
+                continue
+
+            signature = self.signature(chunk.page_content)
+            keys = [
+                (
+                    chunk.metadata["type"],
+                    band,
+                    signature[band * self.rows : (band + 1) * self.rows].tobytes(),
+                )
+                for band in range(self.bands)
+            ]
+
+            match, similarity = self._best_match(keys, signature)
+            if match is not None:
+                kept = self._reps[match]
+                cluster = self.clusters.setdefault(match, Cluster(kept))
+                cluster.duplicates.append((ref, chunk.metadata["heading"], similarity))
+                self._collapsed[chunk_id] = kept.chunk_id
+                self._tag(chunk, kept.chunk_id)
+                yield ref, chunk
+                continue
+
+            rep = len(self._reps)
+            self._reps.append(
+                _Representative(ref, chunk_id, chunk.metadata["heading"], signature)
+            )
+            self._kept_ids.add(chunk_id)
+            for key in keys:
+                bucket = self._buckets[key]
+                if len(bucket) < _BUCKET_REPS:
+                    bucket.append(rep)
+            yield ref, chunk
+
+    def _best_match(self, keys: list[tuple], signature: np.ndarray) -> tuple[int | None, float]:
+        best, best_similarity = None, 0.0
+        checked: set[int] = set()
+        for key in keys:
+            for rep in self._buckets.get(key, ()):
+                if rep in checked:
+                    continue
+                checked.add(rep)
+                similarity = float(np.mean(self._reps[rep].signature == signature))
+                if similarity >= self.threshold and similarity > best_similarity:
+                    best, best_similarity = rep, similarity
+        return best, best_similarity
+
+    @property
+    def collapsed(self) -> int:
+        return sum(len(cluster.duplicates) for cluster in self.clusters.values())
+
+    def report(self) -> dict:
+        """Clusters collapsed per book (the book of the collapsed chunk)."""
+        books: dict[str, dict] = {}
+        for cluster in self.clusters.values():
+            kept = cluster.kept
+            by_book: dict[str, list[dict]] = defaultdict(list)
+            for ref, heading, similarity in cluster.duplicates:
+                by_book[ref.source].append(
+                    {"index": ref.index, "heading": heading, "similarity": round(similarity, 3)}
+                )
+            for source, duplicates in by_book.items():
+                book = books.setdefault(source, {"collapsed": 0, "clusters": []})
+                book["collapsed"] += len(duplicates)
+                book["clusters"].append(
+                    {
+                        "kept": str(kept.ref),
+                        "kept_heading": kept.heading,
+                        "chunk_id": kept.chunk_id,
+                        "duplicates": duplicates,
+                    }
+                )
+
+        return {
+            "threshold": self.threshold,
+            "dry_run": self.dry_run,
+            "num_perm": self.num_perm,
+            "bands": self.bands,
+            "rows": self.rows,
+            "chunks": self.chunks,
+            "collapsed": self.collapsed,
+            "books": dict(sorted(books.items())),
+        }
+
+    def log_summary(self) -> None:
+        dry_run = ", dry run: nothing tagged" if self.dry_run else ""
+        logger.info(
+            f"near-duplicates: {self.collapsed} of {self.chunks} chunks collapsed into "
+            f"{len(self.clusters)} clusters (threshold {self.threshold}{dry_run})"
+        )
+        for source, book in self.report()["books"].items():
+            logger.info(f"  {source}: {book['collapsed']} collapsed, {len(book['clusters'])} clusters")
@@ -1,23 +1,97 @@
-"""Copy PDFs from pdfs_raw/ to pdfs_normalised/ with slugified filenames.
+"""Link PDFs from pdfs_raw/ into pdfs_normalised/ with slugified filenames.
 
 Normalises any filename to lowercase, hyphen-separated, filesystem-safe.
 
+Normalised files are hardlinks to the raw PDFs where possible (reflinks, then
+plain copies, where not — e.g. across filesystems), so gigabytes of scans are
+not duplicated. Every PDF is content-hashed (SHA-256, streamed) and the same
+book uploaded under two names is only normalised once.
+
+Hashes are kept in pdfs_normalised/.manifest.json keyed by raw filename,
+size and mtime, so unchanged files are not re-read on the next run.
+
 Usage:
     uv run python src/normalise_pdf_filenames.py
 """
 
+import fcntl
+import hashlib
+import json
+import os
 import re
 import shutil
+from pathlib import Path
 
 from config import settings
 from logs import logger, setup_logging
 
+MANIFEST_NAME = ".manifest.json"
+
+# ioctl request for a copy-on-write clone (btrfs, XFS) on Linux
+_FICLONE = 0x40049409
+
 
 def slugify(text: str) -> str:
     text = re.sub(r"[^\w\s-]", "", text.lower())
     return re.sub(r"[\s_]+", "-", text).strip("-")
 
 
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(path: Path) -> dict[str, dict]:
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def save_manifest(path: Path, manifest: dict[str, dict]) -> None:
+    tmp = path.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def content_hash(pdf: Path, manifest: dict[str, dict]) -> str:
+    """Hash of the PDF, reused from the manifest when size and mtime are unchanged."""
+    stat = pdf.stat()
+    entry = manifest.get(pdf.name)
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+    return file_sha256(pdf)
+
+
+def _reflink(src: Path, dest: Path) -> None:
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+    shutil.copystat(src, dest)
+
+
+def link_or_copy(src: Path, dest: Path) -> str:
+    """Place `src` at `dest` without copying data if the filesystem allows.
+
+    Returns how it was placed: "hardlink", "reflink" or "copy".
+    """
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError:
+        pass
+
+    try:
+        _reflink(src, dest)
+        return "reflink"
+    except OSError:
+        dest.unlink(missing_ok=True)
+
+    shutil.copy2(src, dest)
+    return "copy"
+
+
 def main() -> None:
     setup_logging(settings.log_level)
 
@@ -26,18 +100,61 @@ def main() -> None:
         return
 
     settings.pdfs_normalised_path.mkdir(parents=True, exist_ok=True)
+    manifest_path = settings.pdfs_normalised_path / MANIFEST_NAME
+    manifest = load_manifest(manifest_path)
+
+    updated: dict[str, dict] = {}
+    by_hash: dict[str, str] = {}  # content hash → normalised filename
+    placed: dict[str, int] = {}
 
     for pdf in sorted(settings.pdfs_raw_path.glob("*.pdf")):
         dest = settings.pdfs_normalised_path / f"{slugify(pdf.stem)}.pdf"
+        sha256 = content_hash(pdf, manifest)
+        stat = pdf.stat()
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
 
-        if dest.exists():
-            logger.warning(
-                f"skipping duplicate: {pdf.name} → {dest.name} already exists"
-            )
+        if sha256 in by_hash:
+            logger.warning(f"skipping duplicate: {pdf.name} has the same content as {by_hash[sha256]}")
+            updated[pdf.name] = {**entry, "duplicate_of": by_hash[sha256]}
             continue
 
-        logger.info(f"{pdf.name} → {dest.name}")
-        shutil.copy2(pdf, dest)
+        previous = manifest.get(pdf.name)
+        if dest.exists():
+            owned = previous is not None and previous.get("dest") == dest.name
+            if owned and previous["sha256"] == sha256:
+                # Already normalised and unchanged
+                adopt = True
+            elif owned:
+                # This raw file was re-uploaded with new content
+                logger.info(f"{pdf.name} changed, replacing {dest.name}")
+                dest.unlink()
+                adopt = False
+            else:
+                # Not ours per the manifest: either a slug collision, or a copy
+                # made before the manifest existed
+                adopt = dest.name not in by_hash.values() and file_sha256(dest) == sha256
+                if not adopt:
+                    logger.warning(
+                        f"skipping duplicate: {pdf.name} → {dest.name} already exists"
+                    )
+                    updated[pdf.name] = entry
+                    continue
+
+            if adopt:
+                by_hash[sha256] = dest.name
+                updated[pdf.name] = {**entry, "dest": dest.name}
+                continue
+
+        method = link_or_copy(pdf, dest)
+        logger.info(f"{pdf.name} → {dest.name} ({method})")
+        placed[method] = placed.get(method, 0) + 1
+        by_hash[sha256] = dest.name
+        updated[pdf.name] = {**entry, "dest": dest.name}
+
+    save_manifest(manifest_path, updated)
+    if placed:
+        summary = ", ".join(f"{count} {method}" for method, count in sorted(placed.items()))
+        logger.info(f"normalised {sum(placed.values())} PDFs ({summary})")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,756 @@
+"""Exact vector search over a memory-mapped NumPy copy of the Chroma store.
+
+Chroma answers queries from an HNSW graph, which trades a little recall for
+speed. At this corpus size (a few hundred thousand 1024-dim vectors) exact
+search is one matrix multiply, fast enough to skip the graph entirely.
+VECTOR_BACKEND=numpy makes the query side (query.py, query_server.py,
+evaluate.py, shadowtalk.py) read this index instead of Chroma.
+
+The index is exported from the Chroma store, embeddings included, so nothing
+is re-embedded. It is a directory (numpy_index/ under data_path):
+
+- vectors.npy: one row per chunk, memory-mapped. float32 by default;
+  NUMPY_INDEX_DTYPE=float16 halves the file (and page cache) but every
+  search converts it back in blocks, which costs more than the multiply
+- columns.npz: metadata, one array per field. Scalar fields (source, heading,
+  type) are dictionary-encoded as int32 codes; list fields (sources,
+  headings) are codes plus offsets; chunk_id is fixed-width bytes
+- texts.bin: every chunk's text, UTF-8, back to back; its offsets are in
+  columns.npz and only the texts of returned chunks are decoded
+- norms.npy: squared vector norms, for l2 and cosine distances
+- index.json: row count, dimensions, dtype, quantisation, distance space and
+  embedding model
+
+With a quantisation (NUMPY_INDEX_QUANTISATION, or create_embeddings.py
+--quantisation), searches scan int8 or product-quantised codes instead of
+vectors.npy, and NUMPY_INDEX_RESCORE re-ranks the best candidates with their
+float vectors; see vector_quantisation.py.
+
+Searches use the collection's distance space, so distances match Chroma's. The
+query side's Chroma filters work here too: `filter` on any scalar field
+($eq, $ne, $in, $nin, $gt, $gte, $lt, $lte, $and, $or), $contains /
+$not_contains on list fields (`sources`), and `where_document` with
+$contains / $not_contains.
+
+create_embeddings.py re-exports after every ingest when VECTOR_BACKEND=numpy.
+--benchmark compares latency and recall@k with Chroma on tests/rag_queries.md;
+--benchmark-quantisation compares each quantisation (with and without
+rescoring) against the float index: bytes scanned per search, cold start
+(opening plus the first search, from an evicted page cache), latency and
+recall@k.
+
+Usage:
+    uv run python src/numpy_index.py --export
+    uv run python src/numpy_index.py --export --quantisation int8
+    uv run python src/numpy_index.py --benchmark
+    uv run python src/numpy_index.py --benchmark tests/rag_queries.md --k 7
+    uv run python src/numpy_index.py --benchmark-quantisation
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from collections.abc import Iterable
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import chromadb
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from chunk_index import CHROMA_MAX_BATCH, COLLECTION_NAME
+from config import settings
+from logs import logger, setup_logging
+from vector_quantisation import QUANTISATIONS
+from vector_quantisation import build as build_codes
+from vector_quantisation import load as load_codes
+from vector_store import HNSW_BUILD_PARAMS, apply_hnsw_settings
+
+# Rows multiplied per block: bounds the float32 copy of a float16 block
+BLOCK_ROWS = 16384
+
+# Candidates fetched per requested result when where_document has to be
+# checked against chunk text; more are fetched if too few pass
+DOCUMENT_FILTER_OVERSAMPLE = 8
+
+LIST_FIELDS = ("sources", "headings")
+
+
+def collection_space(collection) -> str:
+    """Distance space of a Chroma collection: "l2" (Chroma's default), "cosine" or "ip"."""
+    hnsw = (collection.configuration or {}).get("hnsw") or {}
+    return hnsw.get("space") or (collection.metadata or {}).get("hnsw:space") or "l2"
+
+
+# -- columns -----------------------------------------------------------------
+
+
+def _encode(values: list) -> tuple[np.ndarray, np.ndarray]:
+    """Dictionary-encode a column; missing values get code -1."""
+    categories = sorted({value for value in values if value is not None}, key=str)
+    lookup = {value: code for code, value in enumerate(categories)}
+    codes = np.array([lookup.get(value, -1) for value in values], dtype=np.int32)
+    if not all(isinstance(value, (int, float)) for value in categories):
+        categories = [str(value) for value in categories]
+    return codes, np.array(categories)
+
+
+def build_columns(metadatas: list[dict]) -> dict[str, np.ndarray]:
+    columns: dict[str, np.ndarray] = {
+        "chunk_id": np.array([m.get("chunk_id", "") for m in metadatas], dtype=np.bytes_)
+    }
+    fields = sorted({key for m in metadatas for key in m} - {"chunk_id"})
+    for field_name in fields:
+        if field_name in LIST_FIELDS:
+            lists = [m.get(field_name) or [] for m in metadatas]
+            codes, categories = _encode([value for values in lists for value in values])
+            columns[f"{field_name}.codes"] = codes
+            columns[f"{field_name}.offsets"] = np.cumsum([0] + [len(v) for v in lists])
+        else:
+            codes, categories = _encode([m.get(field_name) for m in metadatas])
+            columns[f"{field_name}.codes"] = codes
+        columns[f"{field_name}.values"] = categories
+    return columns
+
+
+# -- export ------------------------------------------------------------------
+
+
+def _replace_dir(tmp: Path, dest: Path) -> None:
+    old = dest.with_name(f".{dest.name}.old")
+    if dest.exists():
+        dest.rename(old)
+    tmp.rename(dest)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _norms_squared(vectors: np.ndarray) -> np.ndarray:
+    norms = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = np.asarray(vectors[start : start + BLOCK_ROWS], dtype=np.float32)
+        norms[start : start + len(block)] = np.einsum("ij,ij->i", block, block)
+    return norms
+
+
+def add_quantisation(path: Path, quantisation: str) -> None:
+    """Encode an exported index's vectors with `quantisation` (a no-op for "none")."""
+    if quantisation == "none":
+        return
+    start = time.perf_counter()
+    vectors = np.load(path / "vectors.npy", mmap_mode="r")
+    build_codes(quantisation, vectors, path, settings.numpy_index_pq_subvectors)
+    logger.info(f"  {quantisation} codes built in {time.perf_counter() - start:.1f}s")
+
+
+def export_from_chroma(
+    chroma_path: Path | None = None,
+    dest: Path | None = None,
+    dtype: str | None = None,
+    quantisation: str | None = None,
+) -> Path:
+    """Copy vectors, metadata and texts out of the Chroma store. Nothing is re-embedded."""
+    chroma_path = chroma_path or settings.chroma_path
+    dest = dest or settings.numpy_index_path
+    dtype = dtype or settings.numpy_index_dtype
+    quantisation = quantisation or settings.numpy_index_quantisation
+
+    client = chromadb.PersistentClient(path=str(chroma_path))
+    collection = client.get_collection(COLLECTION_NAME)
+    count = collection.count()
+    if count == 0:
+        raise ValueError(f"the vector store at {chroma_path} is empty")
+
+    start = time.perf_counter()
+    tmp = dest.with_name(f".{dest.name}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    vectors = None
+    metadatas: list[dict] = []
+    text_offsets = [0]
+    with open(tmp / "texts.bin", "wb") as texts:
+        for offset in range(0, count, CHROMA_MAX_BATCH):
+            batch = collection.get(
+                limit=CHROMA_MAX_BATCH,
+                offset=offset,
+                include=["embeddings", "metadatas", "documents"],
+            )
+            embeddings = np.asarray(batch["embeddings"], dtype=np.float32)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(
+                    tmp / "vectors.npy",
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(count, embeddings.shape[1]),
+                )
+            vectors[offset : offset + len(embeddings)] = embeddings
+            for metadata, text in zip(batch["metadatas"], batch["documents"]):
+                metadatas.append(metadata or {})
+                encoded = (text or "").encode("utf-8")
+                texts.write(encoded)
+                text_offsets.append(text_offsets[-1] + len(encoded))
+            logger.info(f"  exported {offset + len(embeddings)} of {count} chunks")
+
+    vectors.flush()
+    np.save(tmp / "norms.npy", _norms_squared(vectors))
+    add_quantisation(tmp, quantisation)
+    columns = build_columns(metadatas)
+    columns["text.offsets"] = np.array(text_offsets, dtype=np.int64)
+    np.savez(tmp / "columns.npz", **columns)
+    (tmp / "index.json").write_text(
+        json.dumps(
+            {
+                "count": count,
+                "dimensions": vectors.shape[1],
+                "dtype": dtype,
+                "quantisation": quantisation,
+                "space": collection_space(collection),
+                "embedding_model": settings.embedding_model,
+                "exported": datetime.now().isoformat(timespec="seconds"),
+            },
+            indent=2,
+        ),
+        encoding="utf-8",
+    )
+    del vectors
+    _replace_dir(tmp, dest)
+
+    logger.info(f"exported {count} chunks to {dest} in {time.perf_counter() - start:.1f}s")
+    return dest
+
+
+# -- search ------------------------------------------------------------------
+
+
+class NumpyVectorStore(VectorStore):
+    """Read-only vector store searching an exported index.
+
+    Search is exact over the float vectors, or over quantised codes (the
+    quantisation the index was exported with, unless overridden) with the
+    best `rescore` × k candidates re-ranked by their float vectors.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        embedding_function: Embeddings,
+        quantisation: str | None = None,
+        rescore: int | None = None,
+    ):
+        self.path = path
+        self._embedding_function = embedding_function
+        self.info = json.loads((path / "index.json").read_text(encoding="utf-8"))
+        if self.info["embedding_model"] != settings.embedding_model:
+            raise ValueError(
+                f"{path} holds {self.info['embedding_model']} embeddings, "
+                f"but EMBEDDING_MODEL is {settings.embedding_model}"
+            )
+        self.space = self.info["space"]
+        self.quantisation = quantisation or self.info.get("quantisation", "none")
+        self.rescore = settings.numpy_index_rescore if rescore is None else rescore
+
+        self.vectors = np.load(path / "vectors.npy", mmap_mode="r")
+        self.codes = load_codes(self.quantisation, path)
+        with np.load(path / "columns.npz") as columns:
+            self.columns = dict(columns)
+        texts_path = path / "texts.bin"
+        # np.memmap refuses empty files (a store of empty chunks)
+        self._texts = (
+            np.memmap(texts_path, dtype=np.uint8, mode="r")
+            if texts_path.stat().st_size
+            else np.zeros(0, dtype=np.uint8)
+        )
+        norms_path = path / "norms.npy"
+        # Indexes exported before norms were stored compute them on load
+        self._norms_squared = (
+            np.load(norms_path) if norms_path.exists() else _norms_squared(self.vectors)
+        )
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the array every search scans."""
+        return self.codes.nbytes if self.codes is not None else self.vectors.nbytes
+
+    def _dots(self, queries: np.ndarray) -> np.ndarray:
+        if self.codes is not None:
+            return self.codes.dots(queries)
+        dots = np.empty((len(queries), len(self.vectors)), dtype=np.float32)
+        for start in range(0, len(self.vectors), BLOCK_ROWS):
+            block = np.asarray(self.vectors[start : start + BLOCK_ROWS], dtype=np.float32)
+            dots[:, start : start + len(block)] = queries @ block.T
+        return dots
+
+    def _to_distances(
+        self, dots: np.ndarray, norms_squared: np.ndarray, queries: np.ndarray
+    ) -> np.ndarray:
+        if self.space == "l2":
+            # Squared euclidean, as hnswlib reports it
+            query_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+            return np.maximum(norms_squared - 2 * dots + query_norms, 0)
+        if self.space == "cosine":
+            norms = np.sqrt(norms_squared) * np.linalg.norm(queries, axis=1)[:, None]
+            return 1 - dots / np.maximum(norms, 1e-12)
+        return 1 - dots
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        """(queries × rows) distances in the collection's space, like Chroma reports them.
+
+        Approximate when searching quantised codes.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        return self._to_distances(self._dots(queries), self._norms_squared, queries)
+
+    def exact_distances(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Distances from one query to `rows`, from their float vectors."""
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        query = query[None]
+        dots = query @ vectors.T
+        return self._to_distances(dots, self._norms_squared[rows], query)[0]
+
+    # -- filters --
+
+    def _column(self, name: str) -> tuple[np.ndarray, np.ndarray] | None:
+        if f"{name}.codes" not in self.columns or f"{name}.offsets" in self.columns:
+            return None
+        return self.columns[f"{name}.codes"], self.columns[f"{name}.values"]
+
+    def _list_mask(self, name: str, op: str, operand: Any) -> np.ndarray:
+        """Rows whose list field (e.g. `sources`) does or doesn't contain `operand`."""
+        if op not in ("$contains", "$not_contains"):
+            raise ValueError(f"unsupported operator {op} for list field {name}")
+        codes = self.columns[f"{name}.codes"]
+        values = self.columns[f"{name}.values"]
+        offsets = self.columns[f"{name}.offsets"]
+        matching_codes = np.flatnonzero(values == operand) if len(values) else []
+        # Row of each list element, to map matching elements back to chunks
+        rows = np.repeat(np.arange(len(self)), np.diff(offsets))
+        mask = np.zeros(len(self), dtype=bool)
+        mask[rows[np.isin(codes, matching_codes)]] = True
+        return mask if op == "$contains" else ~mask
+
+    def _field_mask(self, name: str, condition: Any) -> np.ndarray:
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        ((op, operand),) = condition.items()
+
+        if name == "chunk_id":
+            ids = self.columns["chunk_id"]
+            wanted = np.array(operand if isinstance(operand, list) else [operand], dtype=np.bytes_)
+            match = np.isin(ids, wanted)
+            if op in ("$eq", "$in"):
+                return match
+            if op in ("$ne", "$nin"):
+                return ~match
+            raise ValueError(f"unsupported operator {op} for chunk_id")
+
+        if f"{name}.offsets" in self.columns:
+            return self._list_mask(name, op, operand)
+
+        column = self._column(name)
+        if column is None:
+            # Chroma only matches records that have the field
+            return np.zeros(len(self), dtype=bool)
+        codes, values = column
+        compare = {
+            "$eq": lambda v: v == operand,
+            "$ne": lambda v: v != operand,
+            "$in": lambda v: np.isin(v, operand),
+            "$nin": lambda v: ~np.isin(v, operand),
+            "$gt": lambda v: v > operand,
+            "$gte": lambda v: v >= operand,
+            "$lt": lambda v: v < operand,
+            "$lte": lambda v: v <= operand,
+        }
+        if op not in compare:
+            raise ValueError(f"unsupported filter operator {op}")
+        matching_codes = np.flatnonzero(compare[op](values)) if len(values) else []
+        return np.isin(codes, matching_codes)
+
+    def filter_mask(self, where: dict | None) -> np.ndarray | None:
+        """Rows matching a Chroma `where` filter, or None for no filter."""
+        if not where:
+            return None
+        masks = []
+        for key, condition in where.items():
+            if key in ("$and", "$or"):
+                parts = [self.filter_mask(part) for part in condition]
+                combine = np.logical_and if key == "$and" else np.logical_or
+                masks.append(combine.reduce(parts))
+            else:
+                masks.append(self._field_mask(key, condition))
+        return np.logical_and.reduce(masks)
+
+    def _document_matches(self, text: str, where_document: dict) -> bool:
+        ((op, operand),) = where_document.items()
+        if op == "$contains":
+            return operand in text
+        if op == "$not_contains":
+            return operand not in text
+        if op in ("$and", "$or"):
+            matches = (self._document_matches(text, part) for part in operand)
+            return all(matches) if op == "$and" else any(matches)
+        raise ValueError(f"unsupported where_document operator {op}")
+
+    # -- results --
+
+    def text(self, row: int) -> str:
+        offsets = self.columns["text.offsets"]
+        return self._texts[offsets[row] : offsets[row + 1]].tobytes().decode("utf-8")
+
+    def metadata(self, row: int) -> dict:
+        metadata: dict = {"chunk_id": self.columns["chunk_id"][row].decode()}
+        for key in self.columns:
+            name, _, part = key.partition(".")
+            if part != "codes" or name == "text":
+                continue
+            values = self.columns[f"{name}.values"]
+            codes = self.columns[key]
+            if f"{name}.offsets" in self.columns:
+                offsets = self.columns[f"{name}.offsets"]
+                metadata[name] = [values[c].item() for c in codes[offsets[row] : offsets[row + 1]]]
+            elif codes[row] >= 0:
+                metadata[name] = values[codes[row]].item()
+        return metadata
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 4,
+        filter: dict | None = None,
+        where_document: dict | None = None,
+    ) -> list[list[tuple[int, float]]]:
+        """Top-k (row, distance) per query, nearest first; all queries in one multiply."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        distances = self.distances(queries)
+        mask = self.filter_mask(filter)
+        if mask is not None:
+            distances[:, ~mask] = np.inf
+        rescore = self.rescore if self.codes is not None else 0
+
+        results = []
+        for query, row_distances in zip(queries, distances):
+            wanted = k * DOCUMENT_FILTER_OVERSAMPLE if where_document else k
+            while True:
+                wanted = min(wanted, len(row_distances))
+                count = min(wanted * max(rescore, 1), len(row_distances))
+                rows = np.argpartition(row_distances, count - 1)[:count] if count else []
+                rows = np.array([row for row in rows if np.isfinite(row_distances[row])], dtype=int)
+                row_scores = row_distances[rows]
+                if rescore and len(rows):
+                    row_scores = self.exact_distances(query, rows)
+                order = np.argsort(row_scores, kind="stable")
+                hits = [
+                    (int(rows[i]), float(row_scores[i]))
+                    for i in order
+                    if where_document is None
+                    or self._document_matches(self.text(rows[i]), where_document)
+                ]
+                if where_document is None or len(hits) >= k or wanted == len(row_distances):
+                    break
+                wanted *= 4
+            results.append(hits[:k])
+        return results
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        (hits,) = self.search(
+            np.asarray([embedding]), k, kwargs.get("filter"), kwargs.get("where_document")
+        )
+        return [
+            (Document(page_content=self.text(row), metadata=self.metadata(row)), distance)
+            for row, distance in hits
+        ]
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        hits = self.similarity_search_by_vector_with_score(embedding, k, **kwargs)
+        return [doc for doc, _ in hits]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        if self.space == "cosine":
+            return self._cosine_relevance_score_fn
+        if self.space == "ip":
+            return self._max_inner_product_relevance_score_fn
+        return self._euclidean_relevance_score_fn
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: Iterable[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        raise NotImplementedError("the NumPy index is exported from Chroma, see export_from_chroma")
+
+
+# -- benchmark ---------------------------------------------------------------
+
+
+def latency_ms(seconds: list[float]) -> dict:
+    ms = np.array(seconds) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+    }
+
+
+def dir_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def embed_questions(queries_path: Path) -> tuple[Embeddings, np.ndarray]:
+    from langchain_ollama import OllamaEmbeddings
+
+    from evaluate import parse_queries
+
+    questions = [q["question"] for q in parse_queries(queries_path)]
+    if not questions:
+        raise ValueError(f"no queries parsed from {queries_path}")
+
+    embeddings = OllamaEmbeddings(model=settings.embedding_model, base_url=settings.ollama_host)
+    query_vectors = np.array([embeddings.embed_query(q) for q in questions], dtype=np.float32)
+    logger.info(f"embedded {len(questions)} queries")
+    return embeddings, query_vectors
+
+
+def write_report(report: dict, name: str) -> Path:
+    settings.reports_path.mkdir(parents=True, exist_ok=True)
+    output_path = settings.reports_path / f"{datetime.now():%Y%m%d_%H%M%S}_{name}.json"
+    output_path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    logger.info(f"benchmark written to {output_path}")
+    return output_path
+
+
+def benchmark(queries_path: Path, k: int) -> Path:
+    """Latency and recall@k of Chroma's HNSW search against exact NumPy search."""
+    embeddings, query_vectors = embed_questions(queries_path)
+
+    start = time.perf_counter()
+    store = NumpyVectorStore(settings.numpy_index_path, embeddings, quantisation="none")
+    load_seconds = time.perf_counter() - start
+    ids = store.columns["chunk_id"]
+
+    collection = chromadb.PersistentClient(path=str(settings.chroma_path)).get_collection(
+        COLLECTION_NAME
+    )
+    apply_hnsw_settings(collection)
+    # One untimed query each, so neither side is measured loading its index
+    collection.query(query_embeddings=query_vectors[:1], n_results=k)
+    store.search(query_vectors[:1], k)
+
+    chroma_seconds, numpy_seconds, recalls = [], [], []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        chroma_ids = collection.query(query_embeddings=[vector], n_results=k, include=[])["ids"][0]
+        chroma_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        (hits,) = store.search(vector[None], k)
+        numpy_seconds.append(time.perf_counter() - start)
+
+        exact = {ids[row].decode() for row, _ in hits}
+        recalls.append(len(exact & set(chroma_ids)) / len(exact))
+
+    start = time.perf_counter()
+    store.search(query_vectors, k)
+    batch_seconds = time.perf_counter() - start
+
+    report = {
+        "queries_file": str(queries_path),
+        "queries": len(query_vectors),
+        "k": k,
+        "chunks": len(store),
+        "dimensions": store.info["dimensions"],
+        "space": store.space,
+        "numpy_dtype": store.info["dtype"],
+        "chroma_hnsw": {
+            param: collection.configuration["hnsw"].get(param)
+            for param in (*HNSW_BUILD_PARAMS, "ef_search")
+        },
+        "chroma": {
+            **latency_ms(chroma_seconds),
+            "recall_at_k": round(float(np.mean(recalls)), 4),
+            "disk_bytes": dir_bytes(settings.chroma_path),
+        },
+        "numpy": {
+            **latency_ms(numpy_seconds),
+            "batched_ms_per_query": round(batch_seconds * 1000 / len(query_vectors), 3),
+            "load_seconds": round(load_seconds, 3),
+            "disk_bytes": dir_bytes(settings.numpy_index_path),
+        },
+    }
+    chroma, exact = report["chroma"], report["numpy"]
+    logger.info(
+        f"chroma p50 {chroma['p50_ms']}ms p95 {chroma['p95_ms']}ms, "
+        f"recall@{k} {chroma['recall_at_k']}; numpy p50 {exact['p50_ms']}ms "
+        f"p95 {exact['p95_ms']}ms, batched {exact['batched_ms_per_query']}ms/query"
+    )
+    return write_report(report, "vector_index_benchmark")
+
+
+def evict_page_cache(path: Path) -> bool:
+    """Drop the files under `path` from the page cache, so the next read comes from disk.
+
+    Needs posix_fadvise (Linux); returns False where it isn't available. Pages
+    still mapped by a live memmap are not dropped.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for file in path.rglob("*"):
+        if file.is_file():
+            fd = os.open(file, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+
+def benchmark_quantisation(queries_path: Path, k: int) -> Path:
+    """Bytes scanned, cold start, latency and recall@k of each quantisation against float search.
+
+    Opening the index only memory-maps it, so cold start is timed as opening
+    plus the first search, which is what reads the codes (and any rescored
+    vectors) from disk. The index is dropped from the page cache before each
+    variant where the OS allows it; otherwise the cold start figures are warm.
+
+    Codes missing from the index are built first (and kept).
+    """
+    path = settings.numpy_index_path
+    embeddings, query_vectors = embed_questions(queries_path)
+    for quantisation in QUANTISATIONS:
+        if quantisation != "none" and not (path / f"{quantisation}.codes.npy").exists():
+            add_quantisation(path, quantisation)
+
+    variants = [("none", 0)]
+    for quantisation in QUANTISATIONS[1:]:
+        variants += [(quantisation, 0), (quantisation, settings.numpy_index_rescore)]
+
+    exact_ids: list[set[int]] = []
+    results = {}
+    store = None
+    for quantisation, rescore in variants:
+        # Unmap the previous variant's files, or they can't leave the page cache
+        store = None
+        evicted = evict_page_cache(path)
+
+        start = time.perf_counter()
+        store = NumpyVectorStore(path, embeddings, quantisation=quantisation, rescore=rescore)
+        open_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        store.search(query_vectors[:1], k)
+        first_search_seconds = time.perf_counter() - start
+
+        seconds, recalls = [], []
+        for i, vector in enumerate(query_vectors):
+            start = time.perf_counter()
+            (hits,) = store.search(vector[None], k)
+            seconds.append(time.perf_counter() - start)
+            rows = {row for row, _ in hits}
+            if quantisation == "none":
+                exact_ids.append(rows)
+            recalls.append(len(rows & exact_ids[i]) / max(len(exact_ids[i]), 1))
+
+        name = quantisation if not rescore else f"{quantisation}+rescore{rescore}"
+        results[name] = {
+            "bytes_scanned_per_search": store.nbytes,
+            "open_seconds": round(open_seconds, 4),
+            "first_search_seconds": round(first_search_seconds, 4),
+            "cold_start_seconds": round(open_seconds + first_search_seconds, 4),
+            **latency_ms(seconds),
+            "recall_at_k": round(float(np.mean(recalls)), 4),
+        }
+        logger.info(
+            f"{name}: {store.nbytes / 2**20:.1f} MiB scanned per search, "
+            f"cold start {results[name]['cold_start_seconds']:.3f}s, "
+            f"p50 {results[name]['p50_ms']}ms, recall@{k} {results[name]['recall_at_k']}"
+        )
+
+    report = {
+        "queries_file": str(queries_path),
+        "queries": len(query_vectors),
+        "k": k,
+        "chunks": len(store),
+        "dimensions": store.info["dimensions"],
+        "pq_subvectors": settings.numpy_index_pq_subvectors,
+        "page_cache_evicted": evicted,
+        "variants": results,
+    }
+    return write_report(report, "quantisation_benchmark")
+
+
+def main() -> None:
+    setup_logging(settings.log_level)
+
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "--export",
+        action="store_true",
+        help="Export vectors, metadata and texts from the Chroma store",
+    )
+    mode.add_argument(
+        "--benchmark",
+        nargs="?",
+        const=Path("tests/rag_queries.md"),
+        type=Path,
+        metavar="QUERIES",
+        help="Compare search latency and recall@k with Chroma (default: tests/rag_queries.md)",
+    )
+    mode.add_argument(
+        "--benchmark-quantisation",
+        nargs="?",
+        const=Path("tests/rag_queries.md"),
+        type=Path,
+        metavar="QUERIES",
+        help="Compare quantised search with float search (default: tests/rag_queries.md)",
+    )
+    parser.add_argument(
+        "--quantisation",
+        choices=QUANTISATIONS,
+        default=settings.numpy_index_quantisation,
+        help="Codes to search the exported index through",
+    )
+    parser.add_argument("--k", type=int, default=settings.top_k, help="Results per query")
+    args = parser.parse_args()
+
+    if not settings.chroma_path.exists():
+        logger.error(f"vector store not found at {settings.chroma_path}")
+        sys.exit(1)
+
+    if args.export:
+        export_from_chroma(quantisation=args.quantisation)
+    elif args.benchmark:
+        benchmark(args.benchmark, args.k)
+    else:
+        benchmark_quantisation(args.benchmark_quantisation, args.k)
+
+
+if __name__ == "__main__":
+    main()
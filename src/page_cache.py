@@ -0,0 +1,71 @@
+"""Per-page cache of marker-pdf output.
+
+Rendered markdown is stored per page, keyed by (PDF content hash, converter
+config hash, page number), in conversion_cache/pages.sqlite3. Pages are
+written as soon as each batch of pages finishes, so a crashed or OOM-killed
+conversion keeps everything converted before it, and a re-run only converts
+the pages that are missing.
+
+The config hash covers every marker option that affects output (LLM mode and
+model included) plus the marker-pdf version, so changing the converter config
+invalidates exactly the pages converted under the old one. Those old pages
+stay in the database until prune() drops every config that is no longer
+current (convert_pdfs_to_markdown.py --prune-cache).
+"""
+
+import sqlite3
+import time
+from pathlib import Path
+
+
+class PageCache:
+    def __init__(self, root: Path):
+        root.mkdir(parents=True, exist_ok=True)
+        self.path = root / "pages.sqlite3"
+        self._db = sqlite3.connect(self.path)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                pdf_hash TEXT NOT NULL,
+                config_hash TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                markdown TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (pdf_hash, config_hash, page)
+            );
+            """
+        )
+
+    def get_many(self, pdf_hash: str, config_hash: str, pages: list[int]) -> dict[int, str]:
+        """Cached markdown for whichever of `pages` have been converted."""
+        rows = self._db.execute(
+            "SELECT page, markdown FROM pages WHERE pdf_hash = ? AND config_hash = ?",
+            (pdf_hash, config_hash),
+        )
+        wanted = set(pages)
+        return {page: markdown for page, markdown in rows if page in wanted}
+
+    def put_many(self, pdf_hash: str, config_hash: str, pages: dict[int, str]) -> None:
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO pages (pdf_hash, config_hash, page, markdown, created) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(pdf_hash, config_hash, page, markdown, now) for page, markdown in pages.items()],
+        )
+        self._db.commit()
+
+    def prune(self, config_hashes: set[str]) -> int:
+        """Delete pages cached under any config hash not in `config_hashes`; returns how many."""
+        placeholders = ", ".join("?" * len(config_hashes))
+        deleted = self._db.execute(
+            f"DELETE FROM pages WHERE config_hash NOT IN ({placeholders})",
+            tuple(config_hashes),
+        ).rowcount
+        self._db.commit()
+        if deleted:
+            # Give the freed pages back to the filesystem
+            self._db.execute("VACUUM")
+        return deleted
+
+    def close(self) -> None:
+        self._db.close()
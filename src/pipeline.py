@@ -0,0 +1,370 @@
+"""Run the whole pipeline, rebuilding only what is out of date.
+
+normalise → convert → clean → strip → embed
+
+Like make/ninja, every book's artifact at every stage is recorded in
+pipeline_manifest.json (under data_path) with three hashes:
+
+- input: the file the stage read (PDF, extracted/clean/stripped markdown)
+- config: the stage's code and settings — e.g. the source of clean_markdown.py,
+  so editing a regex there re-cleans every book but never re-converts one
+- output: the file the stage wrote
+
+A stage re-runs for a book only when one of those no longer matches. Inputs
+are compared by content, so a change that leaves a stage's output
+byte-identical stops there: a clean rule that only affects two books re-strips
+and re-embeds only those two.
+
+An output that changed outside the pipeline (e.g. a page re-converted with
+`convert_pdfs_to_markdown.py --use-llm --pages`) is kept and recorded, and
+the stages after it rebuild. Existing conversions found without a manifest
+entry are adopted rather than re-converted.
+
+Clean and strip run for independent books in parallel processes (or, with
+INLINE_MARKDOWN_STAGES, in memory inside the embed stage). Conversion
+goes through convert_pdfs_to_markdown (GPU, or page shards with
+CONVERT_WORKERS). Embedding is corpus-wide: when any book's stripped output
+changed, an incremental ingest re-embeds just the new chunks; a changed
+chunking or embedding config triggers a full rebuild. A book's embed input
+includes its row in the book catalogue, so editing docs/sourcebooks.csv
+re-runs an incremental ingest that only rewrites those books' metadata.
+
+Usage:
+    uv run python src/pipeline.py
+    uv run python src/pipeline.py --dry-run
+    uv run python src/pipeline.py --book 7204---germany-sourcebook
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from config import settings
+from logs import logger, setup_logging
+from stage_stamps import config_hash, file_hash, source_hashes, write_stamp
+
+MANIFEST_NAME = "pipeline_manifest.json"
+
+# -- stage configs -----------------------------------------------------------
+
+
+def convert_config() -> str:
+    from convert_pdfs_to_markdown import config_hash
+
+    return config_hash(use_llm=False)
+
+
+def embed_config() -> str:
+    from create_embeddings import _checkpoint_config
+
+    return config_hash(
+        source_hashes("chunk_documents", "near_duplicates", "book_catalogue"), _checkpoint_config()
+    )
+
+
+def embed_input(md: Path) -> str | None:
+    """A book's markdown plus its catalogue row, which its chunks are stored with."""
+    from book_catalogue import book_metadata
+
+    markdown = file_hash(md)
+    return markdown and config_hash(markdown, book_metadata(md.name))
+
+
+# -- manifest ----------------------------------------------------------------
+
+
+class BuildManifest:
+    """{book: {stage: {"input": hash, "config": hash, "output": hash}}}"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.books: dict[str, dict[str, dict]] = {}
+        if path.exists():
+            self.books = json.loads(path.read_text(encoding="utf-8"))
+
+    def entry(self, book: str, stage: str) -> dict | None:
+        return self.books.get(book, {}).get(stage)
+
+    def record(self, book: str, stage: str, entry: dict) -> None:
+        self.books.setdefault(book, {})[stage] = entry
+        self.save()
+
+    def save(self) -> None:
+        tmp = self.path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(self.books, indent=2, sort_keys=True), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+def check(
+    entry: dict | None,
+    input_hash: str | None,
+    config: str,
+    output: Path | None,
+    adopt_existing: bool = False,
+) -> tuple[str | None, dict | None]:
+    """Decide whether a stage must run for one book.
+
+    Returns (reason to rebuild or None, entry to record without rebuilding or
+    None).
+    """
+    output_hash = file_hash(output) if output is not None else None
+    if output is not None and output_hash is None:
+        return "no output", None
+
+    current = {"input": input_hash, "config": config, "output": output_hash}
+    if entry is None:
+        if adopt_existing:
+            return None, current
+        return "not in manifest", None
+    if entry["input"] != input_hash:
+        return "input changed", None
+    if entry["config"] != config:
+        return "config changed", None
+    if entry["output"] != output_hash:
+        # Rebuilt by hand; keep it and let downstream stages pick it up
+        logger.info(f"  {output.name} changed outside the pipeline, keeping it")
+        return None, current
+    return None, None
+
+
+# -- per-book text stages (run in worker processes) -------------------------
+
+
+def build_text_stages(
+    book: str, entries: dict[str, dict | None], configs: dict[str, str], dry_run: bool
+) -> dict[str, dict]:
+    """Run clean then strip for one book as needed; returns entries to record."""
+    from clean_markdown import clean_file
+    from strip_toc import strip_file
+
+    stages = (
+        ("clean", clean_file, settings.markdown_extracted_path, settings.markdown_path),
+        ("strip", strip_file, settings.markdown_path, settings.markdown_stripped_path),
+    )
+    recorded: dict[str, dict] = {}
+    for stage, build, input_dir, output_dir in stages:
+        source, dest = input_dir / f"{book}.md", output_dir / f"{book}.md"
+        input_hash = file_hash(source)
+        if input_hash is None:
+            # Not converted yet (or conversion failed)
+            return recorded
+
+        reason, entry = check(entries.get(stage), input_hash, configs[stage], dest)
+        if reason is None:
+            if entry is not None:
+                recorded[stage] = entry
+            continue
+
+        logger.info(f"  {stage} {book}: {reason}")
+        if dry_run:
+            # Later stages depend on output that doesn't exist yet
+            return recorded
+        output_dir.mkdir(parents=True, exist_ok=True)
+        build(source, dest)
+        # Lets clean_markdown.py/strip_toc.py run on their own skip this book
+        write_stamp(dest, input_hash, configs[stage])
+        recorded[stage] = {"input": input_hash, "config": configs[stage], "output": file_hash(dest)}
+    return recorded
+
+
+# -- pipeline ----------------------------------------------------------------
+
+
+def find_books(book: str | None = None) -> list[str]:
+    stems = {pdf.stem for pdf in settings.pdfs_normalised_path.glob("*.pdf")}
+    # Books converted before they had a normalised PDF still get cleaned
+    stems |= {md.stem for md in settings.markdown_extracted_path.glob("*.md")}
+    if book:
+        stems = {stem for stem in stems if book in stem}
+    return sorted(stems)
+
+
+def run_convert(manifest: BuildManifest, books: list[str], dry_run: bool) -> None:
+    pdfs = [settings.pdfs_normalised_path / f"{book}.pdf" for book in books]
+    pdfs = [pdf for pdf in pdfs if pdf.exists()]
+    if not pdfs:
+        return
+
+    # Importing the converter pulls in torch, so only once there is a PDF
+    config = convert_config()
+    stale: list[Path] = []
+    for pdf in pdfs:
+        book = pdf.stem
+        reason, entry = check(
+            manifest.entry(book, "convert"),
+            file_hash(pdf),
+            config,
+            settings.markdown_extracted_path / f"{book}.md",
+            adopt_existing=True,
+        )
+        if entry is not None and not dry_run:
+            manifest.record(book, "convert", entry)
+        if reason is not None:
+            logger.info(f"  convert {book}: {reason}")
+            stale.append(pdf)
+
+    if not stale or dry_run:
+        return
+
+    from convert_pdfs_to_markdown import convert_pdfs
+
+    for pdf in convert_pdfs(stale, force=True, workers=settings.convert_workers):
+        output = settings.markdown_extracted_path / f"{pdf.stem}.md"
+        manifest.record(
+            pdf.stem,
+            "convert",
+            {"input": file_hash(pdf), "config": config, "output": file_hash(output)},
+        )
+
+
+def run_text_stages(
+    manifest: BuildManifest, books: list[str], dry_run: bool, workers: int
+) -> None:
+    import clean_markdown
+    import strip_toc
+
+    configs = {"clean": clean_markdown.stage_config(), "strip": strip_toc.stage_config()}
+    jobs = [
+        (book, {stage: manifest.entry(book, stage) for stage in configs}, configs, dry_run)
+        for book in books
+    ]
+
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(jobs)),
+            initializer=setup_logging,
+            initargs=(settings.log_level,),
+        ) as pool:
+            results = list(pool.map(build_text_stages, *zip(*jobs)))
+    else:
+        results = [build_text_stages(*job) for job in jobs]
+
+    if dry_run:
+        return
+    for (book, *_), recorded in zip(jobs, results):
+        for stage, entry in recorded.items():
+            manifest.record(book, stage, entry)
+
+
+def run_embed(manifest: BuildManifest, dry_run: bool, chunk_workers: int) -> None:
+    from create_embeddings import markdown_source_path, run_ingest
+
+    config = embed_config()
+    # Stripped markdown, or extracted markdown with INLINE_MARKDOWN_STAGES
+    books = {md.stem: md for md in markdown_source_path().glob("*.md")}
+
+    stale: list[str] = []
+    if settings.vector_backend == "sharded" and not settings.chroma_shards_path.exists():
+        # Ingest writes the shards directly; an existing single store is split
+        # instead of re-embedded
+        if (settings.chroma_path / "chroma.sqlite3").exists():
+            logger.info("  embed: book shards missing, splitting chroma_db")
+            if not dry_run:
+                from sharded_store import sync_shards
+
+                sync_shards()
+        else:
+            logger.info("  embed: book shards missing")
+            stale = sorted(books)
+    for book, md in sorted(books.items()):
+        if book in stale:
+            continue
+        reason, _ = check(manifest.entry(book, "embed"), embed_input(md), config, None)
+        if reason is not None:
+            logger.info(f"  embed {book}: {reason}")
+            stale.append(book)
+    removed = [
+        book
+        for book, stages in manifest.books.items()
+        if "embed" in stages and book not in books
+    ]
+    for book in removed:
+        logger.info(f"  embed {book}: removed from corpus")
+
+    if not stale and not removed:
+        if settings.vector_backend == "numpy" and not settings.numpy_index_path.exists():
+            logger.info("  embed: NumPy index missing")
+            if not dry_run:
+                from numpy_index import export_from_chroma
+
+                export_from_chroma()
+        return
+    if dry_run:
+        return
+
+    # Chunk ids are only comparable under the same chunking/embedding config
+    store_exists = (settings.ingest_store_path / "chroma.sqlite3").exists()
+    incremental = store_exists and all(
+        stages["embed"]["config"] == config
+        for stages in manifest.books.values()
+        if "embed" in stages
+    )
+    run_ingest(incremental=incremental, chunk_workers=chunk_workers)
+
+    for book in removed:
+        del manifest.books[book]["embed"]
+    for book, md in books.items():
+        manifest.books.setdefault(book, {})["embed"] = {
+            "input": embed_input(md),
+            "config": config,
+            "output": None,
+        }
+    manifest.save()
+
+
+def run_pipeline(book: str | None = None, dry_run: bool = False, workers: int = 1) -> None:
+    manifest = BuildManifest(settings.data_path / MANIFEST_NAME)
+    label = " (dry run)" if dry_run else ""
+
+    if not dry_run:
+        from normalise_pdf_filenames import main as normalise
+
+        logger.info("stage: normalise")
+        normalise()
+
+    books = find_books(book)
+    logger.info(f"{len(books)} books in the pipeline{label}")
+
+    logger.info("stage: convert")
+    run_convert(manifest, books, dry_run)
+
+    if settings.inline_markdown_stages:
+        logger.info("stage: clean + strip (inline, at embed)")
+    else:
+        logger.info("stage: clean + strip")
+        run_text_stages(manifest, books, dry_run, workers)
+
+    logger.info("stage: embed")
+    run_embed(manifest, dry_run, chunk_workers=workers)
+
+    logger.info(f"pipeline complete{label}")
+
+
+def main() -> None:
+    setup_logging(settings.log_level)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--book",
+        help="Only rebuild this book (filename stem); embedding still covers the corpus",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Show what is out of date without rebuilding anything",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.chunk_workers or os.cpu_count() or 1,
+        help="Processes for per-book clean/strip and for chunking",
+    )
+    args = parser.parse_args()
+
+    run_pipeline(book=args.book, dry_run=args.dry_run, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,115 +1,275 @@
-"""Query the Shadowrun Lore RAG system."""
-
+"""Query the Shadowrun Lore RAG system.
+
+Each question is embedded and searched exactly once. The chunks that search
+returns are the ones the answer is generated from, and the ones reported as
+its sources. RagQuery splits a question into those two steps so callers can
+show sources before the answer finishes streaming:
+
+    result = rag.retrieve(question)     # embed + vector search
+    for token in rag.stream(result):    # generation, fills result.answer
+        ...
+
+Both steps have async twins (aretrieve/astream) for query_server.py. The
+QueryResult they fill in records the answer, the retrieved chunks and a
+latency breakdown:
+
+- embed: embedding the question
+- search: the vector search
+- time_to_first_token: from sending the prompt to the first answer token
+  (prompt processing, plus model load if Ollama had unloaded it)
+- generation: from the first answer token to the last
+
+--book, --edition and --book-type pre-filter the search to chunks from those
+books (see book_catalogue.py), so only that subset is searched and other
+books' chunks can't outrank the right one.
+
+Usage:
+    uv run python src/query.py "What is essence in Shadowrun?"
+    uv run python src/query.py "How does magic work?" --sources
+    uv run python src/query.py "How does magic work?" --json
+    uv run python src/query.py "What is Tir Tairngire's population?" --book 7210---tir-tairngire
+    uv run python src/query.py "How do foci work?" --edition 2
+"""
+
+import argparse
+import asyncio
+import json
 import sys
+import time
+from collections.abc import AsyncIterator, Iterator
+from dataclasses import asdict, dataclass, field
 
-from langchain_chroma import Chroma
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.vectorstores import VectorStore
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 
+from book_catalogue import book_filter
 from config import settings
-from logs import logger
+from logs import logger, setup_logging
+from vector_store import open_vector_store, vector_store_path
+
+ANSWER_PROMPT = ChatPromptTemplate.from_template(
+    """You are an expert on the Shadowrun RPG system. Use the following pieces of context from the Shadowrun rulebooks to answer the question. If you don't know the answer based on the context, say so - don't make up information.
+
+Context:
+{context}
+
+Question: {question}
+
+Answer:"""
+)
 
 
 def load_vector_store():
-    """Load the existing ChromaDB vector store."""
-    if not settings.chroma_path.exists():
-        logger.error(f"error: vector store not found at {settings.chroma_path}")
+    """Load the existing vector store (Chroma, or the NumPy index)."""
+    path = vector_store_path()
+    if not path.exists():
+        logger.error(f"error: vector store not found at {path}")
         sys.exit(1)
 
-    logger.info(f"loading vector store from {settings.chroma_path}")
+    logger.info(f"loading vector store from {path}")
     embeddings = OllamaEmbeddings(
         model=settings.embedding_model,
         base_url=settings.ollama_host,
+        keep_alive=settings.ollama_keep_alive,
     )
 
-    vector_store = Chroma(
-        persist_directory=str(settings.chroma_path),
-        embedding_function=embeddings,
-    )
-
-    return vector_store
-
+    return open_vector_store(embeddings)
 
-def format_docs(docs):
-    """Format retrieved documents into a single string."""
-    return "\n\n".join(doc.page_content for doc in docs)
 
-
-def create_rag_chain(vector_store):
-    """Create a RAG chain with the vector store using LCEL."""
-    llm = ChatOllama(
+def create_llm() -> ChatOllama:
+    return ChatOllama(
         model=settings.llm_model,
         base_url=settings.ollama_host,
         temperature=0,
+        keep_alive=settings.ollama_keep_alive,
     )
 
-    retriever = vector_store.as_retriever(search_kwargs={"k": settings.top_k})
-
-    prompt = ChatPromptTemplate.from_template(
-        """You are an expert on the Shadowrun RPG system. Use the following pieces of context from the Shadowrun rulebooks to answer the question. If you don't know the answer based on the context, say so - don't make up information.
 
-Context:
-{context}
-
-Question: {question}
-
-Answer:"""
-    )
-
-    rag_chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
-        | prompt
-        | llm
-        | StrOutputParser()
-    )
-
-    return rag_chain, retriever
-
-
-def query(question: str, show_sources: bool = False):
+@dataclass
+class RetrievedChunk:
+    chunk_id: str
+    source: str
+    heading: str
+    type: str
+    # Chunks shared by several books list all of them
+    sources: list[str]
+    content: str
+
+    @classmethod
+    def from_document(cls, doc: Document) -> "RetrievedChunk":
+        metadata = doc.metadata
+        source = metadata.get("source", "Unknown")
+        return cls(
+            chunk_id=metadata.get("chunk_id", ""),
+            source=source,
+            heading=metadata.get("heading", ""),
+            type=metadata.get("type", ""),
+            sources=list(metadata.get("sources") or [source]),
+            content=doc.page_content,
+        )
+
+
+@dataclass
+class QueryResult:
+    question: str
+    chunks: list[RetrievedChunk] = field(default_factory=list)
+    answer: str = ""
+    timings: dict[str, float] = field(default_factory=dict)  # seconds, per step
+    filter: dict | None = None  # Chroma `where` pre-filter the search ran with
+
+    def context(self) -> str:
+        """The retrieved chunks as the prompt sees them."""
+        return "\n\n".join(chunk.content for chunk in self.chunks)
+
+    def to_dict(self) -> dict:
+        result = asdict(self)
+        result["timings"] = {step: round(seconds, 4) for step, seconds in self.timings.items()}
+        return result
+
+
+class RagQuery:
+    """Retrieve once, then generate from exactly what was retrieved."""
+
+    def __init__(self, vector_store: VectorStore, llm: ChatOllama | None = None):
+        self.vector_store = vector_store
+        self.llm = llm or create_llm()
+
+    def _search(self, result: QueryResult, embedding: list[float]) -> None:
+        start = time.perf_counter()
+        docs = self.vector_store.similarity_search_by_vector(
+            embedding, k=settings.top_k, filter=result.filter
+        )
+        result.timings["search"] = time.perf_counter() - start
+        result.chunks = [RetrievedChunk.from_document(doc) for doc in docs]
+
+    def _messages(self, result: QueryResult):
+        return ANSWER_PROMPT.format_messages(context=result.context(), question=result.question)
+
+    def _token(self, result: QueryResult, token: str, start: float) -> None:
+        if "time_to_first_token" not in result.timings:
+            result.timings["time_to_first_token"] = time.perf_counter() - start
+        result.answer += token
+
+    def _finish(self, result: QueryResult, start: float) -> None:
+        first_token = result.timings.setdefault("time_to_first_token", time.perf_counter() - start)
+        result.timings["generation"] = time.perf_counter() - start - first_token
+
+    def retrieve(self, question: str, filter: dict | None = None) -> QueryResult:
+        result = QueryResult(question=question, filter=filter)
+        start = time.perf_counter()
+        embedding = self.vector_store.embeddings.embed_query(question)
+        result.timings["embed"] = time.perf_counter() - start
+        self._search(result, embedding)
+        return result
+
+    def stream(self, result: QueryResult) -> Iterator[str]:
+        """Stream the answer to `result.question`, filling in `result.answer`."""
+        start = time.perf_counter()
+        for message in self.llm.stream(self._messages(result)):
+            if message.content:
+                self._token(result, message.content, start)
+                yield message.content
+        self._finish(result, start)
+
+    async def aretrieve(self, question: str, filter: dict | None = None) -> QueryResult:
+        result = QueryResult(question=question, filter=filter)
+        start = time.perf_counter()
+        embedding = await self.vector_store.embeddings.aembed_query(question)
+        result.timings["embed"] = time.perf_counter() - start
+        # Neither backend has an async search for a local store
+        await asyncio.to_thread(self._search, result, embedding)
+        return result
+
+    async def astream(self, result: QueryResult) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        async for message in self.llm.astream(self._messages(result)):
+            if message.content:
+                self._token(result, message.content, start)
+                yield message.content
+        self._finish(result, start)
+
+    def ask(self, question: str, filter: dict | None = None) -> QueryResult:
+        """Retrieve and generate without streaming."""
+        result = self.retrieve(question, filter)
+        for _ in self.stream(result):
+            pass
+        return result
+
+
+def log_timings(result: QueryResult) -> None:
+    steps = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in result.timings.items())
+    logger.info(f"timings: {steps}")
+
+
+def query(
+    question: str,
+    show_sources: bool = False,
+    as_json: bool = False,
+    filter: dict | None = None,
+):
     """Query the RAG system."""
     logger.info(f"using model: {settings.llm_model}")
     logger.info(f"retrieving top {settings.top_k} relevant chunks\n")
+    if filter:
+        logger.info(f"pre-filter: {json.dumps(filter)}")
 
-    vector_store = load_vector_store()
-    rag_chain, retriever = create_rag_chain(vector_store)
+    rag = RagQuery(load_vector_store())
 
     logger.debug(f"question: {question}\n")
+    result = rag.retrieve(question, filter)
     logger.debug("generating answer...\n")
 
+    if as_json:
+        for _ in rag.stream(result):
+            pass
+        print(json.dumps(result.to_dict(), indent=2, ensure_ascii=False))
+        return
+
     print("Answer:\n")
-    for chunk in rag_chain.stream(question):
-        print(chunk, end="", flush=True)
+    for token in rag.stream(result):
+        print(token, end="", flush=True)
     print()
 
     if show_sources:
-        docs = retriever.invoke(question)
         print("\n" + "=" * 80)
         print("Sources:")
-        for i, doc in enumerate(docs, 1):
-            source = doc.metadata.get("source", "Unknown")
-            print(f"\n[{i}] {source}")
-            print(doc.page_content[:200] + "...")
+        for i, chunk in enumerate(result.chunks, 1):
+            print(f"\n[{i}] {', '.join(chunk.sources)}")
+            print(chunk.content[:200] + "...")
+
+    log_timings(result)
 
 
 def main():
     """CLI entry point."""
-    if len(sys.argv) < 2:
-        print("Usage: python query.py <question> [--sources]")
-        print('\nExample: python query.py "What is essence in Shadowrun?"')
-        print('         python query.py "How does magic work?" --sources')
-        sys.exit(1)
-
-    # Check for --sources flag
-    show_sources = "--sources" in sys.argv
-    if show_sources:
-        sys.argv.remove("--sources")
-
-    question = " ".join(sys.argv[1:])
-
-    query(question, show_sources=show_sources)
+    setup_logging(settings.log_level)
+
+    parser = argparse.ArgumentParser(description="Ask the Shadowrun lore RAG a question")
+    parser.add_argument("question", nargs="+", help='e.g. "What is essence in Shadowrun?"')
+    parser.add_argument("--sources", action="store_true", help="Print the retrieved chunks")
+    parser.add_argument("--json", action="store_true", help="Print the QueryResult as JSON")
+    parser.add_argument(
+        "--book",
+        action="append",
+        help="Only search this book's chunks (source file stem, e.g. 7210---tir-tairngire); "
+        "repeat for several",
+    )
+    parser.add_argument("--edition", help="Only search books of this edition")
+    parser.add_argument("--book-type", help="Only search books of this type")
+    args = parser.parse_args()
+    try:
+        search_filter = book_filter(args.book, args.edition, args.book_type)
+    except ValueError as e:
+        parser.error(str(e))
+
+    query(
+        " ".join(args.question),
+        show_sources=args.sources,
+        as_json=args.json,
+        filter=search_filter,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+"""HTTP query server that keeps the vector store and models warm.
+
+`query.py` pays for importing langchain/chromadb, opening Chroma and creating
+the Ollama clients on every question. This answers through the same RagQuery
+from one long-running process instead: the store and clients are created
+once at startup and shared by every request.
+
+Startup opens the store in the background and warms it before reporting ready:
+one embedding request and one single-token generation load both Ollama
+models, and a vector search with that embedding loads the HNSW index from
+disk. OLLAMA_KEEP_ALIVE stops Ollama unloading them again between questions.
+Ollama may still be starting when the server does, so a failed warm-up is
+retried with exponential backoff (SERVER_WARMUP_ATTEMPTS tries); if the last
+one fails too, the server shuts down and exits 1 for the container to be
+restarted, rather than staying up but never ready.
+
+Requests run concurrently on one event loop (retrieval in worker threads,
+generation over Ollama's async client); at most SERVER_CONCURRENCY are
+generating at once, the rest wait their turn. Answers are streamed back as
+they are generated, and generation stops if the client disconnects.
+
+Endpoints:
+    GET  /health    200 while the process is up (liveness)
+    GET  /ready     200 once the store and models are warm, 503 until then
+    POST /query     {"question": "..."} → answer streamed as text/plain
+
+With {"question": "...", "format": "events"}, /query streams newline-delimited
+JSON instead: a "sources" event with the retrieved chunks as soon as the
+search returns, a "token" event per answer token, and a final "result" event
+with the full QueryResult (answer, chunks, timings).
+
+It is a bare ASGI app on uvicorn rather than a web framework, since three
+routes don't need one.
+
+Usage:
+    uv run python src/query_server.py
+    curl -N localhost:8000/query -d '{"question": "What is Tir Tairngire?"}'
+"""
+
+import asyncio
+import json
+import time
+
+import uvicorn
+from langchain_ollama import ChatOllama
+
+from config import settings
+from logs import logger, setup_logging
+from query import RagQuery, load_vector_store, log_timings
+from vector_store import vector_store_path
+
+FORMATS = ("text", "events")
+
+# Seconds before the first warm-up retry; doubles per attempt up to the cap
+WARMUP_RETRY_DELAY = 1.0
+WARMUP_MAX_RETRY_DELAY = 60.0
+
+
+class QueryServer:
+    """ASGI app holding the vector store and Ollama clients for its lifetime."""
+
+    def __init__(self):
+        self.rag: RagQuery | None = None
+        self.ready = False
+        self.failed = False
+        # Set by main(); told to exit when warm-up gives up
+        self.server: uvicorn.Server | None = None
+        self._warmup: asyncio.Task | None = None
+        self._slots: asyncio.Semaphore | None = None
+
+    # -- startup --------------------------------------------------------------
+
+    async def warm_up(self) -> None:
+        delay = WARMUP_RETRY_DELAY
+        for attempt in range(1, settings.server_warmup_attempts + 1):
+            try:
+                await self._load()
+                return
+            except Exception as e:
+                if attempt == settings.server_warmup_attempts:
+                    raise
+                logger.warning(
+                    f"warm-up attempt {attempt} of {settings.server_warmup_attempts} "
+                    f"failed: {e!r} — retrying in {delay:.0f}s"
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WARMUP_MAX_RETRY_DELAY)
+
+    async def _load(self) -> None:
+        start = time.perf_counter()
+        if self.rag is None:
+            self.rag = RagQuery(await asyncio.to_thread(load_vector_store))
+
+        # Loads the embedding model; the vector search then loads the index
+        await self.rag.aretrieve("warm-up")
+        logger.info(f"vector store and {settings.embedding_model} loaded")
+
+        llm = ChatOllama(
+            model=settings.llm_model,
+            base_url=settings.ollama_host,
+            num_predict=1,
+            keep_alive=settings.ollama_keep_alive,
+        )
+        await llm.ainvoke("warm-up")
+        logger.info(f"{settings.llm_model} loaded")
+
+        self.ready = True
+        logger.info(f"ready in {time.perf_counter() - start:.1f}s")
+
+    def _warmup_done(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            # /health would keep answering 200, so nothing would restart a
+            # server that can never get ready; exit instead
+            logger.error(f"warm-up failed, shutting down: {task.exception()!r}")
+            self.failed = True
+            if self.server is not None:
+                self.server.should_exit = True
+
+    async def lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._slots = asyncio.Semaphore(settings.server_concurrency)
+                self._warmup = asyncio.create_task(self.warm_up())
+                self._warmup.add_done_callback(self._warmup_done)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._warmup is not None:
+                    self._warmup.cancel()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # -- requests -------------------------------------------------------------
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        route = (scope["method"], scope["path"])
+        if route == ("GET", "/health"):
+            await respond(send, 200, {"status": "ok"})
+        elif route == ("GET", "/ready"):
+            status = 200 if self.ready else 503
+            await respond(send, status, {"ready": self.ready})
+        elif route == ("POST", "/query"):
+            await self.handle_query(receive, send)
+        elif scope["path"] in ("/health", "/ready", "/query"):
+            await respond(send, 405, {"error": "method not allowed"})
+        else:
+            await respond(send, 404, {"error": "not found"})
+
+    async def handle_query(self, receive, send) -> None:
+        if not self.ready:
+            await respond(send, 503, {"error": "not ready"})
+            return
+
+        try:
+            body = json.loads(await read_body(receive) or b"{}")
+            question = body["question"].strip()
+            format_ = body.get("format", "text")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            await respond(send, 400, {"error": 'expected {"question": "..."}'})
+            return
+        if not question:
+            await respond(send, 400, {"error": "question is empty"})
+            return
+        if format_ not in FORMATS:
+            await respond(send, 400, {"error": f"format must be one of {', '.join(FORMATS)}"})
+            return
+
+        disconnected = asyncio.Event()
+        watcher = asyncio.create_task(wait_for_disconnect(receive, disconnected))
+        try:
+            async with self._slots:
+                if not disconnected.is_set():
+                    await self.answer(question, format_, send, disconnected)
+        finally:
+            watcher.cancel()
+
+    async def answer(
+        self, question: str, format_: str, send, disconnected: asyncio.Event
+    ) -> None:
+        logger.info(f"query: {question}")
+        try:
+            result = await self.rag.aretrieve(question)
+        except Exception as e:
+            logger.error(f"retrieval failed: {e!r}")
+            await respond(send, 502, {"error": "retrieval failed"})
+            return
+
+        events = format_ == "events"
+        content_type = b"application/x-ndjson" if events else b"text/plain; charset=utf-8"
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", content_type)],
+            }
+        )
+
+        async def emit(data: bytes, more_body: bool = True) -> None:
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        if events:
+            await emit(event("sources", chunks=result.to_dict()["chunks"]))
+        try:
+            async for token in self.rag.astream(result):
+                if disconnected.is_set():
+                    logger.info("client disconnected, stopping generation")
+                    return
+                await emit(event("token", text=token) if events else token.encode())
+        except Exception as e:
+            # Headers are already sent, so all we can do is say so in the body
+            logger.error(f"query failed: {e!r}")
+            if events:
+                await emit(event("error", error="generation failed"), more_body=False)
+            else:
+                await emit(b"\n\n[error: generation failed]", more_body=False)
+            return
+
+        await emit(event("result", **result.to_dict()) if events else b"\n", more_body=False)
+        log_timings(result)
+
+
+def event(name: str, **fields) -> bytes:
+    return json.dumps({"event": name, **fields}, ensure_ascii=False).encode() + b"\n"
+
+
+async def read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def wait_for_disconnect(receive, disconnected: asyncio.Event) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    disconnected.set()
+
+
+async def respond(send, status: int, payload: dict) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+
+def main() -> None:
+    setup_logging(settings.log_level)
+
+    if not vector_store_path().exists():
+        logger.error(f"error: vector store not found at {vector_store_path()}")
+        raise SystemExit(1)
+
+    app = QueryServer()
+    app.server = uvicorn.Server(
+        uvicorn.Config(
+            app,
+            host=settings.server_host,
+            port=settings.server_port,
+            log_level=settings.log_level.lower(),
+        )
+    )
+    app.server.run()
+    if app.failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
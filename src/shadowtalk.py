@@ -15,14 +15,15 @@ import random
 import sys
 from dataclasses import dataclass
 
-from langchain_chroma import Chroma
 from langchain_community.vectorstores.utils import Document
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.vectorstores import VectorStore
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 
 from config import settings
 from logs import logger, setup_logging
+from vector_store import open_vector_store, vector_store_path
 
 
 @dataclass
@@ -94,7 +95,7 @@ TURNS = 8  # 2 full rounds for 4 personas
 
 
 def retrieve(
-    vector_store: Chroma, query: str, exclude_ids: set[str], handle: str
+    vector_store: VectorStore, query: str, exclude_ids: set[str], handle: str
 ) -> tuple[str, set[str], list[Document]]:
     search_kwargs: dict = {"k": settings.top_k}
     if exclude_ids:
@@ -133,8 +134,8 @@ def make_schedule(turns: int) -> list[Persona]:
 
 
 def run(topic: str, debug: bool = False) -> None:
-    if not settings.chroma_path.exists():
-        logger.error(f"vector store not found at {settings.chroma_path}")
+    if not vector_store_path().exists():
+        logger.error(f"vector store not found at {vector_store_path()}")
         sys.exit(1)
 
     llm = ChatOllama(
@@ -146,10 +147,7 @@ def run(topic: str, debug: bool = False) -> None:
         model=settings.embedding_model,
         base_url=settings.ollama_host,
     )
-    vector_store = Chroma(
-        persist_directory=str(settings.chroma_path),
-        embedding_function=embeddings,
-    )
+    vector_store = open_vector_store(embeddings)
     history_lines: list[str] = []
     used_ids: set[str] = set()
     schedule = make_schedule(TURNS)
@@ -203,6 +201,7 @@ def run(topic: str, debug: bool = False) -> None:
                     {
                         "chunk_id": doc.metadata.get("chunk_id", ""),
                         "source": doc.metadata.get("source", ""),
+                        "sources": doc.metadata.get("sources") or [doc.metadata.get("source", "")],
                         "content": doc.page_content,
                     }
                     for doc in docs
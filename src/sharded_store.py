@@ -0,0 +1,497 @@
+"""Per-book Chroma collections, searched in parallel (VECTOR_BACKEND=sharded).
+
+With VECTOR_BACKEND=sharded, create_embeddings.py writes straight into one
+collection (shard) per book under chroma_shards/, through ShardedCollection,
+instead of the single Chroma store:
+
+- each book gets its own, much smaller, HNSW graph, and re-ingesting a book
+  only writes the shards of the books its chunks appear in
+- a chunk shared by several books is embedded once but stored in the shard of
+  every book in its `sources`, so a book's shard holds everything a search
+  scoped to that book should find
+- a book-scoped query (`source` equal to or `$in` some books, or `sources`
+  `$contains` a book) only searches the shards it names
+- the shards a query does search are searched concurrently on a thread
+  pool (SHARD_SEARCH_WORKERS, one per core by default), and the hits are
+  merged by distance, each chunk once, into one global top k
+
+sync_shards() (--sync) splits an existing single Chroma store into shards,
+copying embeddings rather than re-embedding; a rerun only writes chunks whose
+metadata or books changed. A shard built with different HNSW build
+parameters (see vector_store.py) is rebuilt. --benchmark compares fan-out
+latency and results with the single collection on tests/rag_queries.md.
+
+Usage:
+    uv run python src/sharded_store.py --sync
+    uv run python src/sharded_store.py --benchmark
+    uv run python src/sharded_store.py --benchmark tests/rag_queries.md --k 7
+"""
+
+import argparse
+import hashlib
+import itertools
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import chromadb
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from chunk_index import CHROMA_MAX_BATCH, COLLECTION_NAME
+from config import settings
+from logs import logger, setup_logging
+from numpy_index import collection_space, embed_questions, latency_ms, write_report
+from vector_store import HNSW_BUILD_PARAMS, apply_hnsw_settings, hnsw_configuration
+
+
+def shard_name(source: str) -> str:
+    """Chroma collection name for a book: readable, unique, within Chroma's rules."""
+    stem = re.sub(r"[^a-zA-Z0-9._-]+", "-", Path(source).stem).strip("._-")[:48]
+    digest = hashlib.sha1(source.encode("utf-8")).hexdigest()[:8]
+    return f"book-{stem}-{digest}" if stem else f"book-{digest}"
+
+
+def _open_shards(client) -> dict[str, Any]:
+    """{source: collection} for every shard in `client`."""
+    return {
+        collection.metadata["source"]: collection
+        for collection in client.list_collections()
+        if (collection.metadata or {}).get("source")
+    }
+
+
+def _built_as_configured(shard) -> bool:
+    current = (shard.configuration or {}).get("hnsw") or {}
+    wanted = hnsw_configuration()["hnsw"]
+    return all(current.get(param) == wanted[param] for param in HNSW_BUILD_PARAMS)
+
+
+def chunk_books(metadata: dict) -> set[str]:
+    """The books whose shards hold a chunk: every book it appears in."""
+    return set(metadata.get("sources") or [metadata.get("source", "Unknown")])
+
+
+class ShardedCollection:
+    """The part of a Chroma collection's API ingest writes through, over book shards.
+
+    ChunkIndex and the embedding pipeline use it in place of the single
+    collection. Each chunk is kept in the shard of every book in its
+    `sources`: when a provenance update adds a book, the chunk's embedding
+    is copied from a shard that already holds it; when one is dropped, it
+    is deleted from that book's shard. A shard left empty is removed.
+    """
+
+    def __init__(self, path: Path):
+        path.mkdir(parents=True, exist_ok=True)
+        self.client = chromadb.PersistentClient(path=str(path))
+        self.shards = _open_shards(self.client)
+        self.members: dict[str, set[str]] = {}  # chunk_id: books whose shards hold it
+        self.changed: Counter[str] = Counter()  # chunks written or removed, per book
+        for source, shard in self.shards.items():
+            apply_hnsw_settings(shard)
+            for chunk_id in shard.get(include=[])["ids"]:
+                self.members.setdefault(chunk_id, set()).add(source)
+
+    def _shard(self, source: str):
+        shard = self.shards.get(source)
+        if shard is None:
+            shard = self.client.create_collection(
+                name=shard_name(source),
+                metadata={"source": source},
+                configuration=hnsw_configuration(),
+            )
+            self.shards[source] = shard
+        return shard
+
+    def count(self) -> int:
+        return len(self.members)
+
+    def get(self, include: list[str] | None = None) -> dict:
+        """Every chunk's id and metadata, once each (its shards hold the same metadata)."""
+        seen: set[str] = set()
+        ids, metadatas = [], []
+        for shard in self.shards.values():
+            stored = shard.get(include=["metadatas"])
+            for chunk_id, metadata in zip(stored["ids"], stored["metadatas"]):
+                if chunk_id not in seen:
+                    seen.add(chunk_id)
+                    ids.append(chunk_id)
+                    metadatas.append(metadata)
+        return {"ids": ids, "metadatas": metadatas}
+
+    def upsert(
+        self,
+        ids: list[str],
+        embeddings: list,
+        metadatas: list[dict],
+        documents: list[str],
+    ) -> None:
+        rows: dict[str, list[int]] = defaultdict(list)
+        removals: dict[str, list[str]] = defaultdict(list)
+        for row, (chunk_id, metadata) in enumerate(zip(ids, metadatas)):
+            books = chunk_books(metadata)
+            for book in self.members.get(chunk_id, set()) - books:
+                removals[book].append(chunk_id)
+            self.members[chunk_id] = books
+            for book in books:
+                rows[book].append(row)
+
+        for book, book_rows in rows.items():
+            self._shard(book).upsert(
+                ids=[ids[row] for row in book_rows],
+                embeddings=[embeddings[row] for row in book_rows],
+                metadatas=[metadatas[row] for row in book_rows],
+                documents=[documents[row] for row in book_rows],
+            )
+            self.changed[book] += len(book_rows)
+        self._remove(removals)
+
+    def update(self, ids: list[str], metadatas: list[dict]) -> None:
+        """Rewrite metadata, moving each chunk into the shards of the books it now lists."""
+        updates: dict[str, list[tuple[str, dict]]] = defaultdict(list)
+        # {shard copied from: [(chunk_id, metadata, books it joins)]}
+        joins: dict[str, list[tuple[str, dict, set[str]]]] = defaultdict(list)
+        removals: dict[str, list[str]] = defaultdict(list)
+        for chunk_id, metadata in zip(ids, metadatas):
+            current = self.members.get(chunk_id)
+            if not current:
+                continue
+            books = chunk_books(metadata)
+            for book in current & books:
+                updates[book].append((chunk_id, metadata))
+            if books - current:
+                joins[min(current)].append((chunk_id, metadata, books - current))
+            for book in current - books:
+                removals[book].append(chunk_id)
+            self.members[chunk_id] = books
+
+        for donor, chunks in joins.items():
+            for start in range(0, len(chunks), CHROMA_MAX_BATCH):
+                batch = chunks[start : start + CHROMA_MAX_BATCH]
+                stored = self.shards[donor].get(
+                    ids=[chunk_id for chunk_id, _, _ in batch],
+                    include=["embeddings", "documents"],
+                )
+                copies = dict(zip(stored["ids"], zip(stored["embeddings"], stored["documents"])))
+                adds: dict[str, list[tuple[str, dict]]] = defaultdict(list)
+                for chunk_id, metadata, books in batch:
+                    # A None value deletes a field on update, but can't be added
+                    added = {name: value for name, value in metadata.items() if value is not None}
+                    for book in books:
+                        adds[book].append((chunk_id, added))
+                for book, chunks_added in adds.items():
+                    self._shard(book).add(
+                        ids=[chunk_id for chunk_id, _ in chunks_added],
+                        embeddings=[copies[chunk_id][0] for chunk_id, _ in chunks_added],
+                        metadatas=[metadata for _, metadata in chunks_added],
+                        documents=[copies[chunk_id][1] for chunk_id, _ in chunks_added],
+                    )
+                    self.changed[book] += len(chunks_added)
+
+        for book, chunks in updates.items():
+            for start in range(0, len(chunks), CHROMA_MAX_BATCH):
+                batch = chunks[start : start + CHROMA_MAX_BATCH]
+                self.shards[book].update(
+                    ids=[chunk_id for chunk_id, _ in batch],
+                    metadatas=[metadata for _, metadata in batch],
+                )
+        self._remove(removals)
+
+    def delete(self, ids: list[str]) -> None:
+        removals: dict[str, list[str]] = defaultdict(list)
+        for chunk_id in ids:
+            for book in self.members.pop(chunk_id, set()):
+                removals[book].append(chunk_id)
+        self._remove(removals)
+
+    def _remove(self, removals: dict[str, list[str]]) -> None:
+        for book, chunk_ids in removals.items():
+            shard = self.shards[book]
+            for start in range(0, len(chunk_ids), CHROMA_MAX_BATCH):
+                shard.delete(ids=chunk_ids[start : start + CHROMA_MAX_BATCH])
+            self.changed[book] += len(chunk_ids)
+            if shard.count() == 0:
+                self.client.delete_collection(shard.name)
+                del self.shards[book]
+
+
+def sync_shards(chroma_path: Path | None = None, dest: Path | None = None) -> Path:
+    """Split a single Chroma store into per-book shards, writing only what changed."""
+    chroma_path = chroma_path or settings.chroma_path
+    dest = dest or settings.chroma_shards_path
+
+    main = chromadb.PersistentClient(path=str(chroma_path)).get_collection(COLLECTION_NAME)
+    dest.mkdir(parents=True, exist_ok=True)
+    client = chromadb.PersistentClient(path=str(dest))
+    for source, shard in _open_shards(client).items():
+        if not _built_as_configured(shard):
+            logger.info(f"  {source}: rebuilding with the HNSW settings")
+            client.delete_collection(shard.name)
+
+    start = time.perf_counter()
+    shards = ShardedCollection(dest)
+    stored = shards.get()
+    stored = dict(zip(stored["ids"], stored["metadatas"]))
+
+    # Occurrence lists change when another book gains or loses a shared chunk
+    seen: set[str] = set()
+    changed: list[str] = []
+    for offset in range(0, main.count(), CHROMA_MAX_BATCH):
+        batch = main.get(limit=CHROMA_MAX_BATCH, offset=offset, include=["metadatas"])
+        for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]):
+            seen.add(chunk_id)
+            metadata = metadata or {}
+            if stored.get(chunk_id) != metadata or shards.members.get(chunk_id) != chunk_books(
+                metadata
+            ):
+                changed.append(chunk_id)
+
+    for offset in range(0, len(changed), CHROMA_MAX_BATCH):
+        batch = main.get(
+            ids=changed[offset : offset + CHROMA_MAX_BATCH],
+            include=["embeddings", "metadatas", "documents"],
+        )
+        shards.upsert(
+            ids=batch["ids"],
+            embeddings=batch["embeddings"],
+            metadatas=batch["metadatas"],
+            documents=batch["documents"],
+        )
+    shards.delete([chunk_id for chunk_id in stored if chunk_id not in seen])
+
+    for source, count in sorted(shards.changed.items()):
+        logger.info(f"  {source}: {count} chunks written or removed")
+    logger.info(
+        f"{len(shards.changed)} of {len(shards.shards)} book shards updated in {dest} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    return dest
+
+
+# -- search ------------------------------------------------------------------
+
+
+def _sources(where: dict | None) -> set[str] | None:
+    """The books a Chroma `where` filter restricts chunks to, or None for all of them.
+
+    A chunk is in the shard of every book in `sources`, including its first
+    occurrence `source`, so either field can pick the shards.
+    """
+    if not where:
+        return None
+    if "$and" in where:
+        selected = None
+        for clause in where["$and"]:
+            sources = _sources(clause)
+            if sources is not None:
+                selected = sources if selected is None else selected & sources
+        return selected
+    if "$or" in where:
+        # Only narrows if every alternative does
+        alternatives = [_sources(clause) for clause in where["$or"]]
+        if any(sources is None for sources in alternatives):
+            return None
+        return set().union(*alternatives)
+    sources = where.get("sources")
+    if isinstance(sources, dict) and "$contains" in sources:
+        return {sources["$contains"]}
+    condition = where.get("source")
+    if isinstance(condition, str):
+        return {condition}
+    if isinstance(condition, dict):
+        if "$eq" in condition:
+            return {condition["$eq"]}
+        if "$in" in condition:
+            return set(condition["$in"])
+    # $ne, $nin and filters on other fields can match any book
+    return None
+
+
+class ShardedVectorStore(VectorStore):
+    """Read-only vector store fanning each search out over per-book shards."""
+
+    def __init__(self, path: Path, embedding_function: Embeddings, workers: int | None = None):
+        self._embedding_function = embedding_function
+        client = chromadb.PersistentClient(path=str(path))
+        self.shards = _open_shards(client)
+        if not self.shards:
+            raise ValueError(f"no book shards in {path}, run sharded_store.py --sync")
+        for shard in self.shards.values():
+            apply_hnsw_settings(shard)
+        self.space = collection_space(next(iter(self.shards.values())))
+
+        self.workers = workers or settings.shard_search_workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="shard-search")
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def select(self, filter: dict | None) -> list:
+        """The shards a search with `filter` has to look at."""
+        sources = _sources(filter)
+        if sources is None:
+            return list(self.shards.values())
+        return [self.shards[source] for source in sorted(sources) if source in self.shards]
+
+    def search(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        filter: dict | None = None,
+        where_document: dict | None = None,
+    ) -> list[tuple[Document, float]]:
+        """Global top-k (document, distance), nearest first, over the selected shards."""
+
+        def search_shard(shard) -> list[tuple[float, Document]]:
+            result = shard.query(
+                query_embeddings=[embedding],
+                n_results=k,
+                where=filter or None,
+                where_document=where_document or None,
+                include=["documents", "metadatas", "distances"],
+            )
+            return [
+                (distance, Document(page_content=text or "", metadata=metadata or {}))
+                for text, metadata, distance in zip(
+                    result["documents"][0], result["metadatas"][0], result["distances"][0]
+                )
+            ]
+
+        hits = itertools.chain.from_iterable(self.pool.map(search_shard, self.select(filter)))
+        # A shared chunk is found in each of its books' shards; keep it once
+        nearest: dict[str, tuple[Document, float]] = {}
+        for distance, doc in sorted(hits, key=lambda hit: hit[0]):
+            nearest.setdefault(doc.metadata.get("chunk_id") or doc.page_content, (doc, distance))
+            if len(nearest) == k:
+                break
+        return list(nearest.values())
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        return self.search(embedding, k, kwargs.get("filter"), kwargs.get("where_document"))
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        hits = self.similarity_search_by_vector_with_score(embedding, k, **kwargs)
+        return [doc for doc, _ in hits]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[tuple[Document, float]]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        if self.space == "cosine":
+            return self._cosine_relevance_score_fn
+        if self.space == "ip":
+            return self._max_inner_product_relevance_score_fn
+        return self._euclidean_relevance_score_fn
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: Iterable[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        **kwargs: Any,
+    ) -> "ShardedVectorStore":
+        raise NotImplementedError("shards are split from the Chroma store, see sync_shards")
+
+
+# -- benchmark ---------------------------------------------------------------
+
+
+def benchmark(queries_path: Path, k: int) -> Path:
+    """Latency of the single collection against fan-out over the shards, and their overlap."""
+    embeddings, query_vectors = embed_questions(queries_path)
+
+    main = chromadb.PersistentClient(path=str(settings.chroma_path)).get_collection(
+        COLLECTION_NAME
+    )
+    apply_hnsw_settings(main)
+    store = ShardedVectorStore(settings.chroma_shards_path, embeddings)
+    # One untimed query each, so neither side is measured loading its index
+    main.query(query_embeddings=query_vectors[:1], n_results=k, include=[])
+    store.search(query_vectors[0].tolist(), k)
+
+    single_seconds, sharded_seconds, overlaps = [], [], []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        single = main.query(query_embeddings=[vector], n_results=k, include=[])["ids"][0]
+        single_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        hits = store.search(vector.tolist(), k)
+        sharded_seconds.append(time.perf_counter() - start)
+
+        sharded = {doc.metadata.get("chunk_id") for doc, _ in hits}
+        overlaps.append(len(sharded & set(single)) / max(len(single), 1))
+
+    report = {
+        "queries_file": str(queries_path),
+        "queries": len(query_vectors),
+        "k": k,
+        "shards": len(store.shards),
+        "workers": store.workers,
+        "single": latency_ms(single_seconds),
+        "sharded": {
+            **latency_ms(sharded_seconds),
+            "overlap_at_k": round(float(np.mean(overlaps)), 4),
+        },
+    }
+    logger.info(
+        f"single p50 {report['single']['p50_ms']}ms; {len(store.shards)} shards "
+        f"p50 {report['sharded']['p50_ms']}ms, overlap@{k} {report['sharded']['overlap_at_k']}"
+    )
+    return write_report(report, "sharded_store_benchmark")
+
+
+def main() -> None:
+    setup_logging(settings.log_level)
+
+    parser = argparse.ArgumentParser()
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument(
+        "--sync",
+        action="store_true",
+        help="Create or update the per-book shards from the Chroma store",
+    )
+    mode.add_argument(
+        "--benchmark",
+        nargs="?",
+        const=Path("tests/rag_queries.md"),
+        type=Path,
+        metavar="QUERIES",
+        help="Compare fan-out search with the single collection (default: tests/rag_queries.md)",
+    )
+    parser.add_argument("--k", type=int, default=settings.top_k, help="Results per query")
+    args = parser.parse_args()
+
+    if not settings.chroma_path.exists():
+        logger.error(f"vector store not found at {settings.chroma_path}")
+        sys.exit(1)
+
+    if args.sync:
+        sync_shards()
+    else:
+        benchmark(args.benchmark, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Incremental, parallel per-book stages with sidecar stamps.
+
+Each output file gets a `<name>.stamp` sidecar recording the hash of the
+source it was built from and the stage's config hash (its module source plus
+any settings that change its output). A book whose stamp still matches is
+skipped, so re-running clean_markdown.py after a change that only affects a
+handful of books — or after no change at all — only rebuilds what is stale.
+
+Outputs are written to a temp file and renamed into place, so an interrupted
+run never leaves a half-written book behind for the next stage to read.
+"""
+
+import hashlib
+import json
+import os
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from config import settings
+from logs import logger, setup_logging
+
+_SRC = Path(__file__).resolve().parent
+
+
+def file_hash(path: Path) -> str | None:
+    """SHA-1 of a file's contents, or None if it doesn't exist."""
+    if not path.exists():
+        return None
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def config_hash(*parts: object) -> str:
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def source_hashes(*modules: str) -> list[str | None]:
+    """Hashes of the given src/ modules — a code change is a config change."""
+    return [file_hash(_SRC / f"{module}.py") for module in modules]
+
+
+def write_atomic(dest: Path, text: str) -> None:
+    tmp = dest.with_name(f".{dest.name}.tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, dest)
+
+
+def _stamp_path(dest: Path) -> Path:
+    return dest.with_name(f"{dest.name}.stamp")
+
+
+def write_stamp(dest: Path, source_hash: str, config: str) -> None:
+    write_atomic(_stamp_path(dest), json.dumps({"source": source_hash, "config": config}))
+
+
+def is_current(source: Path, dest: Path, config: str) -> bool:
+    """Whether `dest` was built from `source` as it is now, under `config`."""
+    stamp_path = _stamp_path(dest)
+    if not dest.exists() or not stamp_path.exists():
+        return False
+    stamp = json.loads(stamp_path.read_text(encoding="utf-8"))
+    return stamp["config"] == config and stamp["source"] == file_hash(source)
+
+
+def _build(build: Callable[[Path, Path], None], source: Path, dest: Path, config: str) -> None:
+    source_hash = file_hash(source)
+    build(source, dest)
+    write_stamp(dest, source_hash, config)
+
+
+def run_stage(
+    name: str,
+    build: Callable[[Path, Path], None],
+    sources: list[Path],
+    output_dir: Path,
+    config: str,
+    workers: int = 1,
+    force: bool = False,
+) -> list[Path]:
+    """Build `output_dir/<source name>` for every stale source; returns those built.
+
+    `build` must be a module-level function so it can be sent to worker
+    processes.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stale = [
+        source
+        for source in sources
+        if force or not is_current(source, output_dir / source.name, config)
+    ]
+    logger.info(f"{name}: {len(sources) - len(stale)} of {len(sources)} books up to date")
+    if not stale:
+        return []
+
+    jobs = [(build, source, output_dir / source.name, config) for source in stale]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(jobs)),
+            initializer=setup_logging,
+            initargs=(settings.log_level,),
+        ) as pool:
+            list(pool.map(_build, *zip(*jobs)))
+    else:
+        for job in jobs:
+            _build(*job)
+    return stale
@@ -12,14 +12,31 @@ Removes:
 Real content start is detected as the first heading (after the ToC block) that is
 followed within 20 lines by a non-table prose line of 80+ characters.
 
+Detection streams: kept lines are emitted as they are read, and only lines
+whose fate is still undecided (a ToC block, a possible trailing index) are
+held back. strip_lines can run straight on the output of
+clean_markdown.clean_stream, which is how create_embeddings cleans and strips
+in memory with INLINE_MARKDOWN_STAGES.
+
+Books are stripped in parallel processes and skipped when unchanged since the
+last run (see stage_stamps.py).
+
 Usage:
     uv run python src/strip_toc.py
+    uv run python src/strip_toc.py --force  # re-strip every book
 """
 
+import argparse
+import os
 import re
+from collections import deque
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import TextIO
 
 from config import settings
 from logs import logger, setup_logging
+from stage_stamps import config_hash, run_stage, source_hashes, write_atomic
 
 # Unambiguous ToC/credits headings — safe to match anywhere in the document
 TOC_HEADING_RE = re.compile(
@@ -46,116 +63,252 @@ HEADING_RE = re.compile(r"^#+\s+")
 TABLE_ROW_RE = re.compile(r"^\|")
 
 
-def find_toc_start(lines: list[str]) -> int | None:
-    """Return the line index of the first ToC/credits heading, or None.
+# A standalone CONTENTS heading counts as the ToC only within the first
+# max(EARLY_MIN_LINES, EARLY_FRACTION * lines) lines
+EARLY_MIN_LINES = 50
+EARLY_FRACTION = 0.15
+
+# Real content starts at a heading followed within this many lines by prose
+CONTENT_LOOKAHEAD = 20
+CONTENT_MIN_CHARS = 80
+
+# An INDEX heading only counts within the last (1 - INDEX_FRACTION) of the document
+INDEX_FRACTION = 0.70
+
+
+def _is_toc_heading(line: str, i: int, total: int | None) -> bool | None:
+    """Whether line `i` starts the ToC; None if that depends on the document length.
 
-    Unambiguous patterns (TABLE OF CONTENTS, CREDITS/CONTENTS) are matched
-    anywhere. Ambiguous standalone CONTENTS headings are only matched within
-    the first 15% of the document to avoid false positives mid-document.
+    Unambiguous patterns (TABLE OF CONTENTS, CREDITS/CONTENTS) match anywhere.
+    Ambiguous standalone CONTENTS headings only match within the first 15% of
+    the document, to avoid false positives mid-document.
     """
-    early_limit = max(50, int(len(lines) * 0.15))
-    for i, line in enumerate(lines):
-        stripped = line.rstrip()
-        if TOC_HEADING_RE.match(stripped):
-            return i
-        if i < early_limit and TOC_HEADING_EARLY_RE.match(stripped):
-            return i
-    return None
+    stripped = line.rstrip()
+    if TOC_HEADING_RE.match(stripped):
+        return True
+    if not TOC_HEADING_EARLY_RE.match(stripped):
+        return False
+    if i < EARLY_MIN_LINES:
+        return True
+    if total is None:
+        return None
+    return i < int(total * EARLY_FRACTION)
+
+
+def _is_prose(line: str) -> bool:
+    candidate = line.strip()
+    return (
+        bool(candidate)
+        and not TABLE_ROW_RE.match(candidate)
+        and not HEADING_RE.match(candidate)
+        and len(candidate) >= CONTENT_MIN_CHARS
+    )
+
 
+def strip_front_matter(
+    lines: Iterable[str], start: int = 0, total: int | None = None
+) -> Iterator[str]:
+    """Yield `lines` without the ToC/credits block.
 
-def find_content_start(lines: list[str], from_line: int) -> int | None:
-    """Return the line index of the first real-content heading after the ToC block.
+    The block runs from the first ToC heading to the first later heading that
+    is followed within 20 lines by a non-table, non-heading line of 80+
+    characters. Lines are passed through as they arrive; only lines whose fate
+    is still open are held back: the ToC block while its end is being looked
+    for, or everything after an ambiguous CONTENTS heading until enough of the
+    document has been seen to tell whether it is in the first 15%. If the
+    content start is never found, the ToC is kept (safety valve — don't strip).
 
-    Scans forward from `from_line` looking for a heading that is followed
-    within 20 lines by a non-table, non-heading line of 80+ characters.
-    Returns None if no such heading is found (safety valve — don't strip).
+    `start` and `total` are used to re-scan held lines once the document
+    length is known.
     """
-    i = from_line
-    while i < len(lines):
-        if HEADING_RE.match(lines[i]):
-            for j in range(i + 1, min(i + 21, len(lines))):
-                candidate = lines[j].strip()
-                if (
-                    candidate
-                    and not TABLE_ROW_RE.match(candidate)
-                    and not HEADING_RE.match(candidate)
-                    and len(candidate) >= 80
-                ):
-                    return i
-        i += 1
-    return None
-
-
-def find_index_start(lines: list[str]) -> int | None:
-    """Return the line index of the INDEX heading if found in the last 30% of the doc."""
-    min_line = int(len(lines) * 0.70)
-    for i in range(len(lines) - 1, min_line, -1):
-        if INDEX_HEADING_RE.match(lines[i].rstrip()):
-            return i
-    return None
-
-
-def strip_front_matter(lines: list[str], filename: str) -> list[str]:
-    toc_start = find_toc_start(lines)
-    if toc_start is None:
-        logger.info("  no ToC heading found — skipping front matter strip")
-        return lines
+    held: list[str] = []  # lines from `toc` (or `pending`) onwards
+    toc: int | None = None
+    pending: int | None = None  # ambiguous CONTENTS heading awaiting the length
+    headings: deque[int] = deque()  # headings in the last CONTENT_LOOKAHEAD lines
+    content_start: int | None = None
+
+    def find_content(j: int, line: str) -> int | None:
+        """Track headings after the ToC; return the content start once line j shows it."""
+        while headings and headings[0] < j - CONTENT_LOOKAHEAD:
+            headings.popleft()
+        if headings and _is_prose(line):
+            return headings[0]
+        if HEADING_RE.match(line):
+            headings.append(j)
+        return None
+
+    i = start - 1
+    for i, line in enumerate(lines, start):
+        if content_start is not None:
+            yield line
+            continue
+
+        if toc is None and pending is None:
+            found = _is_toc_heading(line, i, total)
+            if found is False:
+                yield line
+                continue
+            held = [line]
+            if found:
+                toc = i
+            else:
+                pending = i
+            continue
+
+        held.append(line)
+        if pending is not None:
+            if int((i + 1) * EARLY_FRACTION) <= pending:
+                continue
+            # Enough lines seen: the heading is within the first 15% whatever
+            # the final length. Replay what was held since
+            toc, pending = pending, None
+            for j, held_line in enumerate(held[1:], toc + 1):
+                content_start = find_content(j, held_line)
+                if content_start is not None:
+                    break
+        else:
+            content_start = find_content(i, line)
+
+        if content_start is not None:
+            logger.info(
+                f"  front matter: lines {toc + 1}–{content_start} stripped "
+                f"({content_start - toc} lines)"
+            )
+            yield from held[content_start - toc :]
+            held = []
+
+    if content_start is not None:
+        return
 
-    content_start = find_content_start(lines, toc_start + 1)
-    if content_start is None:
+    if pending is not None:
+        # Too far into the document to be the ToC; look again past it, now
+        # that the length is known
+        yield held[0]
+        yield from strip_front_matter(held[1:], start=pending + 1, total=i + 1)
+        return
+
+    if toc is None:
+        logger.info("  no ToC heading found — skipping front matter strip")
+    else:
         logger.warning(
             "  ToC found but could not detect content start — skipping front matter strip"
         )
-        return lines
+    yield from held
 
-    removed = content_start - toc_start
-    logger.info(
-        f"  front matter: lines {toc_start + 1}–{content_start} stripped ({removed} lines)"
-    )
-    return lines[:toc_start] + lines[content_start:]
 
+def strip_back_matter(lines: Iterable[str]) -> Iterator[str]:
+    """Yield `lines` up to the last INDEX heading in the last 30% of the document.
 
-def strip_back_matter(lines: list[str]) -> list[str]:
-    index_start = find_index_start(lines)
-    if index_start is None:
-        return lines
+    Lines from an INDEX heading on are held back until it is clear the heading
+    is too early to be the index (everything seen so far is already more than
+    30% longer than the held lines), so only a trailing index is ever buffered.
+    """
+    held: list[str] = []
+    held_start = 0
+    candidates: deque[int] = deque()  # INDEX headings among the held lines
 
-    removed = len(lines) - index_start
+    total = 0
+    for i, line in enumerate(lines):
+        total = i + 1
+        if INDEX_HEADING_RE.match(line.rstrip()):
+            if not candidates:
+                held_start = i
+            candidates.append(i)
+        if not candidates:
+            yield line
+            continue
+        held.append(line)
+
+        # Once a heading is at or before 70% of what has been read, it stays
+        # there however long the document turns out to be
+        while candidates and candidates[0] <= int(total * INDEX_FRACTION):
+            candidates.popleft()
+            release = (candidates[0] if candidates else total) - held_start
+            yield from held[:release]
+            held, held_start = held[release:], held_start + release
+
+    if not candidates:
+        yield from held
+        return
+
+    index_start = candidates[-1]
     logger.info(
-        f"  back matter: lines {index_start + 1}–{len(lines)} stripped ({removed} lines)"
+        f"  back matter: lines {index_start + 1}–{total} stripped "
+        f"({total - index_start} lines)"
     )
-    return lines[:index_start]
+    yield from held[: index_start - held_start]
+
 
+def strip_lines(lines: Iterable[str]) -> Iterator[str]:
+    """Stream a cleaned book's lines (without line endings) minus ToC, credits and index."""
+    return strip_back_matter(strip_front_matter(lines))
 
-def process(content: str, filename: str) -> str:
-    lines = content.splitlines()
-    lines = strip_front_matter(lines, filename)
-    lines = strip_back_matter(lines)
-    return "\n".join(lines)
+
+def stage_config() -> str:
+    return config_hash(source_hashes("strip_toc"))
+
+
+def process(content: str) -> str:
+    return "\n".join(strip_lines(content.splitlines()))
+
+
+def file_lines(f: TextIO) -> Iterator[str]:
+    """Lines of an open file without endings, split exactly as str.splitlines()."""
+    for raw in f:
+        yield from raw.splitlines()
+
+
+def strip_file(md_file: Path, dest: Path) -> None:
+    logger.info(f"processing {md_file.name}")
+
+    original_lines = 0
+
+    def counted(lines: Iterator[str]) -> Iterator[str]:
+        nonlocal original_lines
+        for line in lines:
+            original_lines += 1
+            yield line
+
+    with open(md_file, encoding="utf-8") as f:
+        stripped = "\n".join(strip_lines(counted(file_lines(f))))
+    write_atomic(dest, stripped)
+
+    stripped_lines = len(stripped.splitlines())
+    logger.info(
+        f"  {original_lines} → {stripped_lines} lines ({original_lines - stripped_lines} removed)"
+    )
 
 
 def main() -> None:
     setup_logging(settings.log_level)
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-strip every book, even those whose source and config are unchanged",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.chunk_workers or os.cpu_count() or 1,
+        help="Books stripped in parallel",
+    )
+    args = parser.parse_args()
+
     if not settings.markdown_path.exists():
         logger.error(f"markdown clean path {settings.markdown_path} does not exist")
         return
 
-    settings.markdown_stripped_path.mkdir(parents=True, exist_ok=True)
-
-    for md_file in sorted(settings.markdown_path.glob("*.md")):
-        dest = settings.markdown_stripped_path / md_file.name
-        logger.info(f"processing {md_file.name}")
-
-        content = md_file.read_text(encoding="utf-8")
-        stripped = process(content, md_file.name)
-        dest.write_text(stripped, encoding="utf-8")
-
-        original_lines = len(content.splitlines())
-        stripped_lines = len(stripped.splitlines())
-        logger.info(
-            f"  {original_lines} → {stripped_lines} lines ({original_lines - stripped_lines} removed)"
-        )
+    run_stage(
+        "strip",
+        strip_file,
+        sorted(settings.markdown_path.glob("*.md")),
+        settings.markdown_stripped_path,
+        stage_config(),
+        workers=args.workers,
+        force=args.force,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,184 @@
+"""Quantised copies of the NumPy index's vectors (see numpy_index.py).
+
+Searching scans every vector, so the scanned array's size sets the memory
+(page cache) a search needs and how long a cold start takes to read it in.
+Two compressed encodings cut that, at some cost in recall:
+
+- int8: each dimension is scaled into -128..127 using its min/max across the
+  corpus — 4x smaller than float32. A dot product with the query is
+  (query * scale) · codes + query · offset, so search is still one matrix
+  multiply (over small blocks converted in a reused float32 buffer).
+- pq: product quantisation. Vectors are split into NUMPY_INDEX_PQ_SUBVECTORS
+  slices, each slice is replaced by the nearest of 256 centroids trained
+  with k-means, and a vector becomes one byte per slice — 64 bytes instead
+  of 4 KiB for 1024-dim float32 with the default 64 slices. A search builds a
+  (slices × 256) table of query · centroid and sums table lookups.
+
+Either way the float vectors stay on disk next to the codes. With rescoring,
+the top candidates from the codes are re-ranked with their exact float
+vectors: only those rows are read, so recall comes back almost for free.
+
+Files, in the index directory: int8.codes.npy + int8.params.npz, or
+pq.codes.npy (slices × rows, so each slice's lookups are contiguous) +
+pq.params.npz.
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+from logs import logger
+
+QUANTISATIONS = ("none", "int8", "pq")
+
+# Rows per block when converting int8 codes; small enough for the float32
+# copy to stay in CPU cache, which is what makes the conversion cheap
+CONVERT_BLOCK_ROWS = 1024
+
+# Rows encoded per block, and vectors sampled to train PQ centroids
+ENCODE_BLOCK_ROWS = 65536
+PQ_TRAIN_SAMPLE = 20000
+PQ_CENTROIDS = 256
+PQ_ITERATIONS = 15
+
+
+class Int8Codes:
+    def __init__(self, codes: np.ndarray, scale: np.ndarray, offset: np.ndarray):
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, path: Path) -> None:
+        low = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        high = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(vectors), ENCODE_BLOCK_ROWS):
+            block = np.asarray(vectors[start : start + ENCODE_BLOCK_ROWS], dtype=np.float32)
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        scale = np.maximum(high - low, 1e-12) / 255
+        # x ≈ (code + 128) * scale + low = code * scale + offset
+        offset = low + 128 * scale
+
+        codes = np.lib.format.open_memmap(
+            path / "int8.codes.npy", mode="w+", dtype=np.int8, shape=vectors.shape
+        )
+        for start in range(0, len(vectors), ENCODE_BLOCK_ROWS):
+            block = np.asarray(vectors[start : start + ENCODE_BLOCK_ROWS], dtype=np.float32)
+            codes[start : start + len(block)] = np.clip(
+                np.rint((block - offset) / scale), -128, 127
+            )
+        codes.flush()
+        np.savez(path / "int8.params.npz", scale=scale, offset=offset)
+
+    @classmethod
+    def load(cls, path: Path) -> "Int8Codes":
+        with np.load(path / "int8.params.npz") as params:
+            scale, offset = params["scale"], params["offset"]
+        return cls(np.load(path / "int8.codes.npy", mmap_mode="r"), scale, offset)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    def dots(self, queries: np.ndarray) -> np.ndarray:
+        scaled = queries * self.scale
+        dots = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        buffer = np.empty((CONVERT_BLOCK_ROWS, self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.codes), CONVERT_BLOCK_ROWS):
+            block = self.codes[start : start + CONVERT_BLOCK_ROWS]
+            converted = buffer[: len(block)]
+            np.copyto(converted, block, casting="unsafe")
+            dots[:, start : start + len(block)] = scaled @ converted.T
+        return dots + (queries @ self.offset)[:, None]
+
+
+def _nearest_centroid(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin |x - c|² = argmin |c|² - 2 x·c
+    norms = np.einsum("ij,ij->i", centroids, centroids)
+    return np.argmin(norms - 2 * data @ centroids.T, axis=1)
+
+
+def _kmeans(data: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(PQ_ITERATIONS):
+        assign = _nearest_centroid(data, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.stack(
+            [np.bincount(assign, weights=data[:, d], minlength=k) for d in range(data.shape[1])],
+            axis=1,
+        )
+        # An empty cluster keeps its previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids.astype(np.float32)
+
+
+class PQCodes:
+    def __init__(self, codes: np.ndarray, centroids: np.ndarray):
+        self.codes = codes  # (slices, rows) uint8
+        self.centroids = centroids  # (slices, centroids, slice dimensions)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, path: Path, subvectors: int) -> None:
+        rows, dimensions = vectors.shape
+        if dimensions % subvectors:
+            raise ValueError(
+                f"{dimensions}-dim vectors can't be split into {subvectors} PQ subvectors"
+            )
+        width = dimensions // subvectors
+
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(rows, min(rows, PQ_TRAIN_SAMPLE), replace=False))
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+        k = min(PQ_CENTROIDS, len(sample))
+        centroids = np.stack(
+            [_kmeans(sample[:, j * width : (j + 1) * width], k, rng) for j in range(subvectors)]
+        )
+        logger.info(f"  trained {subvectors} × {k} PQ centroids on {len(sample)} vectors")
+
+        codes = np.lib.format.open_memmap(
+            path / "pq.codes.npy", mode="w+", dtype=np.uint8, shape=(subvectors, rows)
+        )
+        for start in range(0, rows, ENCODE_BLOCK_ROWS):
+            block = np.asarray(vectors[start : start + ENCODE_BLOCK_ROWS], dtype=np.float32)
+            for j in range(subvectors):
+                codes[j, start : start + len(block)] = _nearest_centroid(
+                    block[:, j * width : (j + 1) * width], centroids[j]
+                )
+        codes.flush()
+        np.savez(path / "pq.params.npz", centroids=centroids)
+
+    @classmethod
+    def load(cls, path: Path) -> "PQCodes":
+        with np.load(path / "pq.params.npz") as params:
+            centroids = params["centroids"]
+        return cls(np.load(path / "pq.codes.npy", mmap_mode="r"), centroids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    def dots(self, queries: np.ndarray) -> np.ndarray:
+        subvectors, _, width = self.centroids.shape
+        dots = np.zeros((len(queries), self.codes.shape[1]), dtype=np.float32)
+        for j in range(subvectors):
+            table = queries[:, j * width : (j + 1) * width] @ self.centroids[j].T
+            dots += table[:, self.codes[j]]
+        return dots
+
+
+def build(method: str, vectors: np.ndarray, path: Path, pq_subvectors: int) -> None:
+    """Write `method`'s codes for `vectors` into the index directory `path`."""
+    if method == "int8":
+        Int8Codes.build(vectors, path)
+    elif method == "pq":
+        PQCodes.build(vectors, path, pq_subvectors)
+
+
+def load(method: str, path: Path) -> Int8Codes | PQCodes | None:
+    if method == "int8":
+        return Int8Codes.load(path)
+    if method == "pq":
+        return PQCodes.load(path)
+    return None
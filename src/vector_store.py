@@ -0,0 +1,107 @@
+"""Open the vector store the query side searches, per VECTOR_BACKEND.
+
+- chroma: the Chroma store create_embeddings.py writes (HNSW search)
+- numpy: exact search over numpy_index/, exported from that store (see
+  numpy_index.py)
+- sharded: one collection per book under chroma_shards/, which ingest
+  writes instead of the single store, searched in parallel (see
+  sharded_store.py)
+
+Both are langchain vector stores taking the same filters, so callers don't
+need to know which one they got.
+
+The Chroma collection is created with the HNSW_* settings. Only ef_search can
+change afterwards: opening the store brings it in line with HNSW_EF_SEARCH
+before anything searches it (a process keeps the ef_search its index was
+loaded with). A store built with a different space, M or ef_construction is
+reported rather than silently searched as if it matched.
+"""
+
+from pathlib import Path
+
+import chromadb
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from chunk_index import COLLECTION_NAME
+from config import settings
+from logs import logger
+
+# Fixed when a collection is created; changing them means a full rebuild
+HNSW_BUILD_PARAMS = ("space", "max_neighbors", "ef_construction")
+
+
+def vector_store_path() -> Path:
+    if settings.vector_backend == "numpy":
+        return settings.numpy_index_path
+    if settings.vector_backend == "sharded":
+        return settings.chroma_shards_path
+    return settings.chroma_path
+
+
+def hnsw_configuration() -> dict:
+    """Chroma collection configuration for the HNSW_* settings."""
+    return {
+        "hnsw": {
+            "space": settings.hnsw_space,
+            "max_neighbors": settings.hnsw_max_neighbors,
+            "ef_construction": settings.hnsw_ef_construction,
+            "ef_search": settings.hnsw_ef_search,
+        }
+    }
+
+
+def apply_hnsw_settings(collection) -> None:
+    """Set the collection's ef_search from settings; warn about build params that differ."""
+    current = (collection.configuration or {}).get("hnsw") or {}
+    wanted = hnsw_configuration()["hnsw"]
+
+    stale = [
+        f"{param} {current.get(param)} (settings: {wanted[param]})"
+        for param in HNSW_BUILD_PARAMS
+        if current.get(param) != wanted[param]
+    ]
+    if stale:
+        logger.warning(
+            f"vector store was built with HNSW {', '.join(stale)}; "
+            "a full rebuild is needed to apply them"
+        )
+
+    if current.get("ef_search") != wanted["ef_search"]:
+        logger.info(f"setting HNSW ef_search {current.get('ef_search')} → {wanted['ef_search']}")
+        collection.modify(configuration={"hnsw": {"ef_search": wanted["ef_search"]}})
+
+
+def chroma_client():
+    settings.chroma_path.mkdir(parents=True, exist_ok=True)
+    return chromadb.PersistentClient(path=str(settings.chroma_path))
+
+
+def open_collection(client=None):
+    """Open (or create) the Chroma collection, with the HNSW settings applied."""
+    client = client or chroma_client()
+    collection = client.get_or_create_collection(
+        name=COLLECTION_NAME, configuration=hnsw_configuration()
+    )
+    apply_hnsw_settings(collection)
+    return collection
+
+
+def open_vector_store(embeddings: Embeddings) -> VectorStore:
+    if settings.vector_backend == "numpy":
+        from numpy_index import NumpyVectorStore
+
+        return NumpyVectorStore(settings.numpy_index_path, embeddings)
+    if settings.vector_backend == "sharded":
+        from sharded_store import ShardedVectorStore
+
+        return ShardedVectorStore(settings.chroma_shards_path, embeddings)
+
+    client = chroma_client()
+    open_collection(client)
+    return Chroma(
+        client=client,
+        collection_name=COLLECTION_NAME,
+        embedding_function=embeddings,
+    )